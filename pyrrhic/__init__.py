@@ -1,9 +1,12 @@
 import base64
-import urllib
-import urllib2
+import re
+import sys
+import threading
+import time
 import urlparse
 
-import pyrrhic.http
+import pyrrhic.jobs
+import pyrrhic.streaming
 
 # Mapping of HTTP verbs to a bool indicating whether data is required
 # for each of them.
@@ -15,64 +18,237 @@ HTTP_VERBS = {
     u'OPTIONS': False,
 }
 
-opener = urllib2.build_opener(
-    pyrrhic.http.PyrrhicHTTPErrorHandler,
-)
+# Matches a URL that starts with a scheme, like 'http://'
+SCHEME_RE = re.compile(r'[A-Za-z][A-Za-z0-9+.-]*://')
+
+# What every Resource shares. Each is made when it's first needed, by its
+# get_*() function below, so that importing pyrrhic, e.g. to start pyr,
+# doesn't import the network modules. They're None until then.
+
+# Idle keep-alive connections
+pool = None
+
+# DNS lookups, shared by every new connection
+dns_cache = None
+
+# Client-side response cache. Switched off until enabled with the cache
+# command.
+cache = None
+
+# Shared HTTP/2 connections, for resources that have HTTP/2 switched on
+http2_handler = None
+
+# Records requests and responses, once switched on with the record command
+recorder = None
+
+# Rate limits for each host, and backing off when a host asks us to. Every
+# request that goes to the network waits its turn here.
+throttle = None
+
+# Latency and size histograms for every request, shown by the stats command
+request_stats = None
+
+# Makes requests through all of the above
+opener = None
+
+# Held while making any of them. Making the opener makes the others.
+_lock = threading.RLock()
+
+
+def _shared(name, make):
+    # The shared object `name`, made by make() if it hasn't been yet
+    value = globals()[name]
+    if value is None:
+        with _lock:
+            value = globals()[name]
+            if value is None:
+                value = globals()[name] = make()
+    return value
+
+
+def _make(path, *args):
+    # An instance of the class at `path`, e.g. 'pyrrhic.http:ConnectionPool'
+    module, _, name = path.partition(':')
+    __import__(module)
+    return getattr(sys.modules[module], name)(*args)
+
+
+def get_pool():
+    return _shared('pool', lambda: _make('pyrrhic.http:ConnectionPool'))
+
+
+def get_dns_cache():
+    return _shared('dns_cache', lambda: _make('pyrrhic.resolver:DNSCache'))
+
+
+def get_cache():
+    return _shared('cache', lambda: _make('pyrrhic.caching:ResponseCache'))
+
+
+def get_http2_handler():
+    return _shared('http2_handler', lambda: _make(
+        'pyrrhic.http2:HTTP2Handler', get_dns_cache()))
+
+
+def get_recorder():
+    return _shared('recorder', lambda: _make(
+        'pyrrhic.recording:RecordingHandler'))
+
+
+def get_throttle():
+    return _shared('throttle', lambda: _make('pyrrhic.throttling:Throttle'))
+
+
+def get_request_stats():
+    return _shared('request_stats', lambda: _make('pyrrhic.stats:Stats'))
+
+
+def _build_opener():
+    import urllib2
+    import pyrrhic.caching
+    import pyrrhic.compression
+    import pyrrhic.http
+    import pyrrhic.stats
+    import pyrrhic.throttling
+    pool, dns_cache = get_pool(), get_dns_cache()
+    return urllib2.build_opener(
+        pyrrhic.http.PyrrhicHTTPErrorHandler,
+        pyrrhic.caching.CacheHandler(get_cache()),
+        get_recorder(),
+        pyrrhic.throttling.ThrottleHandler(get_throttle()),
+        pyrrhic.throttling.RetryHandler(get_throttle()),
+        pyrrhic.stats.StatsHandler(get_request_stats()),
+        pyrrhic.compression.ContentEncodingHandler,
+        get_http2_handler(),
+        pyrrhic.http.KeepAliveHTTPHandler(pool, resolver=dns_cache),
+        pyrrhic.http.KeepAliveHTTPSHandler(pool, resolver=dns_cache),
+    )
+
+
+def get_opener():
+    """ The opener every Resource makes its requests with """
+    if opener is not None:
+        return opener
+    return _shared('opener', _build_opener)
+
+
+def after_fork(processes, resources=()):
+    """
+    Set up a forked worker process, one of `processes` sharing the load
+    (see pyrrhic.bench.run_processes). It gets connections of its own, as
+    sockets inherited from the parent can't be shared, doesn't record, as
+    only the parent writes to the recording, and takes its share of each
+    rate limit, including those of `resources`.
+    """
+    global pool, http2_handler, recorder, opener
+    # Made again, for this process, when they're next needed
+    pool = http2_handler = recorder = opener = None
+    buckets = [resource.rate_limit for resource in resources]
+    if throttle is not None:
+        buckets += throttle.limits.values()
+    shared = set()
+    for bucket in buckets:
+        if bucket is not None and id(bucket) not in shared:
+            # Resources joined to another share its bucket
+            shared.add(id(bucket))
+            bucket.share(processes)
 
 class Resource(object):
     
-    has_authentication = False
-    
+    # Resources are created in bulk, e.g. when loading a session, so keep
+    # them small
+    __slots__ = ('url', 'parsed_url', 'has_authentication', 'http2',
+                 'rate_limit', 'stats_label', '_headers', '_selector')
+
     def __init__(self, url):
         """
-        Create a Resource instance, bound to a URL.
+        Create a Resource instance, bound to a URL. The URL is only parsed
+        here: the request target is worked out once, so that requests don't
+        need to parse it again.
         """
         self._headers = {}
-        
-        parsed_url = urlparse.urlparse(url)
-        if parsed_url.scheme and not parsed_url.netloc:
-            # If we have a scheme but no netloc, someone's entered
-            # a URL like 'foo.com:123'. Add an http://to the
-            # start, and reparse.
+        self.has_authentication = False
+        # Whether to try HTTP/2 first; see pyrrhic.http2
+        self.http2 = False
+        # A pyrrhic.throttling.TokenBucket, or None for no limit. Resources
+        # joined to this one share it.
+        self.rate_limit = None
+
+        if not SCHEME_RE.match(url):
+            # No scheme was provided, e.g. 'foo.com' or 'foo.com:123'.
+            # Default to http.
             url = 'http://' + url
-            parsed_url = urlparse.urlparse(url)
-            
-        if not parsed_url.scheme:
-            # If no scheme was provided, then the url parsing
-            # won't have worked. Reparse.
-            scheme = 'http'
-            url = '%s://%s' % (scheme, url)
-            parsed_url = urlparse.urlparse(url)
-        else:
-            scheme = parsed_url.scheme
+        parsed_url = urlparse.urlparse(url)
 
-        if parsed_url.netloc.find(':') < 0:
-            if scheme == 'http':
-                netloc = parsed_url.netloc + ':80'
+        netloc = parsed_url.netloc
+        if netloc.find(':') < 0:
+            if parsed_url.scheme == 'http':
+                netloc += ':80'
             else:
-                netloc = parsed_url.netloc + ':443'
-        else:
-            # Already had an explicit port
-            netloc = parsed_url.netloc
-        
+                netloc += ':443'
+
         # Normalise
-        self.url = urlparse.urlunparse((scheme, netloc, parsed_url.path,
-                    parsed_url.params, parsed_url.query, parsed_url.fragment))
-        self.parsed_url = urlparse.urlparse(self.url)
+        self.parsed_url = parsed_url._replace(netloc=netloc)
+        self.url = self.parsed_url.geturl()
+        # What requests are counted under in `request_stats`: the URL of
+        # this resource, or of the one it was joined to
+        self.stats_label = self.url
+
+        selector = parsed_url.path or '/'
+        if parsed_url.params:
+            selector += ';' + parsed_url.params
+        if parsed_url.query:
+            selector += '?' + parsed_url.query
+        self._selector = selector
+
+    @classmethod
+    def from_urls(cls, urls):
+        """ Create a Resource for each of a list of URLs """
+        return map(cls, urls)
 
     def set_authentication(self, username, password):
         auth = base64.b64encode('%s:%s' % (username, password))
         self._headers['Authorization'] = 'Basic %s' % auth
         self.has_authentication = True
 
-    def _getresponse(self, verb, data=None):
+    def _getresponse(self, verb, data=None, selector=None, headers=()):
+        import socket
+        import urllib2
+        import pyrrhic.http
         assert verb in HTTP_VERBS
+        opener = get_opener()
         if HTTP_VERBS[verb]:
-            data = urllib.urlencode(data, doseq=True)
-        request = pyrrhic.http.Request(self.url, req_method=verb, data=data)
+            if hasattr(data, 'read'):
+                # A file: stream it, rather than reading it into memory
+                data = pyrrhic.streaming.Upload.from_file(data)
+            elif not isinstance(data, (pyrrhic.streaming.Upload, str)):
+                # Strings are sent as they are, e.g. from a template
+                import urllib
+                data = urllib.urlencode(data, doseq=True)
+        if selector is None:
+            url, selector = self.url, self._selector
+        else:
+            url = '%s://%s%s' % (self.parsed_url.scheme,
+                                 self.parsed_url.netloc, selector)
+        request = pyrrhic.http.Request(url, req_method=verb, data=data)
+        request.set_target(self.parsed_url.scheme, self.parsed_url.netloc,
+                           selector)
+        request.http2 = self.http2
+        request.rate_limit = self.rate_limit
+        request.stats_label = self.stats_label
         for header, value in self._headers.items():
             request.add_header(header, value)
-        return opener.open(request)
+        for header, value in headers:
+            request.add_header(header, value)
+        start = time.time()
+        try:
+            return opener.open(request)
+        except (urllib2.URLError, socket.error):
+            # Responses are recorded by the opener, but failures have to be
+            # recorded here
+            get_request_stats().record(self.stats_label, None,
+                                       time.time() - start)
+            raise
 
     def get(self):
          return self._getresponse('GET')
@@ -87,4 +263,80 @@ class Resource(object):
         return self._getresponse('DELETE')
         
     def options(self):
-        return self._getresponse('OPTIONS')
\ No newline at end of file
+        return self._getresponse('OPTIONS')
+
+    def send_template(self, verb, template):
+        """
+        Make a request from the next rendering of a
+        `pyrrhic.templates.Template`. Its path is relative to this resource,
+        as with join(), and its headers are added to this resource's.
+        Returns the response.
+        """
+        path, headers, body = template.render()
+        selector = None
+        if path:
+            path, query = self._join_path(path)
+            selector = path or '/'
+            if query:
+                selector += '?' + query
+        if body is None and HTTP_VERBS[verb]:
+            body = ''
+        return self._getresponse(verb, body, selector, headers)
+
+    def _join_path(self, path):
+        # The path and query of a path relative to this resource
+        path, _, query = path.partition('?')
+        if path:
+            path = self.parsed_url.path.rstrip('/') + '/' + path.lstrip('/')
+        else:
+            path = self.parsed_url.path
+        return path, query
+
+    def join(self, path):
+        """
+        Return a Resource for a path relative to this one, such as 'items/1'
+        or '?page=2', with the same headers and authentication.
+        """
+        path, query = self._join_path(path)
+        resource = Resource(urlparse.urlunparse((self.parsed_url.scheme,
+                            self.parsed_url.netloc, path, '', query, '')))
+        resource._headers = dict(self._headers)
+        resource.has_authentication = self.has_authentication
+        resource.http2 = self.http2
+        resource.rate_limit = self.rate_limit
+        resource.stats_label = self.stats_label
+        return resource
+
+    def batch(self, paths, verb='GET', data=None, connections=1):
+        """
+        Make a request for each of `paths`, relative to this resource, over
+        at most `connections` keep-alive connections. Returns an iterator of
+        the responses, in the same order as the paths. Each body is read
+        before it's returned, so its connection can carry the next request.
+        """
+        import pyrrhic.http
+        if data is None and HTTP_VERBS[verb]:
+            data = {}
+
+        def fetch(path):
+            response = self.join(path)._getresponse(verb, data)
+            return pyrrhic.http.BufferedResponse.from_response(response)
+        return pyrrhic.jobs.imap(fetch, paths, connections)
+
+    # Background versions of the verbs, which return a `pyrrhic.jobs.Job`.
+    # Call result() on the job to wait for the response.
+
+    def get_async(self):
+        return pyrrhic.jobs.submit(self.get)
+
+    def put_async(self, data={}):
+        return pyrrhic.jobs.submit(self.put, data)
+
+    def post_async(self, data={}):
+        return pyrrhic.jobs.submit(self.post, data)
+
+    def delete_async(self):
+        return pyrrhic.jobs.submit(self.delete)
+
+    def options_async(self):
+        return pyrrhic.jobs.submit(self.options)
\ No newline at end of file
@@ -0,0 +1,369 @@
+import copy
+import httplib
+import os
+import Queue
+import signal
+import socket
+import threading
+import time
+import urllib2
+
+import pyrrhic.histogram
+import pyrrhic.streaming
+
+
+class BenchResult(object):
+    """
+    Collects the outcome of each request made during a benchmark. Latencies
+    are counted in a `pyrrhic.histogram.Histogram`, so that results from
+    several processes can be merged.
+    """
+
+    def __init__(self, concurrency, processes=1):
+        self.concurrency = concurrency
+        self.processes = processes
+        self.elapsed = 0.0
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.histogram = pyrrhic.histogram.Histogram()
+        self.statuses = {}
+        self.errors = {}
+        self.bytes = 0
+
+    def __getstate__(self):
+        # Results are sent between processes, and locks can't be
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def record(self, latency, status=None, size=0, error=None):
+        with self._lock:
+            self.histogram.record(latency)
+            self.bytes += size
+            if error is not None:
+                self.errors[error] = self.errors.get(error, 0) + 1
+            else:
+                self.statuses[status] = self.statuses.get(status, 0) + 1
+
+    def take(self):
+        """
+        Return what's been recorded since the last take(), as a result of
+        its own, e.g. to send to another process
+        """
+        with self._lock:
+            taken = copy.copy(self)
+            self._reset()
+        return taken
+
+    def merge(self, other):
+        """ Add the outcomes recorded in another result to this one """
+        with self._lock:
+            self.histogram.merge(other.histogram)
+            self.bytes += other.bytes
+            for counts, other_counts in ((self.statuses, other.statuses),
+                                         (self.errors, other.errors)):
+                for key, count in other_counts.items():
+                    counts[key] = counts.get(key, 0) + count
+
+    @property
+    def count(self):
+        return self.histogram.count
+
+    @property
+    def throughput(self):
+        if not self.elapsed:
+            return 0.0
+        return self.count / self.elapsed
+
+    def report(self):
+        """ Return the summary as a list of lines """
+        concurrency = 'Concurrency:  %d' % self.concurrency
+        if self.processes > 1:
+            concurrency += ' (over %d processes)' % self.processes
+        lines = [
+            'Requests:     %d in %.2fs (%.1f req/s)' % (self.count,
+                self.elapsed, self.throughput),
+            concurrency,
+            'Transferred:  %d bytes' % self.bytes,
+            'Status codes: %s' % (', '.join('%s: %d' % item
+                for item in sorted(self.statuses.items())) or 'none'),
+        ]
+        if self.errors:
+            lines.append('Errors:       %s' % ', '.join('%s: %d' % item
+                for item in sorted(self.errors.items())))
+        lines.append('Latency (ms): p50 %.1f  p90 %.1f  p99 %.1f  max %.1f' % tuple(
+            self.histogram.percentile(p) * 1000 for p in (50, 90, 99, 100)))
+        return lines
+
+
+def drain(response):
+    """ Read and discard a response body, returning its size """
+    size = 0
+    try:
+        while True:
+            data = response.read(pyrrhic.streaming.CHUNK_SIZE)
+            if not data:
+                break
+            size += len(data)
+    finally:
+        response.close()
+    return size
+
+
+def timed_request(send, result, start=None):
+    """
+    Make one request with `send` and record it in `result`. Its latency is
+    counted from `start`, if given, rather than from when it was sent.
+    """
+    if start is None:
+        start = time.time()
+    try:
+        response = send()
+        size = drain(response)
+    except (urllib2.URLError, socket.error, httplib.HTTPException), e:
+        result.record(time.time() - start, error=e.__class__.__name__)
+    else:
+        result.record(time.time() - start, response.code, size)
+
+
+def run_threads(worker, count, stop):
+    """
+    Run `worker` on `count` threads until they're all done. Ctrl-C calls
+    `stop`, which should make the workers finish after their current
+    request, so that what's been done so far can still be reported.
+    """
+    threads = [threading.Thread(target=worker) for i in range(count)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    try:
+        for thread in threads:
+            # Join with a timeout so that Ctrl-C still gets through
+            while thread.is_alive():
+                thread.join(0.1)
+    except KeyboardInterrupt:
+        stop()
+        for thread in threads:
+            thread.join()
+
+
+def run(send, count, concurrency, result=None):
+    """
+    Call `send`, which should make a request and return the response,
+    `count` times across `concurrency` threads. Returns a `BenchResult`,
+    which is `result` if one is given.
+    """
+    if result is None:
+        result = BenchResult(concurrency)
+    remaining = [count]
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+            timed_request(send, result)
+
+    def stop():
+        # Stop handing out requests
+        with lock:
+            remaining[0] = 0
+
+    start = time.time()
+    run_threads(worker, min(concurrency, count), stop)
+    result.elapsed = time.time() - start
+    return result
+
+
+# Requests that start more than this many seconds after they were due are
+# counted as late
+LATE = 0.005
+
+
+class PacedResult(BenchResult):
+    """ A `BenchResult` for `run_paced`, that also counts late starts """
+
+    def __init__(self, concurrency, rate, processes=1):
+        BenchResult.__init__(self, concurrency, processes)
+        self.rate = rate
+
+    def _reset(self):
+        BenchResult._reset(self)
+        self.late = 0
+
+    def merge(self, other):
+        BenchResult.merge(self, other)
+        with self._lock:
+            self.late += other.late
+
+    def report(self):
+        lines = BenchResult.report(self)
+        lines.insert(1, 'Target rate:  %.1f req/s, %d started late' % (
+            self.rate, self.late))
+        return lines
+
+
+def run_paced(send, count, rate, concurrency, result=None):
+    """
+    Like `run`, but open-loop: a request is due every 1/`rate` seconds,
+    however long earlier ones are taking, and is sent by the first of the
+    `concurrency` threads that's free. Latency is counted from when each
+    request was due, so a server that falls behind shows up in the
+    percentiles, rather than just slowing the requests down. Returns a
+    `PacedResult`, which is `result` if one is given.
+    """
+    if result is None:
+        result = PacedResult(concurrency, rate)
+    sent = [0]
+    lock = threading.Lock()
+    stopped = threading.Event()
+    start = time.time()
+
+    def worker():
+        while True:
+            with lock:
+                if sent[0] >= count:
+                    return
+                due = start + sent[0] / float(rate)
+                sent[0] += 1
+            wait = due - time.time()
+            if wait > 0:
+                stopped.wait(wait)
+            if stopped.is_set():
+                return
+            if wait < -LATE:
+                with result._lock:
+                    result.late += 1
+            timed_request(send, result, due)
+
+    run_threads(worker, min(concurrency, count), stopped.set)
+    result.elapsed = time.time() - start
+    return result
+
+
+# Seconds between the partial results each worker process sends back
+REPORT_INTERVAL = 0.5
+
+
+def _share(total, parts, index):
+    # The index'th of `parts` nearly equal shares of `total`
+    return total // parts + (index < total % parts)
+
+
+def _process_worker(index, processes, send, count, concurrency, rate,
+                    prepare, stats, results):
+    # Runs in a worker process, sending partial results to the parent as
+    # it goes, with the stats series recorded since the last, then None
+    # when it's done
+    count = _share(count, processes, index)
+    concurrency = max(_share(concurrency, processes, index), 1)
+    if rate:
+        result = PacedResult(concurrency, rate / processes)
+    else:
+        result = BenchResult(concurrency)
+    finished = threading.Event()
+
+    def take():
+        return result.take(), stats is not None and stats.take() or {}
+
+    def report():
+        while not finished.wait(REPORT_INTERVAL):
+            results.put(take())
+
+    reporter = threading.Thread(target=report)
+    reporter.daemon = True
+    try:
+        if stats is not None:
+            # Only send back what this worker records
+            stats.take()
+        prepare(index)
+        reporter.start()
+        if rate:
+            run_paced(send, count, rate / processes, concurrency, result)
+        else:
+            run(send, count, concurrency, result)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        finished.set()
+        if reporter.is_alive():
+            reporter.join()
+        results.put(take())
+        results.put(None)
+
+
+def run_processes(send, count, concurrency, processes, rate=None,
+                  prepare=None, stats=None):
+    """
+    Like `run`, or `run_paced` if `rate` is given, but spread over
+    `processes` worker processes, so that the work of sending requests and
+    reading responses isn't limited to one core. The requests, threads and
+    rate are shared out between the workers. Workers are forked, so `send`
+    can be any callable; `prepare`, if given, is called with each worker's
+    index first, e.g. to give it connections of its own. `stats`, if given,
+    is a `pyrrhic.stats.Stats` that requests are recorded in: what each
+    worker records in its copy is merged into it too.
+
+    Workers send back what they've recorded every REPORT_INTERVAL seconds,
+    which is merged into the result as it comes, so only histograms and
+    counts, rather than every latency, go between processes. Returns a
+    `BenchResult`, or a `PacedResult` if `rate` is given.
+    """
+    # Not imported until it's needed, as it's slow to import and most
+    # benchmarks use one process
+    import multiprocessing
+    if rate:
+        result = PacedResult(concurrency, rate, processes)
+    else:
+        result = BenchResult(concurrency, processes)
+    results = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=_process_worker,
+                                       args=(i, processes, send, count,
+                                             concurrency, rate,
+                                             prepare or (lambda index: None),
+                                             stats, results))
+               for i in range(processes)]
+    start = time.time()
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+    running = processes
+    while running:
+        try:
+            taken = results.get(timeout=0.1)
+        except Queue.Empty:
+            if any(worker.is_alive() for worker in workers):
+                continue
+            # A worker died without saying it was done. Take anything
+            # that's left in the queue.
+            try:
+                taken = results.get(timeout=0.1)
+            except Queue.Empty:
+                break
+        except KeyboardInterrupt:
+            # Workers in the same process group get Ctrl-C too, but make
+            # sure they stop, then wait for what they've done so far
+            for worker in workers:
+                if worker.is_alive():
+                    os.kill(worker.pid, signal.SIGINT)
+            continue
+        if taken is None:
+            running -= 1
+        else:
+            taken, series = taken
+            result.merge(taken)
+            if stats is not None:
+                stats.merge(series)
+    for worker in workers:
+        worker.join()
+    result.elapsed = time.time() - start
+    return result
+
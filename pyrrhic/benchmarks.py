@@ -0,0 +1,309 @@
+"""
+Benchmarks for the request path, run against a local stand-in HTTP server so
+that the numbers don't depend on the network. Run them with::
+
+  python -m pyrrhic.benchmarks -o results.json
+
+and compare the results files from different releases.
+"""
+import BaseHTTPServer
+import fnmatch
+import json
+import optparse
+import platform
+import SocketServer
+import sys
+import threading
+import time
+import traceback
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows; peak memory isn't recorded there
+    resource = None
+
+import pyrrhic
+import pyrrhic.bench
+import pyrrhic.commands
+import pyrrhic.ui
+
+# Size of the chunks the server writes when using chunked encoding
+SERVER_CHUNK_SIZE = 8 * 1024
+
+DEFAULT_REQUESTS = 200
+
+
+class BenchmarkHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Answers every request with a body of `server.body_size` bytes, after
+    waiting `server.latency` seconds. Sending 'Connection: close' makes
+    the server hang up after each response when keep-alive is off.
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    # Send each response in as few packets as possible, so that Nagle's
+    # algorithm and delayed ACKs don't add ~40ms to every request
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self._read_body()
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        body = 'x' * self.server.body_size
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        if not self.server.keep_alive:
+            self.send_header('Connection', 'close')
+        if self.server.chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for i in range(0, len(body), SERVER_CHUNK_SIZE):
+                chunk = body[i:i + SERVER_CHUNK_SIZE]
+                self.wfile.write('%x\r\n%s\r\n' % (len(chunk), chunk))
+            self.wfile.write('0\r\n\r\n')
+        else:
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    do_PUT = do_POST = do_DELETE = do_OPTIONS = do_GET
+
+    def _read_body(self):
+        # Read and discard the request body, so that it isn't taken for the
+        # next request on the connection
+        if self.headers.get('transfer-encoding', '').lower() == 'chunked':
+            while True:
+                size = int(self.rfile.readline().split(';')[0], 16)
+                self.rfile.read(size + 2)
+                if not size:
+                    return
+        length = int(self.headers.get('content-length') or 0)
+        if length:
+            self.rfile.read(length)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class BenchmarkServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, latency=0.0, body_size=1024, chunked=False,
+                 keep_alive=True):
+        self.latency = latency
+        self.body_size = body_size
+        self.chunked = chunked
+        self.keep_alive = keep_alive
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                           BenchmarkHandler)
+
+    @property
+    def url(self):
+        return 'http://%s:%d/' % self.server_address
+
+    def options(self):
+        return {
+            'latency': self.latency,
+            'body_size': self.body_size,
+            'chunked': self.chunked,
+            'keep_alive': self.keep_alive,
+        }
+
+    def start(self):
+        # Poll often, so that shutting down between scenarios is quick
+        thread = threading.Thread(target=self.serve_forever, args=(0.01,))
+        thread.daemon = True
+        thread.start()
+        return self
+
+
+class NullOutput(object):
+    """ Swallows what commands print, counting how much there was """
+
+    def __init__(self):
+        self.bytes = 0
+
+    def write(self, data):
+        self.bytes += len(data)
+
+    def flush(self):
+        pass
+
+
+def resource_get(resources):
+    response = resources['__default__'].get()
+    pyrrhic.bench.drain(response)
+    return response.code
+
+
+def resource_post(resources):
+    response = resources['__default__'].post({'key': 'value'})
+    pyrrhic.bench.drain(response)
+    return response.code
+
+
+def command_get(resources):
+    command = pyrrhic.commands.GetCommand(resources)
+    command.run()
+    return command.response.code
+
+
+def console_get(resources):
+    command, args = pyrrhic.ui.CommandParser().parse('get')
+    command = command(resources)
+    pyrrhic.ui.run_command(command, args)
+    return command.response.code
+
+
+# Each scenario is (name, function to benchmark, server options)
+SCENARIOS = [
+    ('resource-get', resource_get, {}),
+    ('resource-post', resource_post, {}),
+    ('resource-get-close', resource_get, {'keep_alive': False}),
+    ('resource-get-chunked', resource_get, {'chunked': True}),
+    ('resource-get-1mb', resource_get, {'body_size': 1024 * 1024}),
+    ('resource-get-latency', resource_get, {'latency': 0.005}),
+    ('command-get', command_get, {}),
+    ('command-get-chunked', command_get, {'chunked': True}),
+    ('console-get', console_get, {}),
+]
+
+
+def peak_memory():
+    """
+    Peak resident set size of this process so far, in KB. Each scenario
+    runs in a process of its own (see run_isolated), so this is its peak.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # Reported in bytes on OS X, rather than KB
+        peak //= 1024
+    return peak
+
+
+def measure(func, resources, count):
+    """ Call func(resources) `count` times, returning a `BenchResult` """
+    result = pyrrhic.bench.BenchResult(1)
+    start = time.time()
+    for i in range(count):
+        request_start = time.time()
+        status = func(resources)
+        result.record(time.time() - request_start, status)
+    result.elapsed = time.time() - start
+    return result
+
+
+def run_scenario(name, func, server_options, count):
+    """ Run one scenario against a fresh server, returning its results """
+    server = BenchmarkServer(**server_options).start()
+    stdout = sys.stdout
+    sys.stdout = NullOutput()
+    try:
+        resources = {'__default__': pyrrhic.Resource(server.url)}
+        # Warm up, so the first connection isn't counted
+        func(resources)
+        result = measure(func, resources, count)
+        printed = sys.stdout.bytes
+    finally:
+        sys.stdout = stdout
+        server.shutdown()
+        server.server_close()
+        pyrrhic.get_pool().clear()
+    histogram = result.histogram
+    return {
+        'name': name,
+        'server': server.options(),
+        'requests': result.count,
+        'elapsed': result.elapsed,
+        'requests_per_sec': result.throughput,
+        'latency_ms': dict(('p%d' % p, histogram.percentile(p) * 1000)
+                           for p in (50, 90, 99, 100)),
+        'mean_latency_ms': histogram.mean * 1000,
+        'status_codes': dict((str(status), n)
+                             for status, n in result.statuses.items()),
+        'printed_bytes': printed,
+        'peak_memory_kb': peak_memory(),
+    }
+
+
+def _scenario_process(name, func, server_options, count, results):
+    # Runs in a child process, sending back the scenario's results, or the
+    # traceback if it failed
+    pyrrhic.after_fork(1)
+    try:
+        results.put((run_scenario(name, func, server_options, count), None))
+    except Exception:
+        results.put((None, traceback.format_exc()))
+
+
+def run_isolated(name, func, server_options, count):
+    """
+    Like run_scenario, but in a forked process, so that its peak memory
+    isn't the high-water mark of every scenario run before it
+    """
+    # Not imported until it's needed, as it's slow to import
+    import multiprocessing
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_scenario_process,
+                                      args=(name, func, server_options,
+                                            count, results))
+    process.daemon = True
+    process.start()
+    try:
+        result, error = results.get()
+    finally:
+        process.join()
+    if error is not None:
+        raise RuntimeError, 'Scenario %s failed:\n%s' % (name, error)
+    return result
+
+
+def run(count=DEFAULT_REQUESTS, patterns=None):
+    """
+    Run the scenarios whose names match any of `patterns` (all of them if
+    None), making `count` requests in each. Returns the results as a dict
+    ready to be written out as JSON.
+    """
+    results = []
+    for name, func, server_options in SCENARIOS:
+        if patterns and not any(fnmatch.fnmatch(name, p) for p in patterns):
+            continue
+        results.append(run_isolated(name, func, server_options, count))
+    return {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'scenarios': results,
+    }
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='%prog [options] [SCENARIO...]')
+    parser.add_option('-o', '--output', default='benchmark-results.json',
+                      help='file to write the results to '
+                           '[default: %default]')
+    parser.add_option('-n', '--requests', type='int', default=DEFAULT_REQUESTS,
+                      help='requests per scenario [default: %default]')
+    options, patterns = parser.parse_args(argv)
+    results = run(options.requests, patterns)
+    for scenario in results['scenarios']:
+        print '%-22s %8.1f req/s  p50 %6.2fms  p99 %6.2fms  peak %s KB' % (
+            scenario['name'], scenario['requests_per_sec'],
+            scenario['latency_ms']['p50'], scenario['latency_ms']['p99'],
+            scenario['peak_memory_kb'])
+    f = open(options.output, 'w')
+    try:
+        json.dump(results, f, indent=2, sort_keys=True)
+    finally:
+        f.close()
+    print 'Results written to %s' % options.output
+
+
+if __name__ == '__main__':
+    main()
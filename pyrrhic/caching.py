@@ -0,0 +1,454 @@
+import collections
+import cPickle
+import hashlib
+import httplib
+import os
+import StringIO
+import threading
+import time
+import urllib2
+
+import pyrrhic.http
+
+# Only the responses to these methods are cached
+CACHEABLE_METHODS = ('GET',)
+
+# Only responses with these status codes are cached
+CACHEABLE_STATUSES = (200, 203, 300, 301, 410)
+
+
+def parse_cache_control(value):
+    """
+    Parse a Cache-Control header into a dict of directive -> value, where
+    value is None for directives without one, e.g.
+    'no-cache, max-age=60' -> {'no-cache': None, 'max-age': '60'}
+    """
+    directives = {}
+    for part in (value or '').split(','):
+        part = part.strip()
+        if not part:
+            continue
+        name, sep, arg = part.partition('=')
+        directives[name.strip().lower()] = sep and arg.strip().strip('"') or None
+    return directives
+
+
+def parse_http_date(value):
+    """ Parse an HTTP date into a timestamp, or None if it can't be parsed """
+    if not value:
+        return None
+    # Imported here, as they're slow to import and only needed once a
+    # response has dates in it
+    import calendar
+    import email.utils
+    parsed = email.utils.parsedate_tz(value)
+    if parsed is None:
+        return None
+    return calendar.timegm(parsed[:9]) - (parsed[9] or 0)
+
+
+def freshness_lifetime(headers, now):
+    """
+    How many seconds a response with these headers can be used for without
+    revalidation. None means the response mustn't be cached at all.
+    """
+    cache_control = parse_cache_control(headers.get('cache-control'))
+    if 'no-store' in cache_control or headers.get('vary', '').strip() == '*':
+        return None
+    if 'no-cache' in cache_control:
+        return 0
+    if cache_control.get('max-age') is not None:
+        try:
+            return max(0, int(cache_control['max-age']))
+        except ValueError:
+            return 0
+    expires = headers.get('expires')
+    if expires is not None:
+        expires_at = parse_http_date(expires)
+        if expires_at is None:
+            # An invalid Expires means already expired
+            return 0
+        date = parse_http_date(headers.get('date')) or now
+        return max(0, expires_at - date)
+    return 0
+
+
+class CacheEntry(object):
+    """ A stored response, along with what's needed to revalidate it """
+
+    def __init__(self, url, vary, code, msg, raw_headers, body, fresh_until):
+        self.url = url
+        self.vary = vary
+        self.code = code
+        self.msg = msg
+        self.raw_headers = raw_headers
+        self.body = body
+        self.fresh_until = fresh_until
+
+    @property
+    def headers(self):
+        return httplib.HTTPMessage(StringIO.StringIO(self.raw_headers))
+
+    @property
+    def size(self):
+        return len(self.body) + len(self.raw_headers)
+
+    def is_fresh(self, now):
+        return now < self.fresh_until
+
+    def matches(self, request_headers):
+        """ Whether the request headers named in Vary match this entry's """
+        for header, value in self.vary:
+            if request_headers.get(header) != value:
+                return False
+        return True
+
+    def update(self, headers, now):
+        """ Merge in the headers from a 304, and renew freshness """
+        merged = self.headers
+        for header in headers.keys():
+            merged[header] = headers[header]
+        self.raw_headers = ''.join(merged.headers)
+        lifetime = freshness_lifetime(merged, now)
+        self.fresh_until = now + (lifetime or 0)
+
+
+class CacheStats(object):
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.stores = 0
+        self.evictions = 0
+
+
+class ResponseCache(object):
+    """
+    An LRU cache of responses, held in memory and optionally also on disk.
+    Entries are grouped under (method, url); each may have several
+    variants, distinguished by the request headers named in their Vary
+    header. Memory and disk use are each capped at a number of bytes, and
+    the least recently used URLs are evicted to stay under the caps.
+    """
+
+    def __init__(self, max_bytes=32 * 1024 * 1024, max_entry_bytes=8 * 1024 * 1024,
+                 directory=None, max_disk_bytes=256 * 1024 * 1024):
+        self.enabled = False
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.stats = CacheStats()
+        self._lock = threading.RLock()
+        self._memory = collections.OrderedDict()
+        self._memory_bytes = 0
+        self._disk = collections.OrderedDict()
+        self._disk_bytes = 0
+        self.directory = None
+        if directory is not None:
+            self.set_directory(directory)
+
+    def _key(self, method, url):
+        return '%s %s' % (method, url)
+
+    def _filename(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key).hexdigest())
+
+    def set_directory(self, directory):
+        """ Also keep entries on disk, in `directory` """
+        with self._lock:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            self.directory = directory
+            self._disk.clear()
+            self._disk_bytes = 0
+            # Rebuild the LRU order of whatever's already there, oldest
+            # access first
+            files = []
+            for name in os.listdir(directory):
+                path = os.path.join(directory, name)
+                if len(name) == 40 and os.path.isfile(path):
+                    stat = os.stat(path)
+                    files.append((stat.st_atime, name, stat.st_size))
+            for atime, name, size in sorted(files):
+                self._disk[name] = size
+                self._disk_bytes += size
+            self._evict_disk()
+
+    def lookup(self, method, url, request_headers):
+        """ Return the entry matching the request, or None """
+        key = self._key(method, url)
+        with self._lock:
+            item = self._memory.pop(key, None)
+            if item is not None:
+                self._memory[key] = item
+                variants = item[0]
+            else:
+                variants = self._read_disk(key)
+                if variants is None:
+                    return None
+                self._set(key, variants, write=False)
+            for entry in variants:
+                if entry.matches(request_headers):
+                    return entry
+            return None
+
+    def store(self, method, url, entry):
+        if entry.size > self.max_entry_bytes:
+            return
+        key = self._key(method, url)
+        with self._lock:
+            item = self._memory.get(key)
+            if item is not None:
+                variants = item[0]
+            else:
+                variants = self._read_disk(key) or []
+            variants = [v for v in variants if v.vary != entry.vary]
+            variants.append(entry)
+            self._set(key, variants)
+            self.stats.stores += 1
+
+    def _set(self, key, variants, write=True):
+        # Each memory item is (variants, size), so that the size that was
+        # counted is what's taken off again, even if an entry has changed
+        old = self._memory.pop(key, None)
+        if old is not None:
+            self._memory_bytes -= old[1]
+        size = sum(v.size for v in variants)
+        self._memory[key] = (variants, size)
+        self._memory_bytes += size
+        if write:
+            self._write_disk(key, variants)
+        while self._memory_bytes > self.max_bytes and self._memory:
+            evicted_key, (evicted, evicted_size) = self._memory.popitem(last=False)
+            self._memory_bytes -= evicted_size
+            self.stats.evictions += 1
+
+    def refresh(self, method, url):
+        """ Write back entries that have been updated after revalidation """
+        key = self._key(method, url)
+        with self._lock:
+            item = self._memory.get(key)
+            if item is not None:
+                self._set(key, item[0])
+
+    def _read_disk(self, key):
+        if self.directory is None:
+            return None
+        name = os.path.basename(self._filename(key))
+        if name not in self._disk:
+            return None
+        try:
+            f = open(self._filename(key), 'rb')
+            try:
+                stored_key, variants = cPickle.load(f)
+            finally:
+                f.close()
+        except (IOError, EOFError, cPickle.UnpicklingError):
+            return None
+        if stored_key != key:
+            return None
+        self._disk[name] = self._disk.pop(name)
+        return variants
+
+    def _write_disk(self, key, variants):
+        if self.directory is None:
+            return
+        path = self._filename(key)
+        name = os.path.basename(path)
+        tmp = path + '.tmp'
+        f = open(tmp, 'wb')
+        try:
+            cPickle.dump((key, variants), f, cPickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+        os.rename(tmp, path)
+        self._disk_bytes -= self._disk.pop(name, 0)
+        self._disk[name] = os.path.getsize(path)
+        self._disk_bytes += self._disk[name]
+        self._evict_disk()
+
+    def _evict_disk(self):
+        while self._disk_bytes > self.max_disk_bytes and self._disk:
+            name, size = self._disk.popitem(last=False)
+            self._disk_bytes -= size
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+            self.stats.evictions += 1
+
+    def purge(self):
+        """ Throw away everything in the cache, including on disk """
+        with self._lock:
+            self._memory.clear()
+            self._memory_bytes = 0
+            if self.directory is not None:
+                for name in self._disk:
+                    try:
+                        os.remove(os.path.join(self.directory, name))
+                    except OSError:
+                        pass
+            self._disk.clear()
+            self._disk_bytes = 0
+
+    def usage(self):
+        """ Return (memory bytes, disk bytes) in use """
+        with self._lock:
+            return self._memory_bytes, self._disk_bytes
+
+
+class CachedResponse(pyrrhic.http.BufferedResponse):
+    """ A response served from a `CacheEntry`, with the urllib2 response API """
+
+    from_cache = True
+
+    def __init__(self, entry, timings=None):
+        super(CachedResponse, self).__init__(entry.code, entry.msg,
+            entry.headers, entry.url, entry.body, timings)
+
+
+class CachingResponse(object):
+    """
+    Wraps a response from the network, keeping a copy of the body as it's
+    read. Once the whole body has been read it's stored in the cache. If the
+    body turns out to be too big to cache, the copy is dropped.
+    """
+
+    def __init__(self, response, cache, method, entry):
+        self._response = response
+        self._cache = cache
+        self._method = method
+        self._entry = entry
+        self._chunks = []
+        self._size = 0
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+    def _keep(self, data, eof):
+        if self._chunks is None:
+            return
+        self._chunks.append(data)
+        self._size += len(data)
+        if self._size > self._cache.max_entry_bytes:
+            self._chunks = None
+        elif eof:
+            self._entry.body = ''.join(self._chunks)
+            self._chunks = None
+            self._cache.store(self._method, self._entry.url, self._entry)
+
+    def read(self, amt=-1):
+        data = self._response.read(amt)
+        self._keep(data, amt is None or amt < 0 or not data)
+        return data
+
+    def readline(self, limit=-1):
+        data = self._response.readline(limit)
+        self._keep(data, not data)
+        return data
+
+    def readlines(self, sizehint=0):
+        lines = []
+        while True:
+            line = self.readline()
+            if not line:
+                return lines
+            lines.append(line)
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+
+class CacheHandler(urllib2.BaseHandler):
+    """
+    Serves fresh responses from a `ResponseCache` without touching the
+    network, revalidates stale ones with If-None-Match/If-Modified-Since,
+    and stores cacheable responses as they're read.
+    """
+
+    # Run before HTTPErrorProcessor, so that a 304 can be turned back into
+    # the cached response
+    handler_order = 400
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    def _request_headers(self, req):
+        return dict((k.lower(), v) for k, v in req.header_items())
+
+    def http_request(self, req):
+        req.cache_entry = None
+        if not self.cache.enabled or req.get_method() not in CACHEABLE_METHODS:
+            return req
+        headers = self._request_headers(req)
+        entry = self.cache.lookup(req.get_method(), req.get_full_url(), headers)
+        if entry is None:
+            self.cache.stats.misses += 1
+            return req
+        req.cache_entry = entry
+        request_cache_control = parse_cache_control(headers.get('cache-control'))
+        if entry.is_fresh(time.time()) and 'no-cache' not in request_cache_control:
+            return req
+        entry_headers = entry.headers
+        etag = entry_headers.get('etag')
+        last_modified = entry_headers.get('last-modified')
+        if etag is not None:
+            req.add_unredirected_header('If-None-Match', etag)
+        if last_modified is not None:
+            req.add_unredirected_header('If-Modified-Since', last_modified)
+        if etag is None and last_modified is None:
+            # Stale, and no way to revalidate it
+            req.cache_entry = None
+            self.cache.stats.misses += 1
+        return req
+
+    https_request = http_request
+
+    def default_open(self, req):
+        entry = getattr(req, 'cache_entry', None)
+        if entry is None:
+            return None
+        if req.has_header('If-none-match') or req.has_header('If-modified-since'):
+            # Needs revalidating, so let the request go to the network
+            return None
+        self.cache.stats.hits += 1
+        return CachedResponse(entry)
+
+    def http_response(self, req, response):
+        if isinstance(response, CachedResponse):
+            return response
+        method = req.get_method()
+        if not self.cache.enabled or method not in CACHEABLE_METHODS:
+            return response
+        now = time.time()
+        entry = getattr(req, 'cache_entry', None)
+        headers = response.info()
+        if response.code == 304 and entry is not None:
+            response.read()
+            response.close()
+            entry.update(headers, now)
+            self.cache.refresh(method, entry.url)
+            self.cache.stats.revalidations += 1
+            return CachedResponse(entry, getattr(response, 'timings', None))
+        if response.code not in CACHEABLE_STATUSES:
+            return response
+        lifetime = freshness_lifetime(headers, now)
+        if lifetime is None:
+            return response
+        if not lifetime and not (headers.get('etag') or
+                                 headers.get('last-modified')):
+            # It would be stale straight away, with no way to revalidate
+            return response
+        request_headers = self._request_headers(req)
+        vary = []
+        for header in headers.get('vary', '').split(','):
+            header = header.strip().lower()
+            if header:
+                vary.append((header, request_headers.get(header)))
+        entry = CacheEntry(req.get_full_url(), tuple(sorted(vary)),
+                           response.code, response.msg,
+                           ''.join(headers.headers), '', now + lifetime)
+        return CachingResponse(response, self.cache, method, entry)
+
+    https_response = http_response
@@ -0,0 +1,555 @@
+"""
+Assertions about responses, such as the status, a header, a value in a
+JSON body or text in the body, and extraction of values from them for
+later commands. Checks are fed the body as it arrives, so the body is never
+held in memory, and reading can stop as soon as every check is decided.
+"""
+import json
+import re
+
+# A JSON token, after any whitespace: punctuation, a string (group 2 is
+# its contents) or another scalar
+TOKEN_RE = re.compile(r'\s*(?:([{}\[\],:])|"([^"\\]*(?:\\.[^"\\]*)*)"|'
+                      r'(-?(?:0|[1-9]\d*)(?:\.\d+)?(?:[eE][+-]?\d+)?|'
+                      r'true|false|null))')
+
+# What can start a JSON token that's been split across pieces of the body
+TOKEN_START = '{}[],:"-0123456789tfn'
+
+# What can follow a number that's still being fed in
+NUMBER_CHARS = '0123456789.eE+-'
+
+# Everything up to the next bracket outside a string (group 1)
+SKIP_RE = re.compile(r'[^"{}\[\]]*(?:"[^"\\]*(?:\\.[^"\\]*)*"[^"{}\[\]]*)*'
+                     r'([{}\[\]])')
+
+# Everything up to a string that hasn't ended
+COMPLETE_RE = re.compile(r'(?:[^"]+|"[^"\\]*(?:\\.[^"\\]*)*")*')
+
+# '.key', '[0]' or '["key"]' in a path such as $.items[0].id
+PATH_PART_RE = re.compile(r'\.([^.\[\]]+)|\[(\d+)\]|\["([^"]*)"\]')
+
+
+def parse_path(path):
+    """
+    Parse a JSON path such as '$.items[0].id' into a tuple of keys and
+    indexes. The '$.' can be left off.
+    """
+    if path.startswith('$'):
+        rest = path[1:]
+    else:
+        rest = '.' + path
+    parts = []
+    end = 0
+    for match in PATH_PART_RE.finditer(rest):
+        if match.start() != end:
+            break
+        key, index, quoted = match.groups()
+        if index is not None:
+            parts.append(int(index))
+        else:
+            parts.append(key is not None and key or quoted)
+        end = match.end()
+    if end != len(rest):
+        raise ValueError, 'Invalid JSON path %s' % path
+    return tuple(parts)
+
+
+def _lookup(value, path):
+    # The value at a path in a decoded JSON value, or MISSING
+    for part in path:
+        if isinstance(part, int):
+            if not isinstance(value, list) or part >= len(value):
+                return MISSING
+        else:
+            if not isinstance(value, dict):
+                return MISSING
+            part = part.decode('utf-8')
+            if part not in value:
+                return MISSING
+        value = value[part]
+    return value
+
+
+class JSONPathMatcher(object):
+    """
+    Finds the values at some paths in a JSON document that's fed in pieces.
+    Only the values at the paths are kept. A path is `missing` as soon as
+    the object or array it would be in is finished without it, and once
+    every path is found or missing, the matcher is `done`.
+    """
+
+    def __init__(self, paths):
+        self.found = {}
+        self.missing = set()
+        self.error = None
+        self.done = not paths
+        self._targets = set(paths)
+        # The paths that lead to a target, so that other objects and arrays
+        # can be skipped over without looking at what's in them
+        self._prefixes = set(path[:i] for path in paths
+                             for i in range(len(path)))
+        # How deep we are in an object or array that's being skipped
+        self._skip = 0
+        self._buffer = ''
+        # Whether the buffer ends part way through a string
+        self._in_string = False
+        # For each open object or array, whether it's an object, and
+        # whether a key is expected next
+        self._stack = []
+        # The key or index of each open object or array's current value
+        self._path = []
+        # The path of a value being kept, its depth and its tokens so far
+        self._capture = None
+
+    def _begin(self):
+        # A value starts at the current path. Returns the path.
+        path = tuple(self._path)
+        if self._capture is None and path in self._targets:
+            self._capture = (path, len(self._stack), [])
+        return path
+
+    def _end(self):
+        # A value ends at the current path
+        path = tuple(self._path)
+        depth = len(path)
+        capture = self._capture
+        if capture is not None:
+            if capture[0] != path or capture[1] != len(self._stack):
+                # Inside a value being kept. Targets in it are looked up
+                # in its value once it's over.
+                return
+            self._capture = None
+            value = self.found[path] = json.loads(''.join(capture[2]))
+            for target in self._targets:
+                if len(target) > depth and target[:depth] == path:
+                    nested = _lookup(value, target[depth:])
+                    if nested is not MISSING:
+                        self.found[target] = nested
+        # Nothing more can be found under this value
+        for target in self._targets:
+            if len(target) > depth and target[:depth] == path and \
+                    target not in self.found:
+                self.missing.add(target)
+        if len(self.found) + len(self.missing) == len(self._targets):
+            self.done = True
+
+    def _token(self, punctuation, string, text):
+        stack = self._stack
+        if punctuation is None:
+            if string is not None and stack and stack[-1][1]:
+                # An object's key
+                if self._capture is not None:
+                    self._capture[2].append(text)
+                if '\\' in string:
+                    string = json.loads(text)
+                self._path[-1] = string
+                stack[-1][1] = False
+                return
+            self._begin()
+            if self._capture is not None:
+                self._capture[2].append(text)
+            self._end()
+            return
+        if punctuation in '{[':
+            path = self._begin()
+            if self._capture is None and path not in self._prefixes:
+                self._skip = 1
+                return
+            if self._capture is not None:
+                self._capture[2].append(punctuation)
+            stack.append([punctuation == '{', punctuation == '{'])
+            self._path.append(punctuation == '{' and None or 0)
+            return
+        if self._capture is not None:
+            self._capture[2].append(punctuation)
+        if punctuation in '}]':
+            if not stack:
+                raise ValueError, 'Unbalanced %s' % punctuation
+            stack.pop()
+            self._path.pop()
+            self._end()
+        elif punctuation == ',' and stack:
+            if stack[-1][0]:
+                stack[-1][1] = True
+            else:
+                self._path[-1] += 1
+
+    def feed(self, data):
+        """ Feed the next piece of the document """
+        if self.done:
+            return
+        if self._in_string and '"' not in data:
+            # The string can't have ended, so don't look through it again
+            self._buffer += data
+            return
+        buffer = self._buffer + data
+        match = TOKEN_RE.match
+        pos = 0
+        try:
+            while not self.done:
+                if self._skip:
+                    pos = self._skip_to_bracket(buffer, pos)
+                    if self._skip:
+                        break
+                    continue
+                m = match(buffer, pos)
+                if m is None or (m.group(3) is not None and (
+                        m.end() == len(buffer) or
+                        buffer[m.end()] in NUMBER_CHARS)):
+                    # The rest of a token, or of a number, may be to come
+                    rest = buffer[pos:].lstrip()
+                    if rest and rest[0] not in TOKEN_START:
+                        raise ValueError, 'Unexpected %r' % rest[:20]
+                    self._in_string = rest.startswith('"')
+                    break
+                punctuation, string, other = m.groups()
+                if string is not None:
+                    text = m.group(0).lstrip()
+                else:
+                    text = other
+                self._token(punctuation, string, text)
+                pos = m.end()
+        except ValueError, e:
+            self.error = 'Invalid JSON: %s' % e
+            self.done = True
+        self._buffer = buffer[pos:]
+
+    def _skip_to_bracket(self, buffer, pos):
+        # Skip over an object or array, a bracket at a time, returning the
+        # position reached
+        match = SKIP_RE.match
+        while self._skip:
+            m = match(buffer, pos)
+            if m is None:
+                # No more brackets yet. Keep only a string that hasn't
+                # ended, as it may have brackets in it.
+                pos = COMPLETE_RE.match(buffer, pos).end()
+                self._in_string = pos < len(buffer)
+                return pos
+            pos = m.end()
+            if m.group(1) in '{[':
+                self._skip += 1
+            else:
+                self._skip -= 1
+        self._end()
+        return pos
+
+    def finish(self):
+        """ The document is over: anything not found is missing """
+        if not self.done and self._buffer.strip():
+            # A number at the very end
+            self.feed(' ')
+        if not self.done and (self._stack or self._skip or
+                              self._capture is not None):
+            self.error = 'Invalid JSON: the body ended early'
+        self.missing.update(self._targets - set(self.found))
+        self.done = True
+
+
+def parse_statuses(spec):
+    """
+    Parse a list of expected status codes such as '2xx,3xx,404' into a
+    function that says whether a status code is expected.
+    """
+    patterns = [bit.strip().lower() for bit in spec.split(',') if bit.strip()]
+    for pattern in patterns:
+        if len(pattern) != 3 or not pattern.replace('x', '0').isdigit():
+            raise ValueError, 'Invalid status code pattern %s' % pattern
+
+    def expected(status):
+        status = str(status)
+        for pattern in patterns:
+            if all(p == 'x' or p == c for p, c in zip(pattern, status)):
+                return True
+        return False
+    return expected
+
+
+# What's compared when there's no such header, or JSON value, as None is
+# JSON's null
+MISSING = object()
+
+
+def _text(value):
+    # A JSON value as text: strings as they are, anything else as JSON
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, str):
+        return value
+    return json.dumps(value)
+
+
+def _split(spec, rest):
+    # 'name=value' -> ('name', '=', 'value'), 'name~re' -> ('name', '~',
+    # 're'), 'name' -> ('name', None, None)
+    match = re.match(r'([^=~]*)([=~])(.*)$', rest)
+    if match is None:
+        return rest, None, None
+    if not match.group(1):
+        raise ValueError, 'Invalid check %s' % spec
+    return match.groups()
+
+
+class Check(object):
+    """
+    One assertion about a response. `passed` is None until it's decided,
+    then True or False, with `detail` saying what was wrong.
+    """
+
+    passed = None
+    detail = ''
+    # The JSON path the check needs from the body, if any
+    path = None
+
+    def __init__(self, spec):
+        self.spec = spec
+
+    def start(self, response):
+        """ Decide what can be from the status and headers """
+
+    def feed(self, data):
+        """ Look at the next piece of the body """
+
+    def found(self, matcher):
+        """ Decide what can be from the JSON found so far """
+
+    def finish(self):
+        """ The body is over """
+        if self.passed is None:
+            self.passed = False
+
+    def _compare(self, value, op, expected):
+        # Whether `value` passes, setting `detail`
+        if value is MISSING:
+            self.detail = 'missing'
+            return False
+        if op == '=' and value != expected:
+            self.detail = 'got %s' % _text(value)
+            return False
+        if op == '~' and not expected.search(_text(value)):
+            self.detail = 'got %s' % _text(value)
+            return False
+        return True
+
+
+class StatusCheck(Check):
+    """ status=2xx,404 """
+
+    def __init__(self, spec, statuses):
+        Check.__init__(self, spec)
+        self.expected = parse_statuses(statuses)
+
+    def start(self, response):
+        self.passed = self.expected(response.code)
+        if not self.passed:
+            self.detail = 'got %s' % response.code
+
+
+class HeaderCheck(Check):
+    """ header:NAME (present), header:NAME=VALUE or header:NAME~REGEX """
+
+    def __init__(self, spec, name, op, value):
+        Check.__init__(self, spec)
+        self.name = name
+        self.op = op
+        if op == '~':
+            value = re.compile(value)
+        self.value = value
+
+    def start(self, response):
+        self.passed = self._compare(response.info().get(self.name, MISSING),
+                                    self.op, self.value)
+
+
+class BodyCheck(Check):
+    """
+    body~TEXT: the body contains TEXT. The end of each piece is kept, to
+    find TEXT when it's split between two.
+    """
+
+    def __init__(self, spec, text):
+        Check.__init__(self, spec)
+        self.text = text
+        self._tail = ''
+
+    def feed(self, data):
+        if self.passed is not None:
+            return
+        window = self._tail + data
+        if self.text in window:
+            self.passed = True
+            self._tail = ''
+        else:
+            self._tail = window[len(window) - len(self.text) + 1:]
+
+    def finish(self):
+        if self.passed is None:
+            self.passed = False
+            self.detail = 'not found'
+
+
+class JSONCheck(Check):
+    """ json:PATH (present), json:PATH=JSON or json:PATH~REGEX """
+
+    def __init__(self, spec, path, op, value):
+        Check.__init__(self, spec)
+        self.path = parse_path(path)
+        self.op = op
+        if op == '~':
+            value = re.compile(value)
+        elif op == '=':
+            try:
+                value = json.loads(value)
+            except ValueError:
+                # A bare string, e.g. json:$.name=bob
+                value = value.decode('utf-8')
+        self.value = value
+
+    def found(self, matcher):
+        if self.passed is not None:
+            return
+        if self.path in matcher.found:
+            self.passed = self._compare(matcher.found[self.path], self.op,
+                                        self.value)
+        elif matcher.error is not None:
+            self.passed = False
+            self.detail = matcher.error
+        elif self.path in matcher.missing:
+            self.passed = False
+            self.detail = 'missing'
+
+
+class Extraction(Check):
+    """
+    NAME=json:PATH, NAME=header:NAME or NAME=status: keeps a value from the
+    response as `value`, and passes if there is one.
+    """
+
+    value = None
+
+    def __init__(self, spec, name, source):
+        Check.__init__(self, spec)
+        self.name = name
+        kind, _, rest = source.partition(':')
+        if kind == 'json' and rest:
+            self.path = parse_path(rest)
+        elif kind == 'header' and rest:
+            self.header = rest
+        elif source != 'status':
+            raise ValueError, 'Invalid extraction %s' % spec
+        self.kind = kind
+
+    def _keep(self, value):
+        if value is MISSING:
+            self.passed = False
+            self.detail = 'missing'
+        else:
+            self.value = _text(value)
+            self.passed = True
+
+    def start(self, response):
+        if self.kind == 'status':
+            self._keep(response.code)
+        elif self.kind == 'header':
+            self._keep(response.info().get(self.header, MISSING))
+
+    def found(self, matcher):
+        if self.passed is not None:
+            return
+        if self.path in matcher.found:
+            self._keep(matcher.found[self.path])
+        elif matcher.error is not None:
+            self.passed = False
+            self.detail = matcher.error
+        elif self.path in matcher.missing:
+            self._keep(MISSING)
+
+
+def parse_check(spec):
+    """ Parse an assertion such as 'status=201' or 'json:$.id~^\d+$' """
+    kind, _, rest = spec.partition(':')
+    if spec.startswith('status='):
+        return StatusCheck(spec, spec[len('status='):])
+    if spec.startswith('body~') and len(spec) > len('body~'):
+        return BodyCheck(spec, spec[len('body~'):])
+    if kind == 'header' and rest:
+        return HeaderCheck(spec, *_split(spec, rest))
+    if kind == 'json' and rest:
+        return JSONCheck(spec, *_split(spec, rest))
+    raise ValueError, 'Invalid check %s' % spec
+
+
+def parse_extraction(spec):
+    """ Parse an extraction such as 'id=json:$.id' """
+    name, _, source = spec.partition('=')
+    if not re.match(r'[A-Za-z_]\w*$', name) or not source:
+        raise ValueError, 'Invalid extraction %s' % spec
+    return Extraction(spec, name, source)
+
+
+class Checks(object):
+    """
+    A set of `Check`s on one response. JSON paths are all found in one
+    pass over the body, by a `JSONPathMatcher`.
+    """
+
+    def __init__(self, checks):
+        self.checks = checks
+        paths = set(check.path for check in checks if check.path is not None)
+        self.matcher = paths and JSONPathMatcher(paths) or None
+
+    @property
+    def decided(self):
+        return all(check.passed is not None for check in self.checks)
+
+    @property
+    def passed(self):
+        return all(check.passed for check in self.checks)
+
+    @property
+    def values(self):
+        """ The values extracted, by name """
+        return dict((check.name, check.value) for check in self.checks
+                    if isinstance(check, Extraction) and check.passed)
+
+    def start(self, response):
+        for check in self.checks:
+            check.start(response)
+
+    def feed(self, data):
+        for check in self.checks:
+            check.feed(data)
+        if self.matcher is not None and not self.matcher.done:
+            self.matcher.feed(data)
+            self._found()
+
+    def _found(self):
+        for check in self.checks:
+            check.found(self.matcher)
+
+    def finish(self):
+        if self.matcher is not None:
+            self.matcher.finish()
+            self._found()
+        for check in self.checks:
+            check.finish()
+
+    def run(self, response, chunk_size):
+        """
+        Check a response, reading its body in `chunk_size` pieces until
+        every check is decided, and closing it. Returns the bytes read.
+        """
+        size = 0
+        try:
+            self.start(response)
+            while not self.decided:
+                data = response.read(chunk_size)
+                if not data:
+                    break
+                size += len(data)
+                self.feed(data)
+        finally:
+            response.close()
+        self.finish()
+        return size
@@ -1,10 +1,117 @@
+import fnmatch
+import hashlib
+import itertools
+import os
+import re
+import sys
+import time
 import urlparse
 import pyrrhic
+import pyrrhic.checks
+import pyrrhic.formatting
+import pyrrhic.jobs
+import pyrrhic.streaming
+import pyrrhic.templates
+
+# Console settings, switched on and off by the toggle commands
+settings = {
+    'stream': False,
+    'timing': False,
+    # How bodies are formatted: one of pyrrhic.formatting.STYLES
+    'format': 'auto',
+    # Lines of each body shown from the start and end, or None for all
+    'head': 200,
+    'tail': 20,
+    # Whether adding a resource opens a connection to it straight away
+    'prewarm': False,
+}
+
+# How many resources a REST command sends to at once when fanning out
+FAN_OUT_CONCURRENCY = 10
+
+# Threads for 'bench -r' when -c isn't given
+PACED_CONCURRENCY = 64
+
+# Seconds between requests made by the watch command
+WATCH_INTERVAL = 2.0
+
+# Seconds between updates of the stats command's view
+STATS_INTERVAL = 1.0
+
+# Moves the cursor to the top left of the terminal, and clears it
+CLEAR_SCREEN = '\x1b[H\x1b[J'
+
+# Lines of context shown around changes to a watched body
+WATCH_CONTEXT = 2
+
+# Watched bodies bigger than this are compared by their hash alone, rather
+# than kept to diff the next one against
+WATCH_DIFF_LIMIT = 1024 * 1024
+
+# Headers that change on every response, so aren't compared when watching
+WATCH_IGNORED_HEADERS = ('date', 'age', 'expires')
+
+# Named data payloads, used as '+NAME' in place of ':key=value' data. The
+# console replaces this with the payloads saved in its session.
+payloads = {}
+
+# Named request templates (see pyrrhic.templates), used as '%NAME'. The
+# console replaces this with the templates saved in its session.
+templates = {}
+
+# Values kept from responses with '-x NAME=...', used as $NAME in later
+# commands
+variables = {}
+
+# $NAME, or $$ for a $
+VARIABLE_RE = re.compile(r'\$(\$|[A-Za-z_]\w*)')
 
 class ValidationError(Exception):
     """ There was a problem validating the arguments """
 
 
+def parse_number(args, flag, convert=int, minimum=1):
+    """
+    Split 'FLAG N' off a command's arguments, returning the rest of the
+    arguments and N, or None if the flag wasn't given.
+    """
+    if flag not in args:
+        return args, None
+    i = args.index(flag)
+    try:
+        value = convert(args[i + 1])
+    except (IndexError, ValueError):
+        raise ValidationError, 'Please specify a number for %s' % flag
+    if value < minimum:
+        raise ValidationError, '%s must be at least %s' % (flag, minimum)
+    return args[:i] + args[i + 2:], value
+
+
+def parse_concurrency(args):
+    """
+    Split '-c N' off a command's arguments, returning the rest of the
+    arguments and N, or None if there was no -c.
+    """
+    return parse_number(args, '-c')
+
+
+def expand_variables(args):
+    """
+    Replace $NAME in a command's arguments with the value of the variable,
+    and $$ with $. Raises `ValidationError` for a variable that isn't set.
+    """
+    def replace(match):
+        name = match.group(1)
+        if name == '$':
+            return '$'
+        try:
+            return variables[name]
+        except KeyError:
+            raise ValidationError, 'No such variable $%s' % name
+    return tuple('$' in arg and VARIABLE_RE.sub(replace, arg) or arg
+                 for arg in args)
+
+
 class BaseCommand(object):
     
     def __init__(self, resources):
@@ -24,7 +131,9 @@ class UnknownCommand(BaseCommand):
 
 class ResourceCommand(BaseCommand):
     """
-    This command adds a new resource.
+    This command adds a new resource. Its host is looked up in the
+    background, and with prewarm on, a connection is opened to it, ready
+    for the first request.
     """
     
     def validate(self, *args):
@@ -38,12 +147,15 @@ class ResourceCommand(BaseCommand):
                 raise ValidationError, 'URL must start with http:// or https://'
         
     def run(self, *args):
+        import pyrrhic.resolver
         url = args[0]
         try:
             name = args[1]
         except IndexError:
             name = '__default__'
-        self.resources[name] = pyrrhic.Resource(url)
+        resource = self.resources[name] = pyrrhic.Resource(url)
+        pool = settings['prewarm'] and pyrrhic.get_pool() or None
+        pyrrhic.resolver.prewarm(resource, pyrrhic.get_dns_cache(), pool)
 
         
 class QuitCommand(BaseCommand):
@@ -91,47 +203,962 @@ class AuthCommand(BaseCommand):
         self.resources[name].set_authentication(username, password)
 
 
+class PoolCommand(BaseCommand):
+    """
+    Show open, idle and reused keep-alive connections per host. Use
+    'pool clear' to close all idle connections.
+    """
+
+    def validate(self, *args):
+        if args and args != ('clear',):
+            raise ValidationError, 'Usage: pool [clear]'
+
+    def run(self, *args):
+        pool = pyrrhic.get_pool()
+        if args:
+            pool.clear()
+            return
+        print "host\t\topen\tidle\treused"
+        for key, open_count, idle, opened, reused in pool.stats():
+            scheme, netloc = key
+            print "%s://%s\t\t%d\t%d\t%d" % (scheme, netloc, open_count,
+                                               idle, reused)
+
+
+class JobsCommand(BaseCommand):
+    """
+    List background jobs. Any command can be run in the background by
+    ending it with '&', e.g. 'get news &'. Use 'jobs wait' to wait for
+    them all to finish.
+    """
+
+    def validate(self, *args):
+        if args and args != ('wait',):
+            raise ValidationError, 'Usage: jobs [wait]'
+
+    def run(self, *args):
+        if args:
+            for job in pyrrhic.jobs.manager.running():
+                job.wait()
+            return
+        for job in pyrrhic.jobs.manager.running():
+            print "[%d] running\t%s" % (job.id, job.description)
+
+
+class CacheCommand(BaseCommand):
+    """
+    Show response cache statistics. 'cache on [DIRECTORY]' caches GET
+    responses, in memory and optionally on disk, 'cache off' stops caching
+    and 'cache purge' empties the cache.
+    """
+
+    def validate(self, *args):
+        if not args:
+            return
+        if args[0] not in ('on', 'off', 'purge') or \
+                (len(args) > 1 and args[0] != 'on') or len(args) > 2:
+            raise ValidationError, 'Usage: cache [on [DIRECTORY]|off|purge]'
+
+    def run(self, *args):
+        cache = pyrrhic.get_cache()
+        if not args:
+            stats = cache.stats
+            memory, disk = cache.usage()
+            format_bytes = pyrrhic.streaming.format_bytes
+            print 'cache is %s' % (cache.enabled and 'on' or 'off')
+            print 'hits: %d' % stats.hits
+            print 'misses: %d' % stats.misses
+            print 'revalidations: %d' % stats.revalidations
+            print 'stores: %d' % stats.stores
+            print 'evictions: %d' % stats.evictions
+            print 'memory: %s of %s' % (format_bytes(memory),
+                                        format_bytes(cache.max_bytes))
+            if cache.directory is not None:
+                print 'disk: %s of %s in %s' % (format_bytes(disk),
+                    format_bytes(cache.max_disk_bytes), cache.directory)
+        elif args[0] == 'on':
+            if len(args) > 1:
+                cache.set_directory(args[1])
+            cache.enabled = True
+        elif args[0] == 'off':
+            cache.enabled = False
+        else:
+            cache.purge()
+
+
+class PayloadCommand(BaseCommand):
+    """
+    Name some data, to send later with '+NAME' in place of ':key=value',
+    e.g. 'payload login :user=bob&pass=secret' then 'post +login'.
+    'payload' lists the payloads, 'payload NAME' shows one and
+    'payload -d NAME' deletes it.
+    """
+
+    def validate(self, *args):
+        if len(args) > 2:
+            raise ValidationError, 'Usage: payload [NAME [:DATA]] | -d NAME'
+        if (len(args) == 2 and args[0] == '-d') or len(args) == 1:
+            if not payloads.has_key(args[-1]):
+                raise ValidationError, 'No such payload %s' % args[-1]
+        elif len(args) == 2 and not args[1].startswith(':'):
+            raise ValidationError, 'Payload data must start with a colon'
+
+    def run(self, *args):
+        if not args:
+            for name in sorted(payloads.keys()):
+                print "%s\t\t:%s" % (name, payloads[name])
+        elif len(args) == 1:
+            print ':%s' % payloads[args[0]]
+        elif args[0] == '-d':
+            del payloads[args[1]]
+        else:
+            payloads[args[0]] = args[1][1:]
+
+
+class TemplateCommand(BaseCommand):
+    """
+    Name a request template, to send later with '%NAME' in place of
+    ':key=value', e.g. 'template order orders/{n} :sku={sku}&qty=1
+    -H X-Request-Id:{uuid} -f skus.csv' then 'bench 1000 post %order'.
+    The path, ':DATA' (or '@FILE' for a body read from FILE) and header
+    values can have {n}, {uuid}, {random}, {time}, {time_ms} or, with
+    '-f FILE', the columns of a CSV file, used a row per request.
+    'template' lists the templates, 'template NAME' shows one and
+    'template -d NAME' deletes it.
+    """
+
+    USAGE = 'Usage: template [NAME [PATH] [:DATA|@FILE] [-H NAME:VALUE]... ' \
+        '[-f FILE]] | -d NAME'
+
+    def _parse(self, args):
+        path = ''
+        headers = []
+        body = None
+        form = False
+        data = None
+        args = list(args)
+        while args:
+            arg = args.pop(0)
+            if arg in ('-H', '-f'):
+                if not args:
+                    raise ValidationError, self.USAGE
+                value = args.pop(0)
+                if arg == '-f':
+                    data = os.path.abspath(value)
+                elif ':' not in value:
+                    raise ValidationError, 'Headers must be NAME:VALUE'
+                else:
+                    name, _, value = value.partition(':')
+                    headers.append((name, value.strip()))
+            elif arg.startswith((':', '@')) and body is None:
+                form = arg.startswith(':')
+                if form:
+                    body = arg[1:]
+                else:
+                    try:
+                        with open(arg[1:], 'rb') as f:
+                            body = f.read()
+                    except IOError, e:
+                        raise ValidationError, 'Can\'t read %s: %s' % (
+                            arg[1:], e.strerror)
+            elif not path:
+                path = arg
+            else:
+                raise ValidationError, self.USAGE
+        try:
+            template = pyrrhic.templates.Template(path, headers, body, form,
+                                                  data)
+            if data is not None:
+                template.load()
+        except IOError, e:
+            raise ValidationError, 'Can\'t read %s: %s' % (data, e.strerror)
+        except ValueError, e:
+            raise ValidationError, str(e)
+        return template
+
+    def validate(self, *args):
+        if (len(args) == 2 and args[0] == '-d') or len(args) == 1:
+            if not templates.has_key(args[-1]):
+                raise ValidationError, 'No such template %s' % args[-1]
+        elif args:
+            self._parse(args[1:])
+
+    def run(self, *args):
+        if not args:
+            for name in sorted(templates.keys()):
+                print "%s\t\t%s" % (name, templates[name])
+        elif len(args) == 1:
+            print templates[args[0]]
+        elif args[0] == '-d':
+            del templates[args[1]]
+        else:
+            templates[args[0]] = self._parse(args[1:])
+
+
+class VarCommand(BaseCommand):
+    """
+    Set a variable, used as $NAME in later commands, e.g. 'var id 42' then
+    'get items/$id'. REST commands set them with '-x NAME=...' too. 'var'
+    lists the variables, 'var NAME' shows one and 'var -d NAME' deletes it.
+    """
+
+    def validate(self, *args):
+        if len(args) > 2:
+            raise ValidationError, 'Usage: var [NAME [VALUE]] | -d NAME'
+        if (len(args) == 2 and args[0] == '-d') or len(args) == 1:
+            if not variables.has_key(args[-1]):
+                raise ValidationError, 'No such variable %s' % args[-1]
+        elif args and not re.match(r'[A-Za-z_]\w*$', args[0]):
+            raise ValidationError, 'Invalid variable name %s' % args[0]
+
+    def run(self, *args):
+        if not args:
+            for name in sorted(variables.keys()):
+                print "%s\t\t%s" % (name, variables[name])
+        elif len(args) == 1:
+            print variables[args[0]]
+        elif args[0] == '-d':
+            del variables[args[1]]
+        else:
+            variables[args[0]] = args[1]
+
+
+class ToggleCommand(BaseCommand):
+    """ Base class for commands that switch a setting on or off """
+
+    setting = None
+
+    def validate(self, *args):
+        if args not in ((), ('on',), ('off',)):
+            raise ValidationError, 'Please specify on or off'
+
+    def run(self, *args):
+        if args:
+            settings[self.setting] = args[0] == 'on'
+        else:
+            print '%s is %s' % (self.setting,
+                                settings[self.setting] and 'on' or 'off')
+
+
+class StreamCommand(ToggleCommand):
+    """
+    Switch streaming of response bodies on or off. When streaming, bodies
+    are printed as they arrive rather than once they've been read in full.
+    """
+    setting = 'stream'
+
+
+class TimingCommand(ToggleCommand):
+    """
+    Switch the per-request timing breakdown (DNS, connect, TLS, time to
+    first byte and transfer) on or off. Compressed responses also show
+    how many bytes compression saved.
+    """
+    setting = 'timing'
+
+
+class PrewarmCommand(ToggleCommand):
+    """
+    Switch pre-warming on or off. With it on, adding a resource with 'r'
+    opens a connection to it in the background, including any TLS
+    handshake, so the first request doesn't have to wait for one.
+    """
+    setting = 'prewarm'
+
+
+class DnsCommand(BaseCommand):
+    """
+    Show the cached DNS lookups, with their addresses, how many seconds
+    they have left and how often they've been used. 'dns flush [HOST]'
+    drops them, or just those for HOST, and 'dns ttl SECONDS' sets how
+    long lookups are kept (0 stops caching).
+    """
+
+    USAGE = 'Usage: dns [flush [HOST] | ttl SECONDS]'
+
+    def validate(self, *args):
+        if not args:
+            return
+        if args[0] == 'flush':
+            if len(args) > 2:
+                raise ValidationError, self.USAGE
+        elif args[0] == 'ttl':
+            if len(args) != 2:
+                raise ValidationError, self.USAGE
+            parse_number(args, 'ttl', float, 0)
+        else:
+            raise ValidationError, self.USAGE
+
+    def run(self, *args):
+        dns_cache = pyrrhic.get_dns_cache()
+        if not args:
+            print '%-30s  %5s  %6s  %5s  %s' % ('host', 'port', 'ttl',
+                                               'hits', 'addresses')
+            for host, port, addresses, ttl, hits in dns_cache.entries():
+                print '%-30s  %5s  %5.0fs  %5d  %s' % (host, port, ttl, hits,
+                                                       ', '.join(addresses))
+        elif args[0] == 'flush':
+            count = dns_cache.flush(len(args) == 2 and args[1] or None)
+            print 'Flushed %d lookups' % count
+        else:
+            args, dns_cache.ttl = parse_number(args, 'ttl', float, 0)
+            if not dns_cache.ttl:
+                dns_cache.flush()
+
+
+class FormatCommand(BaseCommand):
+    """
+    Choose how response bodies are shown. 'format auto', the default,
+    pretty-prints JSON and XML, shows binary bodies as a hex dump and
+    anything else as it is, going by the Content-Type. 'format json',
+    'xml', 'hex' or 'plain' uses one format for every response.
+    """
+
+    def validate(self, *args):
+        if len(args) > 1 or (args and args[0] not in pyrrhic.formatting.STYLES):
+            raise ValidationError, 'Usage: format [%s]' % \
+                '|'.join(pyrrhic.formatting.STYLES)
+
+    def run(self, *args):
+        if args:
+            settings['format'] = args[0]
+        else:
+            print 'format is %s' % settings['format']
+
+
+class LinesCommand(BaseCommand):
+    """
+    Limit how much of each response body is shown: 'lines 50 10' shows the
+    first 50 lines and the last 10, with a note of how many were left out
+    in between. 'lines off' shows bodies in full. Use '> FILE' to save a
+    whole body instead.
+    """
+
+    def validate(self, *args):
+        if args == ('off',):
+            return
+        if not args or len(args) > 2 or not all(arg.isdigit() for arg in args):
+            raise ValidationError, 'Usage: lines HEAD [TAIL] | off'
+
+    def run(self, *args):
+        if args == ('off',):
+            settings['head'] = None
+            settings['tail'] = 0
+        else:
+            settings['head'] = int(args[0])
+            settings['tail'] = len(args) > 1 and int(args[1]) or 0
+
+
+class Http2Command(BaseCommand):
+    """
+    Switch HTTP/2 on or off for a resource, e.g. 'http2 on news'. Requests
+    to the same host then share one connection. With timing on, each
+    response shows the protocol it came over, as servers that don't
+    support HTTP/2 over https:// are sent HTTP/1.1 instead. 'http2' alone
+    lists the open HTTP/2 connections.
+    """
+
+    def validate(self, *args):
+        import pyrrhic.http2
+        if not args:
+            return
+        if args[0] not in ('on', 'off') or len(args) > 2:
+            raise ValidationError, 'Usage: http2 [on|off [NAME]]'
+        if args[0] == 'on' and not pyrrhic.http2.available():
+            raise ValidationError, 'HTTP/2 needs the h2 package: pip install h2'
+        name = len(args) == 2 and args[1] or '__default__'
+        if not self.resources.has_key(name):
+            raise ValidationError, 'No such resource %s' % name
+
+    def run(self, *args):
+        if not args:
+            print "host\t\tstreams"
+            for secure, host, streams in pyrrhic.get_http2_handler().stats():
+                print "%s://%s\t\t%d" % (secure and 'https' or 'http', host,
+                                         streams)
+            return
+        name = len(args) == 2 and args[1] or '__default__'
+        self.resources[name].http2 = args[0] == 'on'
+
+
+class LimitCommand(BaseCommand):
+    """
+    Limit the rate of requests to a resource or a host, e.g. 'limit news
+    10' for 10 requests a second, or 'limit api.example.com 600/m 20' for
+    600 a minute in bursts of up to 20. Requests wait until they're within
+    every limit that applies. A host's limit is for all of its ports.
+    'limit NAME off' removes a limit, 'limit off' removes them all, and
+    'limit' alone shows the limits, how much they've held requests back,
+    and how often hosts have asked us to slow down.
+    """
+
+    USAGE = 'Usage: limit [NAME|HOST (RATE [BURST]|off)] or limit off'
+
+    def _parse(self, args):
+        import pyrrhic.throttling
+        if args == ('off',) or not args:
+            return None, None, 1
+        if len(args) not in (2, 3):
+            raise ValidationError, self.USAGE
+        target = args[0]
+        if args[1] == 'off':
+            if len(args) > 2:
+                raise ValidationError, self.USAGE
+            return target, None, 1
+        try:
+            rate = pyrrhic.throttling.parse_rate(args[1])
+        except ValueError, e:
+            raise ValidationError, str(e)
+        burst = 1
+        if len(args) == 3:
+            try:
+                burst = int(args[2])
+            except ValueError:
+                raise ValidationError, 'Please specify a number for BURST'
+            if burst < 1:
+                raise ValidationError, 'BURST must be at least 1'
+        return target, rate, burst
+
+    def validate(self, *args):
+        self._parse(args)
+
+    def run(self, *args):
+        import pyrrhic.throttling
+        if not args:
+            self._show()
+            return
+        target, rate, burst = self._parse(args)
+        if target is None:
+            pyrrhic.get_throttle().clear()
+            for name in self.resources.keys():
+                self.resources[name].rate_limit = None
+        elif self.resources.has_key(target):
+            self.resources[target].rate_limit = rate and \
+                pyrrhic.throttling.TokenBucket(rate, burst)
+        elif rate:
+            pyrrhic.get_throttle().set_limit(target, rate, burst)
+        else:
+            pyrrhic.get_throttle().remove_limit(target)
+
+    def _show(self):
+        limits = [('%s (resource)' % name, self.resources[name].rate_limit)
+                  for name in sorted(self.resources.keys())
+                  if self.resources[name].rate_limit is not None]
+        limits += sorted(pyrrhic.get_throttle().limits.items())
+        print '%-24s  %-20s  %8s  %9s  %8s' % ('limit', 'rate', 'requests',
+                                               'throttled', 'waited')
+        for name, bucket in limits:
+            print '%-24s  %-20s  %8d  %9d  %7.2fs' % (name, bucket,
+                bucket.requests, bucket.throttled, bucket.waited)
+        for host, stats in sorted(pyrrhic.get_throttle().stats.items()):
+            print '%s asked us to slow down %d times: %d retries, ' \
+                  '%.2fs waited' % (host, stats.slow_downs, stats.retries,
+                                    stats.waited)
+
+
+class StatsCommand(BaseCommand):
+    """
+    Show a live view of every request made so far: the rate and error rate
+    over the last few seconds, then for each resource and class of status,
+    how many requests there were, the latency percentiles and the mean
+    response size. 'stats [-n SECONDS] [-t TIMES]' updates it every
+    SECONDS (default 1) until Ctrl-C, or TIMES updates. 'stats clear'
+    starts counting again.
+    """
+
+    def _parse(self, args):
+        args, interval = parse_number(args, '-n', float, 0.1)
+        args, times = parse_number(args, '-t')
+        return args, interval or STATS_INTERVAL, times
+
+    def validate(self, *args):
+        args, interval, times = self._parse(args)
+        if args not in ((), ('clear',)):
+            raise ValidationError, \
+                'Usage: stats [-n SECONDS] [-t TIMES] or stats clear'
+
+    def run(self, *args):
+        args, interval, times = self._parse(args)
+        if args:
+            pyrrhic.get_request_stats().clear()
+            return
+        # Show resources by name, rather than URL
+        names = dict((self.resources[name].stats_label, name)
+                     for name in self.resources.keys())
+        live = hasattr(sys.stdout, 'isatty') and sys.stdout.isatty()
+        count = 0
+        try:
+            while times is None or count < times:
+                if count:
+                    time.sleep(interval)
+                    if not live:
+                        print
+                count += 1
+                if live:
+                    sys.stdout.write(CLEAR_SCREEN)
+                for line in pyrrhic.get_request_stats().report(names):
+                    print line
+                sys.stdout.flush()
+        except KeyboardInterrupt:
+            print
+
+
+class BatchCommand(BaseCommand):
+    """
+    GET many paths under a resource, reusing keep-alive connections:
+    'batch [NAME] PATH [PATH...] [-c N]'. Paths are relative to the
+    resource, e.g. 'items/1' or '?page=2', and '@FILE' reads them from a
+    file, one per line. -c spreads the requests over N connections.
+    """
+
+    def validate(self, *args):
+        args, connections = parse_concurrency(args)
+        name, paths = self._parse_name(args)
+        if not self.resources.has_key(name):
+            raise ValidationError, 'Specified resource not found'
+        if not paths:
+            raise ValidationError, 'Please specify one or more paths'
+        for path in paths:
+            if path.startswith('@') and not os.path.isfile(path[1:]):
+                raise ValidationError, 'No such file %s' % path[1:]
+
+    def run(self, *args):
+        import socket
+        import urllib2
+        args, connections = parse_concurrency(args)
+        connections = connections or 1
+        name, paths = self._parse_name(args)
+        paths = list(self._expand(paths))
+        responses = self.resources[name].batch(paths,
+                                               connections=connections)
+        print '%-8s  %10s  %10s  %s' % ('status', 'time', 'size', 'path')
+        start = time.time()
+        count = 0
+        try:
+            for path, response in itertools.izip(paths, responses):
+                count += 1
+                print '%-8s  %8.1fms  %10s  %s' % (response.code,
+                    response.timings.total * 1000,
+                    pyrrhic.streaming.format_bytes(len(response.read())),
+                    path)
+        except (urllib2.URLError, socket.error), e:
+            print 'Stopped after %d of %d: %s' % (count, len(paths), e)
+        elapsed = time.time() - start
+        print '%d requests over %d connection(s) in %.2fs (%.1f req/s)' % (
+            count, connections, elapsed, elapsed and count / elapsed or 0)
+
+    def _parse_name(self, args):
+        # The first argument is a resource name if there's a resource by
+        # that name and paths follow it; otherwise it's the first path.
+        if len(args) > 1 and self.resources.has_key(args[0]):
+            return args[0], args[1:]
+        return '__default__', args
+
+    def _expand(self, paths):
+        for path in paths:
+            if not path.startswith('@'):
+                yield path
+                continue
+            f = open(path[1:])
+            try:
+                for line in f:
+                    line = line.strip()
+                    if line:
+                        yield line
+            finally:
+                f.close()
+
+
+class RecordCommand(BaseCommand):
+    """
+    Record every request and response, with headers, bodies and timings:
+    'record on FILE' starts recording, adding to FILE if it's already a
+    recording, and 'record off' stops. Bodies are kept in FILE.bodies.
+    'record' shows what's being recorded. See also replay.
+    """
+
+    def validate(self, *args):
+        import pyrrhic.recording
+        if args and not (args == ('off',) or
+                         (len(args) == 2 and args[0] == 'on')):
+            raise ValidationError, 'Usage: record [on FILE|off]'
+        if args and args[0] == 'on' and os.path.exists(args[1]):
+            try:
+                pyrrhic.recording.RecordingLog(args[1])
+            except (IOError, ValueError), e:
+                raise ValidationError, str(e)
+
+    def run(self, *args):
+        recorder = pyrrhic.get_recorder()
+        if not args:
+            recording = recorder.recording
+            if recording is None:
+                print 'recording is off'
+            else:
+                print 'recording to %s (%d requests)' % (recording.path,
+                                                         recording.count)
+        elif args[0] == 'on':
+            recorder.start(args[1])
+        else:
+            recorder.stop()
+
+
+class ReplayCommand(BaseCommand):
+    """
+    Send the requests in a recording again: 'replay FILE [NAME] [-c N]
+    [-p]'. With a resource NAME, they go to its host instead, with its
+    headers. Requests are sent one at a time, or -c N at once, as fast as
+    possible; -p keeps to the pace they were recorded at.
+    """
+
+    def _parse(self, args):
+        paced = '-p' in args
+        args = tuple(arg for arg in args if arg != '-p')
+        args, concurrency = parse_concurrency(args)
+        if not args or len(args) > 2:
+            raise ValidationError, 'Usage: replay FILE [NAME] [-c N] [-p]'
+        name = len(args) == 2 and args[1] or None
+        return args[0], name, concurrency or 1, paced
+
+    def validate(self, *args):
+        import pyrrhic.recording
+        path, name, concurrency, paced = self._parse(args)
+        try:
+            pyrrhic.recording.RecordingLog(path)
+        except (IOError, ValueError), e:
+            raise ValidationError, str(e)
+        if name is not None and not self.resources.has_key(name):
+            raise ValidationError, 'No such resource %s' % name
+
+    def run(self, *args):
+        import pyrrhic.recording
+        path, name, concurrency, paced = self._parse(args)
+        base = name is not None and self.resources[name] or None
+        log = pyrrhic.recording.RecordingLog(path)
+        try:
+            result = pyrrhic.recording.replay(log, pyrrhic.get_opener(),
+                                              base, concurrency, paced)
+        finally:
+            log.close()
+        for line in result.report():
+            print line
+
+
 class RestCommand(BaseCommand):            
     """ Base class for the REST commands, which all have similar 
         semantics
     """
     
     method = None
+
+    # The last response, once run() has printed it
+    response = None
+
+    # The `pyrrhic.checks.Checks` made on the last response, if any
+    checks = None
     
     def validate(self, *args):
-        name, kwargs = self._parse_resource_data(*args)
-        if not self.resources.has_key(name):
-            raise ValidationError, 'Specified resource not found'
+        args, checks = self._parse_checks(*args)
+        args, filename = self._parse_redirect(*args)
+        args, concurrency = self._parse_concurrency(*args)
+        name, data = self._parse_resource_data(*args)
+        if isinstance(data, pyrrhic.templates.Template):
+            has_data = data.body is not None
+        else:
+            has_data = bool(data)
+        if has_data and not pyrrhic.HTTP_VERBS[self.method.upper()]:
+            raise ValidationError, 'Only put and post can send data'
+        names = self._fan_out_names(name)
+        if isinstance(data, pyrrhic.streaming.FileSource):
+            if data.path == '-':
+                if names is not None:
+                    raise ValidationError, 'stdin can only be sent to one resource'
+            elif not os.path.isfile(data.path):
+                raise ValidationError, 'No such file %s' % data.path
+        if names is None:
+            if concurrency is not None:
+                raise ValidationError, '-c only applies to more than one resource'
+            if not self.resources.has_key(name):
+                raise ValidationError, 'Specified resource not found'
+        elif not names:
+            raise ValidationError, 'No resources match %s' % name
+        elif filename is not None:
+            raise ValidationError, 'Only one resource can be sent to a file'
+        elif checks is not None:
+            raise ValidationError, 'Only one resource can be checked'
+        if checks is not None and filename is not None:
+            raise ValidationError, 'Checked bodies can\'t be sent to a file'
 
-    def run(self, *args):
+    def send(self, *args, **kw):
+        """
+        Make the request, returning the response unread. A `progress`
+        keyword tracks the upload of a body from a file.
+        """
+        args, checks = self._parse_checks(*args)
+        args, filename = self._parse_redirect(*args)
+        name, data = self._parse_resource_data(*args)
+        return self._send_to(self.resources[name], data, kw.get('progress'))
+
+    def sender(self, *args):
+        """
+        Return a function that makes the request, returning the response
+        unread, like send(), but with the arguments only parsed once, e.g.
+        for benchmarks
+        """
+        args, checks = self._parse_checks(*args)
+        args, filename = self._parse_redirect(*args)
         name, data = self._parse_resource_data(*args)
+        resource = self.resources[name]
+        return lambda: self._send_to(resource, data)
+
+    def template(self, *args):
+        """ The template these arguments send, or None """
+        args, checks = self._parse_checks(*args)
+        args, filename = self._parse_redirect(*args)
+        args, concurrency = self._parse_concurrency(*args)
+        name, data = self._parse_resource_data(*args)
+        if isinstance(data, pyrrhic.templates.Template):
+            return data
+        return None
+
+    def _send_to(self, resource, data, progress=None):
+        if isinstance(data, pyrrhic.templates.Template):
+            return resource.send_template(self.method.upper(), data)
         kw = {}
+        if isinstance(data, pyrrhic.streaming.FileSource):
+            data = data.open(progress)
         if data:
             kw['data'] = data
-        response = getattr(self.resources[name], self.method)(**kw)
+        return getattr(resource, self.method)(**kw)
+
+    def run(self, *args):
+        args, checks = self._parse_checks(*args)
+        self.checks = checks
+        args, filename = self._parse_redirect(*args)
+        args, concurrency = self._parse_concurrency(*args)
+        name, data = self._parse_resource_data(*args)
+        names = self._fan_out_names(name)
+        if names is not None:
+            self.response = None
+            self._fan_out(names, data, concurrency or FAN_OUT_CONCURRENCY)
+            return
+        start = time.time()
+        progress = None
+        if isinstance(data, pyrrhic.streaming.FileSource):
+            progress = pyrrhic.streaming.UploadProgress(start, sys.stdout)
+        response = self.response = self.send(*args, progress=progress)
+        first_byte = time.time()
         status = response.code
         reason = response.msg
         headers = dict(response.info())
-        data = response.read()
+        if checks is None and filename is None and not settings['stream']:
+            data = response.read()
         if status or reason:
             print '%s %s' % (status, reason)
         for header, value in headers.items():
             print "%s: %s" % (header, value)
-        print data
+        if checks is not None:
+            self._check(response, checks)
+            self._print_timing(response)
+        elif filename is not None:
+            self._stream_to_file(response, filename, start, first_byte)
+            self._print_timing(response)
+        elif settings['stream']:
+            self._stream(response, headers, start, first_byte)
+            self._print_timing(response)
+        else:
+            self._print_timing(response)
+            body = self._body_writer(headers)
+            for i in range(0, len(data), pyrrhic.streaming.CHUNK_SIZE):
+                body.write(data[i:i + pyrrhic.streaming.CHUNK_SIZE])
+            body.close()
+            print
+
+    def _print_timing(self, response):
+        if not settings['timing']:
+            return
+        protocol = getattr(response, 'protocol', None)
+        if isinstance(protocol, str):
+            print 'protocol: %s' % protocol
+        timings = getattr(response, 'timings', None)
+        if timings is not None:
+            print 'timing: %s' % timings
+        compression = getattr(response, 'compression', None)
+        if compression is not None:
+            print 'compression: %s' % compression
+
+    def _body_writer(self, headers):
+        # Formats the body for the terminal, as it's written
+        content_type = None
+        for header, value in headers.items():
+            if header.lower() == 'content-type':
+                content_type = value
+        return pyrrhic.formatting.BodyWriter(sys.stdout, content_type,
+            settings['format'], settings['head'], settings['tail'])
+
+    def _stream(self, response, headers, start, first_byte):
+        progress = pyrrhic.streaming.Progress(start, first_byte)
+        body = self._body_writer(headers)
+        pyrrhic.streaming.copy(response, body, progress)
+        body.close()
+        print
+        print progress.readout()
+
+    def _stream_to_file(self, response, filename, start, first_byte):
+        progress = pyrrhic.streaming.Progress(start, first_byte, sys.stdout)
+        out = open(filename, 'wb')
+        try:
+            pyrrhic.streaming.copy(response, out, progress)
+        finally:
+            out.close()
+            response.close()
+        progress.finish()
+
+    def _check(self, response, checks):
+        # The body isn't shown, and is only read until every check is
+        # decided
+        checks.run(response, pyrrhic.streaming.CHUNK_SIZE)
+        for check in checks.checks:
+            if not check.passed:
+                print 'FAILED  %s (%s)' % (check.spec, check.detail)
+            elif isinstance(check, pyrrhic.checks.Extraction):
+                print '$%s = %s' % (check.name, check.value)
+            else:
+                print 'ok      %s' % check.spec
+        variables.update(checks.values)
+
+    def is_fan_out(self, *args):
+        """ Whether these arguments send the request to several resources """
+        args, checks = self._parse_checks(*args)
+        args, filename = self._parse_redirect(*args)
+        args, concurrency = self._parse_concurrency(*args)
+        name, data = self._parse_resource_data(*args)
+        return self._fan_out_names(name) is not None
+
+    def _fan_out_names(self, name):
+        # '@all', or a name containing shell-style wildcards, sends the
+        # request to every matching resource. Returns None for a plain name.
+        if name == '@all':
+            return sorted(self.resources.keys())
+        if any(c in name for c in '*?['):
+            return fnmatch.filter(sorted(self.resources.keys()), name)
+        return None
+
+    def _fan_out(self, names, data, concurrency):
+        import httplib
+        import socket
+        import urllib2
+        import pyrrhic.bench
+
+        def send(name):
+            start = time.time()
+            try:
+                response = self._send_to(self.resources[name], data)
+                size = pyrrhic.bench.drain(response)
+            except (urllib2.URLError, socket.error,
+                    httplib.HTTPException), e:
+                return name, e.__class__.__name__, time.time() - start, None
+            return name, response.code, time.time() - start, size
+
+        results = pyrrhic.jobs.parallel_map(send, names, concurrency)
+        width = max(len('resource'), max(len(name) for name in names))
+        print '%-*s  %-8s  %10s  %10s' % (width, 'resource', 'status',
+                                          'time', 'size')
+        for name, status, elapsed, size in results:
+            if size is None:
+                size = '-'
+            else:
+                size = pyrrhic.streaming.format_bytes(size)
+            print '%-*s  %-8s  %8.1fms  %10s' % (width, name, status,
+                                                 elapsed * 1000, size)
+
+    def _parse_concurrency(self, *args):
+        # Split off '-c N', which limits how many resources are sent to
+        # at once when fanning out.
+        return parse_concurrency(args)
+
+    def _parse_checks(self, *args):
+        # Split off '-a CHECK' assertions and '-x NAME=SOURCE' extractions,
+        # returning the rest of the arguments and a pyrrhic.checks.Checks,
+        # or None if there weren't any.
+        rest = []
+        checks = []
+        args = list(args)
+        while args:
+            arg = args.pop(0)
+            if arg not in ('-a', '-x'):
+                rest.append(arg)
+                continue
+            if not args:
+                raise ValidationError, 'Please specify a check after %s' % arg
+            try:
+                if arg == '-a':
+                    checks.append(pyrrhic.checks.parse_check(args.pop(0)))
+                else:
+                    checks.append(pyrrhic.checks.parse_extraction(args.pop(0)))
+            except (ValueError, re.error), e:
+                raise ValidationError, str(e)
+        return tuple(rest), checks and pyrrhic.checks.Checks(checks) or None
+
+    def _parse_redirect(self, *args):
+        # Split off a trailing '> filename' (or '>filename'), which sends
+        # the body to a file rather than the terminal.
+        for i, arg in enumerate(args):
+            if arg.startswith('>'):
+                rest = [x for x in (arg[1:],) + args[i + 1:] if x]
+                if len(rest) != 1:
+                    raise ValidationError, 'Please specify one file name after >'
+                return args[:i], rest[0]
+        return args, None
 
     def _parse_resource_data(self, *args):
         # Parse out a resource name and/or data. If the first
         # element starts with a colon, then it's data. Otherwise,
         # it'll be the name of the resource, and the rest will be data.
+        # The data can also come first, followed by the name. '+NAME' is
+        # data too: the named payload, as is '%NAME', the named template.
+        # '@FILE' sends the contents of FILE, or stdin for '@-' ('@all' is
+        # still every resource).
         name = '__default__'
         args = list(args)
         kw = {}
         if args:
-            if not args[0].startswith(':'):
+            if not args[0].startswith((':', '+', '@', '%')) or \
+                    args[0] == '@all':
                 name = args.pop(0)
+            elif len(args) > 1:
+                name = args.pop(1)
             if args:
-                kw = urlparse.parse_qs(args[0][1:])
+                if args[0].startswith('@'):
+                    return name, pyrrhic.streaming.FileSource(args[0][1:])
+                if args[0].startswith('%'):
+                    return name, self._template(args[0][1:])
+                kw = urlparse.parse_qs(self._data(args[0]))
         return name, kw
+
+    def _template(self, name):
+        try:
+            template = templates[name]
+        except KeyError:
+            raise ValidationError, 'No such template %s' % name
+        # Read its data file now, e.g. for a template from the session,
+        # rather than failing part way through sending
+        try:
+            template.load()
+        except IOError, e:
+            raise ValidationError, 'Can\'t read %s: %s' % (template.data,
+                                                           e.strerror)
+        except ValueError, e:
+            raise ValidationError, str(e)
+        return template
+
+    def _data(self, arg):
+        if not arg.startswith('+'):
+            return arg[1:]
+        try:
+            return payloads[arg[1:]]
+        except KeyError:
+            raise ValidationError, 'No such payload %s' % arg[1:]
         
 
 class GetCommand(RestCommand):
@@ -169,5 +1196,256 @@ class OptionsCommand(RestCommand):
     method = 'options'
 
 
-        
-            
\ No newline at end of file
+class Snapshot(object):
+    """
+    One response to a watched resource: its status, headers and a hash of
+    its body, so that unchanged bodies can be spotted cheaply. The body is
+    only kept, to diff the next change against, if it's no bigger than
+    WATCH_DIFF_LIMIT.
+    """
+
+    def __init__(self, response):
+        self.status = '%s %s' % (response.code, response.msg)
+        self.headers = dict((name.lower(), value)
+                            for name, value in response.info().items()
+                            if name.lower() not in WATCH_IGNORED_HEADERS)
+        self.digest = None
+        self.size = 0
+        self.body = None
+
+    def read(self, response, echo=None):
+        """
+        Read and hash the response's body, passing each chunk to `echo`, if
+        given, as it comes. Returns the snapshot.
+        """
+        digest = hashlib.sha1()
+        chunks = []
+        try:
+            while True:
+                data = response.read(pyrrhic.streaming.CHUNK_SIZE)
+                if not data:
+                    break
+                digest.update(data)
+                self.size += len(data)
+                if echo is not None:
+                    echo(data)
+                if chunks is not None:
+                    chunks.append(data)
+                    if self.size > WATCH_DIFF_LIMIT:
+                        chunks = None
+        finally:
+            response.close()
+        self.digest = digest.digest()
+        if chunks is not None:
+            self.body = ''.join(chunks)
+        return self
+
+    def same_as(self, other):
+        return self.digest == other.digest and \
+            self.status == other.status and self.headers == other.headers
+
+    def diff(self, previous):
+        """ Yield the lines that show what changed since `previous` """
+        if self.status != previous.status:
+            yield '- %s' % previous.status
+            yield '+ %s' % self.status
+        for name in sorted(set(self.headers) | set(previous.headers)):
+            old = previous.headers.get(name)
+            new = self.headers.get(name)
+            if old != new:
+                if old is not None:
+                    yield '- %s: %s' % (name, old)
+                if new is not None:
+                    yield '+ %s: %s' % (name, new)
+        if self.digest != previous.digest:
+            if self.body is None or previous.body is None:
+                # Too big to diff
+                for sign, snapshot in (('-', previous), ('+', self)):
+                    yield '%s body: %d bytes, sha1 %s' % (sign, snapshot.size,
+                        snapshot.digest.encode('hex'))
+                return
+            import difflib
+            lines = difflib.unified_diff(previous.body.splitlines(),
+                                         self.body.splitlines(),
+                                         n=WATCH_CONTEXT, lineterm='')
+            # Skip the ---/+++ file names
+            for line in itertools.islice(lines, 2, None):
+                yield line
+
+
+class WatchCommand(RestCommand):
+    """
+    GET a resource every few seconds, and print only what has changed:
+    the status, headers and a diff of the body. 'watch [NAME] [-n SECONDS]
+    [-t TIMES]'; -n sets the interval (default 2s) and -t stops after that
+    many requests. Press Ctrl-C to stop watching.
+    """
+    method = 'get'
+
+    def _parse_watch(self, *args):
+        args, interval = parse_number(args, '-n', float, 0.1)
+        args, times = parse_number(args, '-t')
+        return args, interval or WATCH_INTERVAL, times
+
+    def validate(self, *args):
+        args, interval, times = self._parse_watch(*args)
+        super(WatchCommand, self).validate(*args)
+        if self.is_fan_out(*args):
+            raise ValidationError, 'Only one resource can be watched at a time'
+        if self._parse_redirect(*args)[1] is not None:
+            raise ValidationError, 'watch output cannot be sent to a file'
+
+    def run(self, *args):
+        import socket
+        import urllib2
+        args, interval, times = self._parse_watch(*args)
+        previous = None
+        count = changes = 0
+        try:
+            while times is None or count < times:
+                if count:
+                    time.sleep(interval)
+                count += 1
+                try:
+                    response = self.send(*args)
+                    snapshot = Snapshot(response)
+                    if previous is None:
+                        # The first body is printed as it's read, so
+                        # printing it never needs it all in memory
+                        self._print_head(snapshot)
+                        snapshot.read(response, sys.stdout.write)
+                        print
+                    else:
+                        snapshot.read(response)
+                except (urllib2.URLError, socket.error), e:
+                    print '[%s] %s' % (time.strftime('%H:%M:%S'), e)
+                    continue
+                if previous is not None:
+                    if snapshot.same_as(previous):
+                        # Keep the body we already have, and let this one go
+                        continue
+                    changes += 1
+                    print '[%s] changed' % time.strftime('%H:%M:%S')
+                    for line in snapshot.diff(previous):
+                        print line
+                previous = snapshot
+        except KeyboardInterrupt:
+            print
+        print '%d requests, %d changed' % (count, changes)
+
+    def _print_head(self, snapshot):
+        print snapshot.status
+        for header, value in sorted(snapshot.headers.items()):
+            print '%s: %s' % (header, value)
+
+
+class HelpCommand(BaseCommand):
+    """
+    Prints out some help on all commands.
+    """
+
+    def run(self, *args):
+        import pyrrhic.ui
+        for opt in pyrrhic.ui.REGISTERED_COMMANDS:
+            cls = pyrrhic.ui.lookup_command(opt)
+            doc = ' '.join(cls.__doc__.split())
+            print "%s: %s" % (opt, doc)
+
+
+class BenchCommand(BaseCommand):
+    """
+    Repeat a REST command and report throughput, status codes and latency
+    percentiles, e.g. 'bench 500 -c 16 get news' makes 500 GET requests to
+    the news resource, 16 at a time. '-r RATE' sends requests at a steady
+    rate, such as 50 (a second) or 600/m, whether or not earlier ones have
+    finished, and counts latency from when each was due. '-P N' shares the
+    requests out between N processes, to use more than one core.
+    """
+
+    USAGE = 'Usage: bench COUNT [-c CONCURRENCY] [-r RATE] [-P PROCESSES] ' \
+        'COMMAND [ARGS]'
+
+    def _parse(self, *args):
+        import pyrrhic.throttling
+        import pyrrhic.ui
+        args = list(args)
+        try:
+            count = int(args.pop(0))
+        except (IndexError, ValueError):
+            raise ValidationError, self.USAGE
+        concurrency = None
+        rate = None
+        processes = 1
+        while args and args[0] in ('-c', '-r', '-P'):
+            if len(args) < 2:
+                raise ValidationError, \
+                    'Please specify a number for %s' % args[0]
+            if args[0] in ('-c', '-P'):
+                try:
+                    number = int(args[1])
+                except ValueError:
+                    raise ValidationError, \
+                        'Please specify a number for %s' % args[0]
+                if args[0] == '-c':
+                    concurrency = number
+                else:
+                    processes = number
+            else:
+                try:
+                    rate = pyrrhic.throttling.parse_rate(args[1])
+                except ValueError, e:
+                    raise ValidationError, str(e)
+            args = args[2:]
+        if concurrency is None:
+            # An open-loop test needs threads to spare for when the server
+            # is slow
+            concurrency = rate and PACED_CONCURRENCY or 1
+        if count < 1 or concurrency < 1 or processes < 1:
+            raise ValidationError, \
+                'COUNT, CONCURRENCY and PROCESSES must be at least 1'
+        # Each process needs a thread of its own
+        processes = min(processes, concurrency)
+        if processes > 1 and not hasattr(os, 'fork'):
+            raise ValidationError, '-P needs a platform with fork()'
+        if not args:
+            raise ValidationError, 'Please specify a command'
+        command = pyrrhic.ui.lookup_command(args[0].lower())
+        if command is None or not issubclass(command, RestCommand):
+            raise ValidationError, 'Only REST commands can be benchmarked'
+        return (count, concurrency, rate, processes, command(self.resources),
+                tuple(args[1:]))
+
+    def validate(self, *args):
+        count, concurrency, rate, processes, command, command_args = \
+            self._parse(*args)
+        command.validate(*command_args)
+        if command.is_fan_out(*command_args):
+            raise ValidationError, \
+                'Only one resource can be benchmarked at a time'
+        if '-a' in command_args or '-x' in command_args:
+            raise ValidationError, 'Checks can\'t be benchmarked'
+
+    def run(self, *args):
+        import pyrrhic.bench
+        count, concurrency, rate, processes, command, command_args = \
+            self._parse(*args)
+        send = command.sender(*command_args)
+        if processes > 1:
+            template = command.template(*command_args)
+
+            def prepare(index):
+                # Workers need connections of their own, and a share of
+                # each rate limit and of the template's counter and rows
+                pyrrhic.after_fork(processes, self.resources.values())
+                if template is not None:
+                    template.share(index, processes)
+            # Workers' requests are counted in the stats command's view too
+            result = pyrrhic.bench.run_processes(send, count, concurrency,
+                                                 processes, rate, prepare,
+                                                 pyrrhic.get_request_stats())
+        elif rate:
+            result = pyrrhic.bench.run_paced(send, count, rate, concurrency)
+        else:
+            result = pyrrhic.bench.run(send, count, concurrency)
+        for line in result.report():
+            print line
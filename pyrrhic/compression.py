@@ -0,0 +1,166 @@
+import urllib2
+import zlib
+
+import pyrrhic.caching
+import pyrrhic.streaming
+
+ACCEPT_ENCODING = 'gzip, deflate'
+
+# Size of the reads made from the compressed stream
+CHUNK_SIZE = 16 * 1024
+
+
+class CompressionStats(object):
+    """ How many bytes came over the wire, and how many they decoded to """
+
+    def __init__(self, encoding):
+        self.encoding = encoding
+        self.compressed = 0
+        self.decoded = 0
+
+    @property
+    def saving(self):
+        """ The fraction of the decoded size that compression saved """
+        if not self.decoded:
+            return 0.0
+        return 1 - float(self.compressed) / self.decoded
+
+    def __str__(self):
+        format_bytes = pyrrhic.streaming.format_bytes
+        return '%s, %s -> %s (%d%% saved)' % (self.encoding,
+            format_bytes(self.compressed), format_bytes(self.decoded),
+            self.saving * 100)
+
+
+class Decoder(object):
+    """
+    Incrementally decodes gzip or deflate data. Servers disagree about
+    whether deflate means a zlib stream or raw deflate data, so for deflate
+    we try zlib first and fall back to raw if the header doesn't match.
+    """
+
+    def __init__(self, encoding):
+        self.encoding = encoding
+        if encoding == 'gzip':
+            self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        else:
+            self._decompressor = zlib.decompressobj()
+        self._first = True
+
+    def decompress(self, data, max_length=0):
+        try:
+            result = self._decompressor.decompress(data, max_length)
+        except zlib.error:
+            if not (self._first and self.encoding == 'deflate'):
+                raise
+            self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            result = self._decompressor.decompress(data, max_length)
+        self._first = False
+        return result
+
+    @property
+    def unconsumed_tail(self):
+        return self._decompressor.unconsumed_tail
+
+    def flush(self):
+        return self._decompressor.flush()
+
+
+class DecodingResponse(object):
+    """
+    Wraps a compressed response, decoding the body as it is read. No more
+    than about one chunk of compressed data, and the amount of decoded data
+    asked for, is held in memory at a time.
+    """
+
+    def __init__(self, response, encoding):
+        self._response = response
+        self._decoder = Decoder(encoding)
+        self._buffer = ''
+        self._eof = False
+        self.compression = CompressionStats(encoding)
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+    def _fill(self, wanted):
+        # Decode until the buffer holds at least `wanted` bytes, or the
+        # body's finished
+        while not self._eof and len(self._buffer) < wanted:
+            tail = self._decoder.unconsumed_tail
+            if tail:
+                data = tail
+            else:
+                data = self._response.read(CHUNK_SIZE)
+                self.compression.compressed += len(data)
+            if not data:
+                decoded = self._decoder.flush()
+                self._eof = True
+            else:
+                decoded = self._decoder.decompress(data,
+                                                   wanted - len(self._buffer))
+            self.compression.decoded += len(decoded)
+            self._buffer += decoded
+
+    def read(self, amt=-1):
+        if amt is None or amt < 0:
+            chunks = [self._buffer]
+            self._buffer = ''
+            while not self._eof:
+                self._fill(CHUNK_SIZE)
+                chunks.append(self._buffer)
+                self._buffer = ''
+            return ''.join(chunks)
+        self._fill(amt)
+        data, self._buffer = self._buffer[:amt], self._buffer[amt:]
+        return data
+
+    def readline(self, limit=-1):
+        while True:
+            end = self._buffer.find('\n') + 1
+            if end or self._eof or 0 < limit <= len(self._buffer):
+                break
+            self._fill(len(self._buffer) + CHUNK_SIZE)
+        if not end:
+            end = len(self._buffer)
+        if limit >= 0:
+            end = min(end, limit)
+        line, self._buffer = self._buffer[:end], self._buffer[end:]
+        return line
+
+    def readlines(self, sizehint=0):
+        return list(self)
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+
+class ContentEncodingHandler(urllib2.BaseHandler):
+    """
+    Asks for gzip or deflate compressed responses, and decodes them as
+    they're read.
+    """
+
+    # Run before the cache, so that it stores the decoded response, and
+    # sees the Accept-Encoding header when matching Vary.
+    handler_order = 300
+
+    def http_request(self, req):
+        if not req.has_header('Accept-encoding'):
+            req.add_unredirected_header('Accept-Encoding', ACCEPT_ENCODING)
+        return req
+
+    https_request = http_request
+
+    def http_response(self, req, response):
+        if isinstance(response, pyrrhic.caching.CachedResponse):
+            # Cached bodies were stored after decoding
+            return response
+        encoding = response.info().get('content-encoding', '').strip().lower()
+        if encoding in ('gzip', 'x-gzip'):
+            return DecodingResponse(response, 'gzip')
+        if encoding == 'deflate':
+            return DecodingResponse(response, 'deflate')
+        return response
+
+    https_response = http_response
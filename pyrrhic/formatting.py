@@ -0,0 +1,410 @@
+"""
+Formats response bodies for the terminal, as they're read. Each formatter
+is fed the body a chunk at a time and writes its output straight away, so
+a large response starts to appear as soon as it arrives, and only about a
+chunk of it is held in memory.
+"""
+import collections
+import re
+
+# Formatters by name. 'auto' picks one from the Content-Type.
+STYLES = ('auto', 'json', 'xml', 'hex', 'plain')
+
+INDENT = '  '
+
+# How much of the body to look at when guessing whether it's binary
+SNIFF_SIZE = 1024
+
+BYTES_PER_HEX_LINE = 16
+
+# Control characters other than tab, newline, form feed and carriage
+# return mean a body isn't text
+BINARY_RE = re.compile(r'[\x00-\x08\x0b\x0e-\x1a\x1c-\x1f]')
+
+
+class Formatter(object):
+    """ Writes the body to `out` as it is, for plain text """
+
+    def __init__(self, out):
+        self.out = out
+
+    def feed(self, data):
+        self.out.write(data)
+
+    def close(self):
+        pass
+
+
+# Tokens outside strings: a whole string, structure (along with any
+# whitespace after it, which saves a token), a run of anything else
+# (numbers, true, false and null), whitespace, or the start of a string
+# that carries on into the next chunk
+JSON_TOKEN_RE = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"|[{}\[\],:]\s*|'
+                           r'[^{}\[\],:"\s]+|\s+|"')
+
+# The characters that end a run of ordinary characters in a string
+JSON_STRING_RE = re.compile(r'["\\]')
+
+JSON_VALUE_START = '{["-0123456789tfn'
+
+
+class JsonFormatter(Formatter):
+    """
+    Pretty-prints JSON without parsing it: the output is worked out from
+    the brackets, commas and colons outside strings, so it can be written
+    as each chunk comes in. Several values in a row, as in JSON lines, are
+    put on lines of their own. A body that doesn't start like JSON is
+    written as it is.
+    """
+
+    def __init__(self, out):
+        Formatter.__init__(self, out)
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        # Set after an opening bracket, until we see whether the
+        # container is empty
+        self._opened = False
+        self._started = False
+        # Set once a top-level value has finished, so the next one goes
+        # on a new line
+        self._finished = False
+        self._plain = False
+        # A newline and indent for each depth
+        self._newlines = ['\n']
+
+    def _newline(self, depth):
+        newlines = self._newlines
+        while len(newlines) <= depth:
+            newlines.append('\n' + INDENT * len(newlines))
+        return newlines[depth]
+
+    def feed(self, data):
+        if self._plain:
+            self.out.write(data)
+            return
+        out = []
+        append = out.append
+        newline = self._newline
+        # Work with locals in the loop, which runs for every token
+        depth = self._depth
+        opened = self._opened
+        finished = self._finished
+        i = 0
+        end = len(data)
+        while i < end:
+            if self._in_string:
+                i = self._feed_string(data, i, out)
+                if not self._in_string:
+                    finished = depth == 0
+                continue
+            for match in JSON_TOKEN_RE.finditer(data, i):
+                token = match.group()
+                c = token[0]
+                if c in ' \t\r\n':
+                    if depth == 0 and self._started:
+                        finished = True
+                    continue
+                if not self._started:
+                    if c not in JSON_VALUE_START:
+                        # Not JSON after all
+                        self._plain = True
+                        append(data[match.start():])
+                        break
+                    self._started = True
+                if finished and c not in ',:}]':
+                    append('\n')
+                    finished = False
+                if c == ':':
+                    append(': ')
+                elif c == ',':
+                    append(',' + newline(depth))
+                elif c == '}' or c == ']':
+                    depth = max(depth - 1, 0)
+                    if opened:
+                        opened = False
+                    else:
+                        append(newline(depth))
+                    append(c)
+                    finished = depth == 0
+                else:
+                    # A value. The first thing in a container goes on a
+                    # new line.
+                    if opened:
+                        append(newline(depth))
+                        opened = False
+                    if c == '{' or c == '[':
+                        append(c)
+                        depth += 1
+                        opened = True
+                    elif token == '"':
+                        # The string carries on in the next chunk
+                        append(token)
+                        self._in_string = True
+                        i = match.end()
+                        break
+                    else:
+                        append(token)
+                        finished = depth == 0 and c == '"'
+            else:
+                i = end
+            if self._plain:
+                break
+        self._depth = depth
+        self._opened = opened
+        self._finished = finished
+        self.out.write(''.join(out))
+
+    def _feed_string(self, data, i, out):
+        # Copy string contents up to and including the closing quote, if
+        # it's in this chunk. Returns where to carry on from.
+        if self._escaped:
+            out.append(data[i])
+            self._escaped = False
+            return i + 1
+        match = JSON_STRING_RE.search(data, i)
+        if match is None:
+            out.append(data[i:])
+            return len(data)
+        out.append(data[i:match.end()])
+        if match.group() == '"':
+            self._in_string = False
+        else:
+            self._escaped = True
+        return match.end()
+
+
+class XmlFormatter(Formatter):
+    """
+    Indents XML, putting each element on a line of its own, except for
+    elements that only contain text, which stay on one line. Like the JSON
+    formatter, it only looks at the markup, so it works incrementally.
+    """
+
+    def __init__(self, out):
+        Formatter.__init__(self, out)
+        self._depth = 0
+        # An unfinished tag, or text that may carry on in the next chunk
+        self._buffer = ''
+        self._started = False
+        # Whether the last thing written was an opening tag, or text
+        # following one, so that a closing tag can go on the same line
+        self._inline = False
+
+    def feed(self, data):
+        data = self._buffer + data
+        out = []
+        i = 0
+        while i < len(data):
+            if data.startswith('<', i):
+                if data.startswith('<!--', i):
+                    close = '-->'
+                elif data.startswith('<![CDATA[', i):
+                    close = ']]>'
+                else:
+                    close = '>'
+                end = data.find(close, i)
+                if end < 0:
+                    break
+                end += len(close)
+            else:
+                end = data.find('<', i)
+                if end < 0:
+                    break
+            self._token(data[i:end], out)
+            i = end
+        self._buffer = data[i:]
+        self.out.write(''.join(out))
+
+    def _newline(self, out):
+        if self._started:
+            out.append('\n' + INDENT * self._depth)
+        self._started = True
+
+    def _token(self, token, out):
+        if not token.startswith('<'):
+            text = token.strip()
+            if text:
+                if not self._inline:
+                    self._newline(out)
+                out.append(text)
+            return
+        if token.startswith('</'):
+            self._depth = max(self._depth - 1, 0)
+            if not self._inline:
+                self._newline(out)
+            out.append(token)
+            self._inline = False
+        elif token.startswith(('<?', '<!')) or token.endswith('/>'):
+            self._newline(out)
+            out.append(token)
+            self._inline = False
+        else:
+            self._newline(out)
+            out.append(token)
+            self._depth += 1
+            self._inline = True
+
+    def close(self):
+        if self._buffer:
+            out = []
+            self._token(self._buffer, out)
+            self._buffer = ''
+            self.out.write(''.join(out))
+
+
+class HexFormatter(Formatter):
+    """ Writes a hex dump, with the offset and printable characters """
+
+    def __init__(self, out):
+        Formatter.__init__(self, out)
+        self._offset = 0
+        self._buffer = ''
+
+    def feed(self, data):
+        data = self._buffer + data
+        whole = len(data) - len(data) % BYTES_PER_HEX_LINE
+        self._buffer = data[whole:]
+        self._write(data[:whole])
+
+    def _write(self, data):
+        lines = []
+        for i in range(0, len(data), BYTES_PER_HEX_LINE):
+            lines.append(self._line(self._offset + i,
+                                    data[i:i + BYTES_PER_HEX_LINE]))
+        if lines:
+            # Lines are separated, rather than ended, with newlines, like
+            # the other formatters' output
+            separator = self._offset and '\n' or ''
+            self.out.write(separator + '\n'.join(lines))
+            self._offset += len(data)
+
+    def _line(self, offset, data):
+        hex_bytes = ['%02x' % ord(c) for c in data]
+        hex_bytes += ['  '] * (BYTES_PER_HEX_LINE - len(data))
+        half = BYTES_PER_HEX_LINE // 2
+        text = ''.join(c if ' ' <= c <= '~' else '.' for c in data)
+        return '%08x  %s  %s  |%s|' % (offset, ' '.join(hex_bytes[:half]),
+                                       ' '.join(hex_bytes[half:]), text)
+
+    def close(self):
+        self._write(self._buffer)
+        self._buffer = ''
+
+
+FORMATTERS = {
+    'json': JsonFormatter,
+    'xml': XmlFormatter,
+    'hex': HexFormatter,
+    'plain': Formatter,
+}
+
+
+def guess_style(content_type, sample=''):
+    """
+    Pick a formatter for a Content-Type, falling back on looking at the
+    start of the body to tell text from binary data.
+    """
+    media_type = (content_type or '').split(';')[0].strip().lower()
+    if media_type.endswith(('/json', '+json')) or media_type == 'application/x-ndjson':
+        return 'json'
+    if media_type.endswith(('/xml', '+xml')):
+        return 'xml'
+    if media_type.startswith('text/'):
+        return 'plain'
+    if BINARY_RE.search(sample[:SNIFF_SIZE]):
+        return 'hex'
+    return 'plain'
+
+
+class LineLimiter(object):
+    """
+    Passes the first `head` lines written on to `out`, then keeps only the
+    last `tail` lines, which are written, after a note of how many lines
+    were left out, by close(). A `head` of None writes everything.
+    """
+
+    def __init__(self, out, head=None, tail=0):
+        self.out = out
+        self.head = head
+        self.tail = tail
+        self._lines = 0
+        self._partial = ''
+        self._last = collections.deque(maxlen=tail)
+        self.omitted = 0
+
+    def write(self, data):
+        if self.head is None:
+            self.out.write(data)
+            return
+        if self._lines < self.head:
+            count = data.count('\n')
+            if self._lines + count < self.head:
+                self._lines += count
+                self.out.write(data)
+                return
+            # Write up to the end of the last line that fits
+            end = -1
+            for i in range(self.head - self._lines):
+                end = data.index('\n', end + 1)
+            self._lines = self.head
+            self.out.write(data[:end + 1])
+            data = data[end + 1:]
+        lines = (self._partial + data).split('\n')
+        self._partial = lines.pop()
+        kept = len(self._last) + len(lines)
+        self._last.extend(lines)
+        self.omitted += max(kept - self.tail, 0)
+
+    def flush(self):
+        self.out.flush()
+
+    def close(self):
+        lines = list(self._last)
+        if self._partial:
+            lines.append(self._partial)
+            extra = len(lines) - self.tail
+            if extra > 0:
+                self.omitted += extra
+                lines = lines[extra:]
+        if self.omitted:
+            self.out.write('... %d lines omitted ...\n' % self.omitted)
+        if lines:
+            text = '\n'.join(lines)
+            if not self._partial:
+                text += '\n'
+            self.out.write(text)
+
+
+class BodyWriter(object):
+    """
+    A file-like object that formats what's written to it, and limits how
+    many lines of the result are shown, before passing it on to `out`.
+    The formatter is chosen when the first chunk is written, so that it
+    can be used to guess whether the body is binary.
+    """
+
+    def __init__(self, out, content_type=None, style='auto', head=None,
+                 tail=0):
+        self.content_type = content_type
+        self.style = style
+        self._limiter = LineLimiter(out, head, tail)
+        self._formatter = None
+
+    def write(self, data):
+        if not data:
+            return
+        if self._formatter is None:
+            style = self.style
+            if style == 'auto':
+                style = guess_style(self.content_type, data)
+            self._formatter = FORMATTERS[style](self._limiter)
+        self._formatter.feed(data)
+
+    def flush(self):
+        self._limiter.flush()
+
+    def close(self):
+        if self._formatter is not None:
+            self._formatter.close()
+        self._limiter.close()
@@ -0,0 +1,104 @@
+"""
+Latency histograms in the style of HdrHistogram: values are counted in
+buckets whose width grows with the value, so any value is known to within
+a fixed relative precision, however many are recorded, and two histograms
+can be merged by adding up their buckets.
+"""
+
+# Each power of two is split into 2 ** (SUB_BUCKET_BITS - 1) buckets, so
+# values are kept to within 1 part in 128, better than 1%
+SUB_BUCKET_BITS = 8
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+HALF_SUB_BUCKETS = SUB_BUCKETS >> 1
+
+# Latencies are recorded in seconds, and counted in microseconds
+UNITS_PER_SECOND = 1000000
+
+
+def bucket_index(value):
+    """ The bucket for a whole number of units """
+    magnitude = max(value.bit_length() - SUB_BUCKET_BITS, 0)
+    return (magnitude * HALF_SUB_BUCKETS) + (value >> magnitude)
+
+
+def bucket_range(index):
+    """ The lowest and highest values in a bucket """
+    if index < SUB_BUCKETS:
+        return index, index
+    magnitude = (index - HALF_SUB_BUCKETS) // HALF_SUB_BUCKETS
+    low = (index - magnitude * HALF_SUB_BUCKETS) << magnitude
+    return low, low + (1 << magnitude) - 1
+
+
+class Histogram(object):
+    """
+    Counts values, such as latencies in seconds, in log-linear buckets.
+    Values are multiplied by `scale` and counted as whole numbers, so the
+    default suits seconds, and a scale of 1 suits sizes in bytes. Buckets
+    are only kept for values that have been seen, so a histogram is small
+    enough to send between processes, and never has more than a few
+    thousand.
+    """
+
+    def __init__(self, scale=UNITS_PER_SECOND):
+        self.scale = scale
+        self.counts = {}
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def record(self, value, count=1):
+        value = int(value * self.scale)
+        if value < 0:
+            value = 0
+        # bucket_index, inline, as this is called for every request
+        magnitude = value.bit_length() - SUB_BUCKET_BITS
+        if magnitude > 0:
+            index = magnitude * HALF_SUB_BUCKETS + (value >> magnitude)
+        else:
+            index = value
+        counts = self.counts
+        counts[index] = counts.get(index, 0) + count
+        if not self.count:
+            self.min = self.max = value
+        elif value < self.min:
+            self.min = value
+        elif value > self.max:
+            self.max = value
+        self.count += count
+        self.total += value * count
+
+    def merge(self, other):
+        """ Add the values counted in another histogram to this one """
+        counts = self.counts
+        for index, count in other.counts.iteritems():
+            counts[index] = counts.get(index, 0) + count
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+
+    @property
+    def mean(self):
+        if not self.count:
+            return 0.0
+        return float(self.total) / self.count / self.scale
+
+    def percentile(self, p):
+        """
+        The p'th percentile (0 <= p <= 100), by the nearest-rank method, as
+        the highest value its bucket could hold
+        """
+        if not self.count:
+            return 0.0
+        rank = max(int(-(-p * self.count // 100)), 1)
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                value = min(bucket_range(index)[1], self.max)
+                return float(max(value, self.min)) / self.scale
+        return float(self.max) / self.scale
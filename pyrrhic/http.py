@@ -1,5 +1,13 @@
+import httplib
+import select
+import socket
+import StringIO
+import threading
+import time
 import urllib2
 
+import pyrrhic.streaming
+
 class Request(urllib2.Request):
     """ Subclass of urllib2.Request that can do PUT, DELETE and OPTIONS """
     
@@ -9,7 +17,34 @@ class Request(urllib2.Request):
         urllib2.Request.__init__(self, url, data, headers, origin_req_host,
                  unverifiable)
         self.req_method = req_method
+        # Whether pyrrhic.http2 should try sending this over HTTP/2
+        self.http2 = False
+        # The request target given to set_target, if any
+        self._selector = None
         
+    def set_target(self, type, host, selector):
+        """
+        Supply the scheme, host and request target of an already parsed
+        URL, so that urllib2 doesn't split the URL again.
+        """
+        self.type = type
+        self.host = host
+        self._selector = selector
+
+    def get_selector(self):
+        if self._selector is None:
+            return urllib2.Request.get_selector(self)
+        return self._selector
+
+    def set_proxy(self, host, type):
+        # Through a proxy, the request target is the whole URL, as urllib2
+        # works out
+        self._selector = None
+        urllib2.Request.set_proxy(self, host, type)
+
+    def has_proxy(self):
+        return self._selector is None and urllib2.Request.has_proxy(self)
+
     def get_method(self):
         if self.req_method is None:
             # If a method wasn't set, fall back to the default approach
@@ -22,4 +57,501 @@ class PyrrhicHTTPErrorHandler(urllib2.HTTPDefaultErrorHandler):
     override the default behaviour with a simple return """
     
     def http_error_default(self, req, fp, code, msg, hdrs):
-        return fp
\ No newline at end of file
+        return fp
+
+
+class Timings(object):
+    """
+    How long each phase of a request took, in seconds. Phases that didn't
+    happen, such as connecting on a reused connection or the TLS handshake
+    for plain HTTP, are None.
+    """
+
+    phases = ('dns', 'connect', 'tls', 'ttfb', 'transfer')
+
+    def __init__(self):
+        self.reused = False
+        for phase in self.phases:
+            setattr(self, phase, None)
+
+    @property
+    def total(self):
+        return sum(getattr(self, phase) or 0 for phase in self.phases)
+
+    def as_dict(self):
+        result = dict((phase, getattr(self, phase)) for phase in self.phases)
+        result['total'] = self.total
+        result['reused'] = self.reused
+        return result
+
+    def __str__(self):
+        bits = []
+        for phase in self.phases + ('total',):
+            value = getattr(self, phase)
+            if value is None:
+                bits.append('%s -' % phase)
+            else:
+                bits.append('%s %.1fms' % (phase, value * 1000))
+        if self.reused:
+            bits.append('(reused connection)')
+        return '  '.join(bits)
+
+
+class TimedConnectionMixin:
+    """
+    Does the work of HTTPConnection.connect itself, so that DNS resolution
+    and the TCP connect can be timed separately. The timings are recorded
+    in the `Timings` instance the handler sets as `self.timings`. Hosts are
+    looked up through `self.resolver`, a `pyrrhic.resolver.DNSCache`, if
+    the handler sets one.
+    """
+
+    timings = None
+    resolver = None
+
+    def _connect_tcp(self):
+        timings = self.timings or Timings()
+        start = time.time()
+        if self.resolver is not None:
+            addresses = self.resolver.resolve(self.host, self.port)
+        else:
+            addresses = socket.getaddrinfo(self.host, self.port, 0,
+                                           socket.SOCK_STREAM)
+        resolved = time.time()
+        timings.dns = resolved - start
+        try:
+            self.sock = self._connect_first(addresses)
+        except socket.error:
+            if self.resolver is not None:
+                # The host may have moved, so look it up again next time
+                self.resolver.forget(self.host, self.port)
+            raise
+        timings.connect = time.time() - resolved
+        if self._tunnel_host:
+            self._tunnel()
+
+    def _connect_first(self, addresses):
+        # As socket.create_connection, but with the addresses already
+        # resolved
+        err = None
+        for af, socktype, proto, canonname, sa in addresses:
+            sock = None
+            try:
+                sock = socket.socket(af, socktype, proto)
+                if self.timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+                    sock.settimeout(self.timeout)
+                if self.source_address:
+                    sock.bind(self.source_address)
+                sock.connect(sa)
+                # Requests are written in more than one send (headers,
+                # then body), so don't let Nagle hold the second one back
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                return sock
+            except socket.error, e:
+                err = e
+                if sock is not None:
+                    sock.close()
+        if err is not None:
+            raise err
+        raise socket.error('getaddrinfo returns an empty list')
+
+
+class TimedHTTPConnection(TimedConnectionMixin, httplib.HTTPConnection):
+
+    def connect(self):
+        self._connect_tcp()
+
+
+class TimedHTTPSConnection(TimedConnectionMixin, httplib.HTTPSConnection):
+
+    def connect(self):
+        self._connect_tcp()
+        server_hostname = self._tunnel_host or self.host
+        start = time.time()
+        self.sock = self._context.wrap_socket(self.sock,
+                                              server_hostname=server_hostname)
+        if self.timings is not None:
+            self.timings.tls = time.time() - start
+
+
+class HostStats(object):
+    """ Counters for the connections the pool has made to one host """
+
+    def __init__(self):
+        self.opened = 0
+        self.reused = 0
+        self.stale = 0
+        self.in_use = 0
+
+
+class ConnectionPool(object):
+    """
+    Keeps idle HTTP/1.1 connections open so that subsequent requests to
+    the same host can reuse them. Connections are keyed on (scheme, netloc),
+    which is exactly what `Resource` normalises its URL to.
+
+    At most `max_per_host` idle connections are kept for each host; any
+    more are closed as they are released. Idle connections older than
+    `idle_timeout` seconds, or whose socket has become readable (which for
+    an idle HTTP connection means the server closed it) are discarded
+    rather than reused.
+    """
+
+    def __init__(self, max_per_host=10, idle_timeout=30.0):
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self._idle = {}
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def _host_stats(self, key):
+        try:
+            return self._stats[key]
+        except KeyError:
+            return self._stats.setdefault(key, HostStats())
+
+    def get(self, key, connection_factory):
+        """
+        Return a tuple of (connection, reused) for the given key, creating
+        a new connection with `connection_factory` if there's no usable
+        idle connection available.
+        """
+        now = time.time()
+        with self._lock:
+            stats = self._host_stats(key)
+            idle = self._idle.get(key, [])
+            while idle:
+                conn, released_at = idle.pop()
+                if now - released_at > self.idle_timeout or self._is_stale(conn):
+                    stats.stale += 1
+                    conn.close()
+                    continue
+                stats.reused += 1
+                stats.in_use += 1
+                return conn, True
+            stats.opened += 1
+            stats.in_use += 1
+        return connection_factory(), False
+
+    def add(self, key, conn):
+        """ Add a connection that was opened ahead of a request as idle """
+        with self._lock:
+            self._host_stats(key).opened += 1
+            self._host_stats(key).in_use += 1
+        self.release(key, conn)
+
+    def release(self, key, conn):
+        """ Hand a connection back to the pool once its response is done """
+        with self._lock:
+            stats = self._host_stats(key)
+            stats.in_use -= 1
+            idle = self._idle.setdefault(key, [])
+            if conn.sock is None or len(idle) >= self.max_per_host:
+                conn.close()
+            else:
+                idle.append((conn, time.time()))
+
+    def discard(self, key, conn):
+        """ Close a connection that can't safely be reused """
+        conn.close()
+        with self._lock:
+            self._host_stats(key).in_use -= 1
+
+    def clear(self):
+        """ Close all idle connections """
+        with self._lock:
+            for idle in self._idle.values():
+                for conn, _ in idle:
+                    conn.close()
+            self._idle.clear()
+
+    def stats(self):
+        """
+        Return a list of (key, open, idle, opened, reused) tuples,
+        one per host the pool has seen.
+        """
+        with self._lock:
+            result = []
+            for key, stats in sorted(self._stats.items()):
+                idle = len(self._idle.get(key, []))
+                result.append((key, stats.in_use + idle, idle, stats.opened,
+                               stats.reused))
+            return result
+
+    def _is_stale(self, conn):
+        if conn.sock is None:
+            return True
+        try:
+            readable, _, _ = select.select([conn.sock], [], [], 0)
+        except (select.error, socket.error, ValueError):
+            return True
+        # An idle connection should have nothing to read. If it does,
+        # it's either EOF because the server hung up, or junk.
+        return bool(readable)
+
+
+class PooledResponse(object):
+    """
+    File-like response, compatible with the object urllib2 returns, which
+    hands its connection back to the pool once the body has been read.
+    """
+
+    def __init__(self, pool, key, conn, response, url, timings=None):
+        self._pool = pool
+        self._key = key
+        self._conn = conn
+        self._response = response
+        response.recv = response.read
+        self.fp = socket._fileobject(response, close=True)
+        self.headers = response.msg
+        self.url = url
+        self.code = response.status
+        self.msg = response.reason
+        self.protocol = response.version == 10 and 'HTTP/1.0' or 'HTTP/1.1'
+        self.timings = timings or Timings()
+        self._headers_received = time.time()
+        self._check_done()
+
+    def _check_done(self):
+        if self._conn is not None and self._response.isclosed():
+            self.timings.transfer = time.time() - self._headers_received
+            conn, self._conn = self._conn, None
+            self._pool.release(self._key, conn)
+
+    def read(self, amt=-1):
+        data = self.fp.read(amt)
+        self._check_done()
+        return data
+
+    def readline(self, limit=-1):
+        data = self.fp.readline(limit)
+        self._check_done()
+        return data
+
+    def readlines(self, sizehint=0):
+        data = self.fp.readlines(sizehint)
+        self._check_done()
+        return data
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    def fileno(self):
+        return self.fp.fileno()
+
+    def info(self):
+        return self.headers
+
+    def geturl(self):
+        return self.url
+
+    def getcode(self):
+        return self.code
+
+    def close(self):
+        if self._conn is not None:
+            # The body wasn't fully read, so the connection has unread
+            # data sitting on it and can't be reused.
+            conn, self._conn = self._conn, None
+            self._pool.discard(self._key, conn)
+        self.fp.close()
+
+
+class BufferedResponse(object):
+    """
+    A response whose body is held in memory, with the urllib2 response API.
+    `from_response` reads a response in full, so that its connection is
+    free for the next request.
+    """
+
+    protocol = None
+
+    def __init__(self, code, msg, headers, url, body, timings=None):
+        self.code = code
+        self.msg = msg
+        self.headers = headers
+        self.url = url
+        self.timings = timings or Timings()
+        self.fp = StringIO.StringIO(body)
+
+    @classmethod
+    def from_response(cls, response):
+        try:
+            body = response.read()
+        finally:
+            response.close()
+        buffered = cls(response.code, response.msg, response.info(),
+                       response.geturl(), body,
+                       getattr(response, 'timings', None))
+        buffered.compression = getattr(response, 'compression', None)
+        buffered.protocol = getattr(response, 'protocol', None)
+        return buffered
+
+    def read(self, amt=-1):
+        return self.fp.read(amt)
+
+    def readline(self, limit=-1):
+        return self.fp.readline(limit)
+
+    def readlines(self, sizehint=0):
+        return self.fp.readlines(sizehint)
+
+    def __iter__(self):
+        return iter(self.fp)
+
+    def info(self):
+        return self.headers
+
+    def geturl(self):
+        return self.url
+
+    def getcode(self):
+        return self.code
+
+    def close(self):
+        self.fp.close()
+
+
+class KeepAliveHandlerMixin:
+    """
+    Replaces urllib2's do_open, which opens a new connection for every
+    request and sends Connection: close, with one that goes through a
+    `ConnectionPool`.
+    """
+
+    def do_request_(self, req):
+        body = req.get_data()
+        if not isinstance(body, pyrrhic.streaming.Upload):
+            return urllib2.AbstractHTTPHandler.do_request_(self, req)
+        # urllib2 would take the Content-Length from len(body), and say the
+        # body is form data
+        req.data = None
+        try:
+            req = urllib2.AbstractHTTPHandler.do_request_(self, req)
+        finally:
+            req.data = body
+        if not req.has_header('Content-type'):
+            req.add_unredirected_header('Content-type',
+                                        'application/octet-stream')
+        if body.chunked:
+            req.add_unredirected_header('Transfer-encoding', 'chunked')
+        else:
+            req.add_unredirected_header('Content-length', str(body.size))
+        return req
+
+    def http_request(self, req):
+        return self.do_request_(req)
+
+    https_request = http_request
+
+    def do_open(self, http_class, req, **http_conn_args):
+        host = req.get_host()
+        if not host:
+            raise urllib2.URLError('no host given')
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update(dict((k, v) for k, v in req.headers.items()
+                            if k not in headers))
+        headers['Connection'] = 'keep-alive'
+        headers = dict(
+            (name.title(), val) for name, val in headers.items())
+
+        tunnel_headers = {}
+        if req._tunnel_host:
+            proxy_auth_hdr = 'Proxy-Authorization'
+            if proxy_auth_hdr in headers:
+                tunnel_headers[proxy_auth_hdr] = headers.pop(proxy_auth_hdr)
+
+        netloc = host
+        if req._tunnel_host:
+            netloc = '%s>%s' % (host, req._tunnel_host)
+        key = (req.get_type(), netloc)
+        def connection_factory():
+            conn = http_class(host, timeout=req.timeout, **http_conn_args)
+            conn.set_debuglevel(self._debuglevel)
+            conn.resolver = self.resolver
+            if req._tunnel_host:
+                conn.set_tunnel(req._tunnel_host, headers=tunnel_headers)
+            return conn
+
+        conn, reused = self.pool.get(key, connection_factory)
+        timings = Timings()
+        try:
+            response = self._send(conn, req, headers, timings, reused)
+        except (socket.error, httplib.HTTPException), err:
+            self.pool.discard(key, conn)
+            stale = isinstance(err, (socket.error, httplib.BadStatusLine))
+            if not reused or not stale or not self._rewind(req):
+                raise urllib2.URLError(err)
+            # The server closed the idle connection between our staleness
+            # check and the request. Try once more on a fresh connection.
+            conn, reused = self.pool.get(key, connection_factory)
+            timings = Timings()
+            try:
+                response = self._send(conn, req, headers, timings, reused)
+            except (socket.error, httplib.HTTPException), err:
+                self.pool.discard(key, conn)
+                raise urllib2.URLError(err)
+        req.timings = timings
+        return PooledResponse(self.pool, key, conn, response,
+                              req.get_full_url(), timings)
+
+    def _rewind(self, req):
+        if isinstance(req.data, pyrrhic.streaming.Upload):
+            return req.data.rewind()
+        return True
+
+    def _send(self, conn, req, headers, timings, reused):
+        timings.reused = reused
+        conn.timings = timings
+        if conn.sock is not None and req.timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+            conn.sock.settimeout(req.timeout)
+        if isinstance(req.data, pyrrhic.streaming.Upload):
+            self._send_upload(conn, req, headers)
+        else:
+            conn.request(req.get_method(), req.get_selector(), req.data,
+                         headers)
+        sent = time.time()
+        response = conn.getresponse(buffering=True)
+        timings.ttfb = time.time() - sent
+        return response
+
+    def _send_upload(self, conn, req, headers):
+        # HTTPConnection.request can't send a chunked body, so send the
+        # headers ourselves and then stream the body.
+        names = set(name.lower() for name in headers)
+        conn.putrequest(req.get_method(), req.get_selector(),
+                        skip_host='host' in names,
+                        skip_accept_encoding='accept-encoding' in names)
+        for name, value in headers.items():
+            conn.putheader(name, value)
+        conn.endheaders()
+        req.data.send(conn)
+
+
+class KeepAliveHTTPHandler(KeepAliveHandlerMixin, urllib2.HTTPHandler):
+
+    def __init__(self, pool, debuglevel=0, resolver=None):
+        urllib2.HTTPHandler.__init__(self, debuglevel)
+        self.pool = pool
+        self.resolver = resolver
+
+    def http_open(self, req):
+        return self.do_open(TimedHTTPConnection, req)
+
+
+class KeepAliveHTTPSHandler(KeepAliveHandlerMixin, urllib2.HTTPSHandler):
+
+    def __init__(self, pool, debuglevel=0, context=None, resolver=None):
+        urllib2.HTTPSHandler.__init__(self, debuglevel, context)
+        self.pool = pool
+        self.resolver = resolver
+
+    def https_open(self, req):
+        return self.do_open(TimedHTTPSConnection, req, context=self._context)
@@ -0,0 +1,454 @@
+"""
+An optional HTTP/2 transport, which needs the h2 package (pip install h2).
+
+Requests to the same host share one connection, each on a stream of its
+own, with HPACK header compression. Plain http:// resources use h2c with
+prior knowledge, which suits local test servers; https:// resources agree
+on HTTP/2 with ALPN, and fall back to HTTP/1.1 if the server won't.
+"""
+import collections
+import httplib
+import socket
+import ssl
+import StringIO
+import threading
+import time
+import urllib2
+
+try:
+    import h2.config
+    import h2.connection
+    import h2.errors
+    import h2.events
+    import h2.exceptions
+    import h2.settings
+except ImportError:
+    h2 = None
+
+import pyrrhic.http
+import pyrrhic.streaming
+
+PROTOCOL = 'HTTP/2'
+
+# Size of the reads made from a connection's socket
+READ_SIZE = 64 * 1024
+
+# How much response data the server may send on each stream before we've
+# read it, and on the connection as a whole
+STREAM_WINDOW = 1024 * 1024
+CONNECTION_WINDOW = 16 * 1024 * 1024
+
+# Seconds between checks for Ctrl-C and timeouts while waiting on a stream
+WAIT_INTERVAL = 0.5
+
+# HTTP/1.1 headers that mean nothing, or are forbidden, in HTTP/2
+CONNECTION_HEADERS = ('connection', 'host', 'keep-alive', 'proxy-connection',
+                      'transfer-encoding', 'upgrade')
+
+
+def available():
+    """ Whether the h2 package is installed """
+    return h2 is not None
+
+
+class NotNegotiated(Exception):
+    """ The server didn't agree to speak HTTP/2 """
+
+
+class Stream(object):
+    """ One request and its response on an `HTTP2Connection` """
+
+    def __init__(self, stream_id):
+        self.id = stream_id
+        self.headers = None
+        # (data, flow controlled length) pairs, not read yet
+        self.chunks = collections.deque()
+        self.ended = False
+        self.error = None
+
+
+class HTTP2Connection(object):
+    """
+    An HTTP/2 connection to one host. A thread reads from the socket and
+    hands what arrives to the waiting streams, so any number of threads
+    can make requests on the connection at once.
+    """
+
+    def __init__(self, host, secure=False, timeout=None, resolver=None):
+        self.host = host
+        self.secure = secure
+        self.timeout = timeout
+        self.resolver = resolver
+        self.closed = False
+        self.error = None
+        self.sock = None
+        self._streams = {}
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+
+    def connect(self, timings):
+        if self.secure:
+            context = ssl.create_default_context()
+            context.set_alpn_protocols(['h2'])
+            conn = pyrrhic.http.TimedHTTPSConnection(self.host,
+                timeout=self.timeout, context=context)
+        else:
+            conn = pyrrhic.http.TimedHTTPConnection(self.host,
+                timeout=self.timeout)
+        conn.timings = timings
+        conn.resolver = self.resolver
+        conn.connect()
+        self.sock = conn.sock
+        if self.secure and self.sock.selected_alpn_protocol() != 'h2':
+            self.sock.close()
+            raise NotNegotiated(self.host)
+        # The reader thread waits on the socket for as long as it's open;
+        # timeouts are applied while waiting for a response instead
+        self.sock.settimeout(None)
+
+        config = h2.config.H2Configuration(client_side=True)
+        self._h2 = h2.connection.H2Connection(config=config)
+        self._h2.initiate_connection()
+        self._h2.update_settings({
+            h2.settings.SettingCodes.INITIAL_WINDOW_SIZE: STREAM_WINDOW})
+        self._h2.increment_flow_control_window(CONNECTION_WINDOW)
+        with self._lock:
+            self._send_pending()
+        thread = threading.Thread(target=self._read)
+        thread.daemon = True
+        thread.start()
+
+    def _send_pending(self):
+        # Called with the lock held
+        data = self._h2.data_to_send()
+        if data:
+            self.sock.sendall(data)
+
+    def _wait(self, ready, deadline=None):
+        # Wait, with the lock held, until ready() is true, failing if the
+        # connection has failed or the deadline passes
+        while not ready():
+            if self.error is not None:
+                raise urllib2.URLError(self.error)
+            if deadline is not None and time.time() > deadline:
+                raise urllib2.URLError(socket.timeout('timed out'))
+            self._changed.wait(WAIT_INTERVAL)
+
+    def _deadline(self):
+        if self.timeout in (None, socket._GLOBAL_DEFAULT_TIMEOUT):
+            return None
+        return time.time() + self.timeout
+
+    def _read(self):
+        try:
+            while True:
+                data = self.sock.recv(READ_SIZE)
+                if not data:
+                    raise socket.error('connection closed by server')
+                with self._lock:
+                    for event in self._h2.receive_data(data):
+                        self._handle(event)
+                    self._send_pending()
+                    self._changed.notify_all()
+                if self.closed:
+                    break
+        except Exception, e:
+            with self._lock:
+                self._fail(e)
+
+    def _handle(self, event):
+        stream = self._streams.get(getattr(event, 'stream_id', None))
+        if isinstance(event, h2.events.ResponseReceived):
+            if stream is not None:
+                stream.headers = event.headers
+        elif isinstance(event, h2.events.DataReceived):
+            if stream is not None and event.data:
+                stream.chunks.append((event.data,
+                                      event.flow_controlled_length))
+            elif event.flow_controlled_length:
+                # Padding, or data for a stream we've given up on. An
+                # empty frame, which just ends the stream, isn't queued,
+                # as it would be read as the end of the body.
+                self._h2.acknowledge_received_data(
+                    event.flow_controlled_length, event.stream_id)
+        elif isinstance(event, h2.events.StreamEnded):
+            if stream is not None:
+                stream.ended = True
+        elif isinstance(event, h2.events.StreamReset):
+            if stream is not None:
+                stream.error = 'stream reset by server (%s)' % event.error_code
+                stream.ended = True
+        elif isinstance(event, h2.events.ConnectionTerminated):
+            self.closed = True
+            # Streams the server didn't get to can't be answered now
+            for stream_id, stream in self._streams.items():
+                if stream_id > event.last_stream_id and not stream.ended:
+                    stream.error = 'connection closed by server'
+                    stream.ended = True
+
+    def _fail(self, error):
+        # Called with the lock held
+        self.closed = True
+        if self.error is None:
+            self.error = error
+        for stream in self._streams.values():
+            if not stream.ended:
+                stream.error = error
+                stream.ended = True
+        self._changed.notify_all()
+        try:
+            self.sock.close()
+        except socket.error:
+            pass
+
+    def request(self, method, authority, selector, headers, body=None):
+        """ Start a request, returning its `Stream` """
+        h2_headers = [
+            (':method', method),
+            (':scheme', self.secure and 'https' or 'http'),
+            (':authority', authority),
+            (':path', selector),
+        ]
+        h2_headers.extend((name.lower(), value) for name, value in headers.items()
+                          if name.lower() not in CONNECTION_HEADERS)
+        deadline = self._deadline()
+        with self._lock:
+            # Wait for a stream to be free, if the server limits them
+            self._wait(lambda: self.closed or self._h2.open_outbound_streams <
+                       self._h2.remote_settings.max_concurrent_streams, deadline)
+            if self.closed:
+                raise urllib2.URLError('HTTP/2 connection closed')
+            stream = Stream(self._h2.get_next_available_stream_id())
+            self._streams[stream.id] = stream
+            self._h2.send_headers(stream.id, h2_headers,
+                                  end_stream=body is None)
+            self._send_pending()
+        if body is not None:
+            self._send_body(stream, body)
+        return stream
+
+    def _send_body(self, stream, body):
+        if isinstance(body, pyrrhic.streaming.Upload):
+            chunks = body.chunks()
+        else:
+            chunks = [body]
+        for data in chunks:
+            while data:
+                with self._lock:
+                    self._wait(lambda: stream.ended or
+                               self._h2.local_flow_control_window(stream.id) > 0)
+                    if stream.ended:
+                        # The server has answered, or reset the stream,
+                        # without waiting for the rest of the body
+                        return
+                    size = min(len(data), self._h2.max_outbound_frame_size,
+                               self._h2.local_flow_control_window(stream.id))
+                    self._h2.send_data(stream.id, data[:size])
+                    self._send_pending()
+                data = data[size:]
+        with self._lock:
+            if not stream.ended:
+                self._h2.end_stream(stream.id)
+                self._send_pending()
+
+    def get_headers(self, stream):
+        """ Wait for, and return, the response headers for a stream """
+        with self._lock:
+            self._wait(lambda: stream.headers is not None or stream.ended,
+                       self._deadline())
+            if stream.headers is None:
+                self._forget(stream)
+                raise urllib2.URLError(stream.error or 'no response headers')
+            return stream.headers
+
+    def read_chunk(self, stream):
+        """ Return the next piece of a stream's body, or '' at the end """
+        with self._lock:
+            self._wait(lambda: stream.chunks or stream.ended,
+                       self._deadline())
+            if not stream.chunks:
+                self._forget(stream)
+                if stream.error is not None:
+                    raise urllib2.URLError(stream.error)
+                return ''
+            data, length = stream.chunks.popleft()
+            # Only let the server send more once we've taken this off its
+            # hands, so an unread body can't fill up memory
+            self._h2.acknowledge_received_data(length, stream.id)
+            self._send_pending()
+            return data
+
+    def cancel(self, stream):
+        """ Stop receiving a stream's response """
+        with self._lock:
+            if not stream.ended and not self.closed:
+                self._h2.reset_stream(stream.id, h2.errors.ErrorCodes.CANCEL)
+                self._send_pending()
+            stream.ended = True
+            self._forget(stream)
+
+    def _forget(self, stream):
+        self._streams.pop(stream.id, None)
+
+    def close(self):
+        with self._lock:
+            if not self.closed:
+                self.closed = True
+                try:
+                    self._h2.close_connection()
+                    self._send_pending()
+                except (socket.error, h2.exceptions.ProtocolError):
+                    pass
+                self.sock.close()
+
+
+class HTTP2Response(object):
+    """
+    The response to a request made over HTTP/2, with the urllib2 response
+    API. The body is read from the stream as it's asked for.
+    """
+
+    protocol = PROTOCOL
+
+    def __init__(self, conn, stream, url, timings):
+        self._conn = conn
+        self._stream = stream
+        self._buffer = ''
+        self._eof = False
+        self.url = url
+        self.timings = timings
+        headers = conn.get_headers(stream)
+        lines = []
+        for name, value in headers:
+            if name == ':status':
+                self.code = int(value)
+            elif not name.startswith(':'):
+                lines.append('%s: %s\r\n' % (name, value))
+        self.msg = httplib.responses.get(self.code, '')
+        self.headers = httplib.HTTPMessage(StringIO.StringIO(''.join(lines)))
+        self._headers_received = time.time()
+
+    def _fill(self, wanted=None):
+        while not self._eof and (wanted is None or len(self._buffer) < wanted):
+            data = self._conn.read_chunk(self._stream)
+            if not data:
+                self._eof = True
+                self.timings.transfer = time.time() - self._headers_received
+            self._buffer += data
+
+    def read(self, amt=-1):
+        if amt is None or amt < 0:
+            self._fill()
+            data, self._buffer = self._buffer, ''
+            return data
+        self._fill(amt)
+        data, self._buffer = self._buffer[:amt], self._buffer[amt:]
+        return data
+
+    def readline(self, limit=-1):
+        while True:
+            end = self._buffer.find('\n') + 1
+            if end or self._eof or 0 < limit <= len(self._buffer):
+                break
+            self._fill(len(self._buffer) + 1)
+        if not end:
+            end = len(self._buffer)
+        if limit >= 0:
+            end = min(end, limit)
+        line, self._buffer = self._buffer[:end], self._buffer[end:]
+        return line
+
+    def readlines(self, sizehint=0):
+        return list(self)
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+    def info(self):
+        return self.headers
+
+    def geturl(self):
+        return self.url
+
+    def getcode(self):
+        return self.code
+
+    def close(self):
+        if not self._eof:
+            self._eof = True
+            self._conn.cancel(self._stream)
+
+
+class HTTP2Handler(urllib2.BaseHandler):
+    """
+    Sends requests marked with `http2` over a shared HTTP/2 connection per
+    host. Anything else, including https:// hosts that won't agree to
+    HTTP/2, is left for the HTTP/1.1 handlers.
+    """
+
+    # Ahead of the keep-alive HTTP/1.1 handlers
+    handler_order = 450
+
+    def __init__(self, resolver=None):
+        self.resolver = resolver
+        self._connections = {}
+        self._http1_hosts = set()
+        self._lock = threading.Lock()
+
+    def http_open(self, req):
+        return self._open(req, False)
+
+    def https_open(self, req):
+        return self._open(req, True)
+
+    def _open(self, req, secure):
+        if not getattr(req, 'http2', False):
+            return None
+        if h2 is None:
+            raise urllib2.URLError('HTTP/2 needs the h2 package: pip install h2')
+        host = req.get_host()
+        key = (secure, host)
+        if key in self._http1_hosts:
+            return None
+        timings = pyrrhic.http.Timings()
+        try:
+            conn, reused = self._connection(key, req.timeout, timings)
+        except NotNegotiated:
+            self._http1_hosts.add(key)
+            return None
+        except (socket.error, ssl.SSLError, h2.exceptions.ProtocolError), e:
+            raise urllib2.URLError(e)
+        timings.reused = reused
+        headers = dict(req.unredirected_hdrs)
+        headers.update(req.headers)
+        sent = time.time()
+        stream = conn.request(req.get_method(), host, req.get_selector(),
+                              headers, req.data)
+        response = HTTP2Response(conn, stream, req.get_full_url(), timings)
+        timings.ttfb = response._headers_received - sent
+        req.timings = timings
+        return response
+
+    def _connection(self, key, timeout, timings):
+        with self._lock:
+            conn = self._connections.get(key)
+            if conn is not None and not conn.closed:
+                return conn, True
+            secure, host = key
+            conn = HTTP2Connection(host, secure, timeout, self.resolver)
+            conn.connect(timings)
+            self._connections[key] = conn
+            return conn, False
+
+    def stats(self):
+        """ Return (secure, host, open streams) for each live connection """
+        with self._lock:
+            return [(secure, host, len(conn._streams))
+                    for (secure, host), conn in sorted(self._connections.items())
+                    if not conn.closed]
+
+    def clear(self):
+        with self._lock:
+            for conn in self._connections.values():
+                conn.close()
+            self._connections.clear()
@@ -0,0 +1,199 @@
+import collections
+import Queue
+import sys
+import threading
+
+
+class Job(object):
+    """
+    A function call running in a background thread. `result()` waits for
+    it to finish and returns its return value, or re-raises its exception.
+    """
+
+    def __init__(self, func, *args, **kw):
+        self.id = None
+        self.description = None
+        self.output = []
+        self._func = func
+        self._args = args
+        self._kw = kw
+        self._result = None
+        self.exc_info = None
+        self._done = threading.Event()
+        self._callbacks = []
+
+    def start(self):
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def _run(self):
+        try:
+            self._result = self._func(*self._args, **self._kw)
+        except:
+            self.exc_info = sys.exc_info()
+        for callback in self._callbacks:
+            callback(self)
+        self._done.set()
+
+    def add_done_callback(self, callback):
+        """
+        Arrange for callback(job) to be called from the job's thread when
+        it finishes. Must be called before the job is started.
+        """
+        self._callbacks.append(callback)
+
+    def done(self):
+        """ Whether the job, and any callbacks, have finished """
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        self._done.wait(timeout)
+        return self.done()
+
+    def result(self, timeout=None):
+        if not self.wait(timeout):
+            raise RuntimeError, 'Job has not finished'
+        if self.exc_info is not None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self._result
+
+
+def submit(func, *args, **kw):
+    """ Start func(*args, **kw) in the background, returning a `Job` """
+    return Job(func, *args, **kw).start()
+
+
+def parallel_map(func, items, concurrency):
+    """
+    Call func(item) for each item, with up to `concurrency` calls running
+    at once. Returns the results in the same order as the items.
+    """
+    return list(imap(func, items, concurrency))
+
+
+def imap(func, items, concurrency):
+    """
+    Like `parallel_map`, but returns an iterator, which yields each result
+    as soon as it and those before it are ready. The calls are made by up
+    to `concurrency` threads, which take them from a queue, and items are
+    only taken from `items` as threads are free to start on them.
+    """
+    if concurrency == 1:
+        for item in items:
+            yield func(item)
+        return
+    calls = Queue.Queue()
+    workers = []
+    pending = collections.deque()
+
+    def worker():
+        while True:
+            job = calls.get()
+            if job is None:
+                return
+            job._run()
+
+    try:
+        for item in items:
+            if len(pending) >= concurrency:
+                yield pending.popleft().result()
+            job = Job(func, item)
+            pending.append(job)
+            if len(workers) < concurrency:
+                workers.append(submit(worker))
+            calls.put(job)
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        # Let the workers go, even if the caller stopped early
+        for job in workers:
+            calls.put(None)
+
+
+class ThreadOutput(object):
+    """
+    Stands in for sys.stdout and sys.stderr. Writes from a job's thread
+    are collected in that job's output, so they can be shown together when
+    it finishes. Everything else goes to the real stream.
+    """
+
+    def __init__(self, manager, stream):
+        self._manager = manager
+        self.stream = stream
+
+    def write(self, data):
+        job = self._manager.current()
+        if job is None:
+            self.stream.write(data)
+        else:
+            job.output.append(data)
+
+    def flush(self):
+        if self._manager.current() is None:
+            self.stream.flush()
+
+
+class JobManager(object):
+    """
+    Runs console commands in the background and numbers them, so their
+    output can be tagged with a job id as they finish.
+    """
+
+    def __init__(self):
+        self.jobs = {}
+        self._next_id = 1
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def current(self):
+        """ Return the job running in the current thread, if any """
+        return getattr(self._local, 'job', None)
+
+    def _install(self):
+        if not isinstance(sys.stdout, ThreadOutput):
+            sys.stdout = ThreadOutput(self, sys.stdout)
+        if not isinstance(sys.stderr, ThreadOutput):
+            sys.stderr = ThreadOutput(self, sys.stderr)
+
+    def start(self, description, func, *args, **kw):
+        """
+        Run func(*args, **kw) in the background, returning the `Job`. The
+        optional `on_done` keyword is called with the job once it has
+        finished.
+        """
+        on_done = kw.pop('on_done', None)
+        with self._lock:
+            self._install()
+            job_id = self._next_id
+            self._next_id += 1
+
+        def run():
+            self._local.job = job
+            try:
+                return func(*args, **kw)
+            finally:
+                self._local.job = None
+
+        job = Job(run)
+        job.id = job_id
+        job.description = description
+        job.add_done_callback(self._finished)
+        if on_done is not None:
+            job.add_done_callback(on_done)
+        with self._lock:
+            self.jobs[job_id] = job
+        return job.start()
+
+    def _finished(self, job):
+        with self._lock:
+            del self.jobs[job.id]
+
+    def running(self):
+        """ Return the jobs that haven't finished yet, oldest first """
+        with self._lock:
+            return [job for job_id, job in sorted(self.jobs.items())]
+
+
+manager = JobManager()
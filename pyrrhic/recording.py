@@ -0,0 +1,440 @@
+"""
+Records requests and responses, and replays them.
+
+A recording is two files. The log, one JSON object per line, holds each
+request and response much as a HAR file would: method, URL, headers,
+status and timings. Bodies are appended to a second file, FILE.bodies,
+and the log refers to them by offset and length, so reading through the
+log stays quick however big the bodies are. When replaying, the log is
+read a line at a time and the bodies file is memory-mapped, so neither
+has to fit in memory.
+"""
+import httplib
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
+import urllib2
+import urlparse
+
+import pyrrhic.bench
+import pyrrhic.http
+import pyrrhic.streaming
+
+HEADER = 'pyrrhic-recording 1\n'
+
+# Bodies bigger than this are spooled to a temporary file, rather than
+# held in memory, until they're appended to the bodies file
+SPOOL_SIZE = 1024 * 1024
+
+# Request headers that belong to the connection the request was sent on,
+# or are worked out again when it's replayed
+REPLAY_SKIPPED_HEADERS = ('host', 'content-length', 'transfer-encoding',
+                          'connection', 'keep-alive', 'accept-encoding')
+
+
+def bodies_path(path):
+    return path + '.bodies'
+
+
+def _str(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def _ms(seconds):
+    # HAR style: milliseconds, or -1 for a phase that didn't happen
+    if seconds is None:
+        return -1
+    return round(seconds * 1000, 3)
+
+
+def _header_list(message):
+    # The headers of an HTTPMessage as [name, value] pairs, in the order
+    # and case they came in
+    headers = []
+    for line in message.headers:
+        if line[:1].isspace() and headers:
+            # A continuation line
+            headers[-1][1] += ' ' + line.strip()
+        else:
+            name, _, value = line.partition(':')
+            headers.append([name.strip(), value.strip()])
+    return headers
+
+
+class Recording(object):
+    """ Appends exchanges to a recording's log and bodies files """
+
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        self.closed = False
+        self._lock = threading.Lock()
+        self._log = self._open(path)
+        if os.fstat(self._log.fileno()).st_size == 0:
+            self._log.write(HEADER)
+            self._log.flush()
+        self._bodies = self._open(bodies_path(path))
+        self._offset = os.fstat(self._bodies.fileno()).st_size
+
+    def _open(self, path):
+        # Recordings can hold passwords and cookies, so keep them private
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0600)
+        return os.fdopen(fd, 'ab')
+
+    def _append_body(self, spool):
+        # Called with the lock held
+        if spool is None:
+            return None
+        import shutil
+        size = spool.tell()
+        spool.seek(0)
+        shutil.copyfileobj(spool, self._bodies)
+        spool.close()
+        ref = [self._offset, size]
+        self._offset += size
+        return ref
+
+    def add(self, entry, request_body=None, response_body=None):
+        """
+        Add an exchange, as a dict in the log's format. The bodies are
+        spooled files (see `spool`), positioned at their ends.
+        """
+        with self._lock:
+            if self.closed:
+                # Recording was switched off while the body was being read
+                return
+            entry['request']['body'] = self._append_body(request_body)
+            entry['response']['body'] = self._append_body(response_body)
+            # The bodies have to be there before the log refers to them
+            self._bodies.flush()
+            # Without sort_keys, so that json's C encoder is used
+            self._log.write(json.dumps(entry) + '\n')
+            self._log.flush()
+            self.count += 1
+
+    def close(self):
+        with self._lock:
+            self.closed = True
+            self._log.close()
+            self._bodies.close()
+
+
+def spool():
+    """ A temporary file to collect a body in as it's sent or read """
+    return tempfile.SpooledTemporaryFile(SPOOL_SIZE)
+
+
+class RecordingResponse(object):
+    """
+    Wraps a response, keeping a copy of the body as it's read. The
+    exchange is recorded once the body has been read, or the response is
+    closed.
+    """
+
+    def __init__(self, response, finish):
+        self._response = response
+        self._finish = finish
+        self._body = spool()
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+    def _keep(self, data, eof):
+        if self._body is None:
+            return
+        self._body.write(data)
+        if eof:
+            body, self._body = self._body, None
+            self._finish(self._response, body)
+
+    def read(self, amt=-1):
+        data = self._response.read(amt)
+        self._keep(data, amt is None or amt < 0 or not data)
+        return data
+
+    def readline(self, limit=-1):
+        data = self._response.readline(limit)
+        self._keep(data, not data)
+        return data
+
+    def readlines(self, sizehint=0):
+        lines = []
+        while True:
+            line = self.readline()
+            if not line:
+                return lines
+            lines.append(line)
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+    def close(self):
+        # Record what was read, if the body wasn't read to the end
+        self._keep('', True)
+        self._response.close()
+
+
+class RecordingHandler(urllib2.BaseHandler):
+    """
+    Records every request and response to the current `Recording`, if
+    there is one. Switched off until `start()` is called.
+    """
+
+    # Run after the cache and decompression, so that what's recorded is
+    # what was printed, including responses that came from the cache
+    handler_order = 450
+
+    def __init__(self):
+        self.recording = None
+
+    def start(self, path):
+        self.stop()
+        self.recording = Recording(path)
+
+    def stop(self):
+        recording, self.recording = self.recording, None
+        if recording is not None:
+            recording.close()
+
+    def http_request(self, req):
+        if self.recording is None:
+            return req
+        req.recording_started = time.time()
+        if isinstance(req.data, pyrrhic.streaming.Upload):
+            req.data.tee = spool()
+        return req
+
+    https_request = http_request
+
+    def http_response(self, req, response):
+        recording = self.recording
+        started = getattr(req, 'recording_started', None)
+        if recording is None or started is None:
+            return response
+
+        def finish(response, response_body):
+            if isinstance(req.data, pyrrhic.streaming.Upload):
+                request_body = req.data.tee
+                req.data.tee = None
+            elif req.data is not None:
+                request_body = spool()
+                request_body.write(req.data)
+            else:
+                request_body = None
+            recording.add(self._entry(req, response, started),
+                          request_body, response_body)
+        return RecordingResponse(response, finish)
+
+    https_response = http_response
+
+    def _entry(self, req, response, started):
+        timings = getattr(response, 'timings', None) or pyrrhic.http.Timings()
+        protocol = getattr(response, 'protocol', None)
+        return {
+            'started': started,
+            'time': _ms(time.time() - started),
+            'request': {
+                'method': req.get_method(),
+                'url': req.get_full_url(),
+                'headers': sorted(req.header_items()),
+            },
+            'response': {
+                'status': response.code,
+                'statusText': response.msg,
+                'httpVersion': isinstance(protocol, str) and protocol or None,
+                'headers': _header_list(response.info()),
+                'fromCache': getattr(response, 'from_cache', False),
+            },
+            'timings': {
+                'dns': _ms(timings.dns),
+                'connect': _ms(timings.connect),
+                'ssl': _ms(timings.tls),
+                'wait': _ms(timings.ttfb),
+                'receive': _ms(timings.transfer),
+            },
+        }
+
+
+class Entry(object):
+    """ One recorded exchange, read from a `RecordingLog` """
+
+    def __init__(self, log, data):
+        self._log = log
+        self.started = data['started']
+        request = data['request']
+        response = data['response']
+        self.method = _str(request['method'])
+        self.url = _str(request['url'])
+        self.headers = [(_str(name), _str(value))
+                        for name, value in request['headers']]
+        self.status = response['status']
+        self._request_body = request['body']
+        self._response_body = response['body']
+
+    def request_body(self):
+        return self._log.body(self._request_body)
+
+    def response_body(self):
+        return self._log.body(self._response_body)
+
+
+class RecordingLog(object):
+    """
+    Reads a recording. Iterating over it reads the log a line at a time,
+    yielding an `Entry` for each exchange.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._map = None
+        self._lock = threading.Lock()
+        f = open(path, 'rb')
+        try:
+            if f.readline() != HEADER:
+                raise ValueError, '%s is not a pyrrhic recording' % path
+        finally:
+            f.close()
+
+    def __iter__(self):
+        f = open(self.path, 'rb')
+        try:
+            f.readline()
+            for line in f:
+                if line.endswith('\n'):
+                    yield Entry(self, json.loads(line))
+        finally:
+            f.close()
+
+    def body(self, ref):
+        """ Return a body from the bodies file, given its offset and length """
+        if ref is None:
+            return None
+        offset, length = ref
+        if not length:
+            return ''
+        with self._lock:
+            if self._map is None or offset + length > len(self._map):
+                # Not mapped yet, or the recording has grown since
+                self._remap()
+            return self._map[offset:offset + length]
+
+    def _remap(self):
+        import mmap
+        self.close()
+        f = open(bodies_path(self.path), 'rb')
+        try:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+
+def rebase(url, base):
+    """ Point a recorded URL at the scheme and host of `base`, a Resource """
+    if base is None:
+        return url
+    parsed = urlparse.urlparse(url)
+    return urlparse.urlunparse((base.parsed_url.scheme, base.parsed_url.netloc)
+                               + parsed[2:])
+
+
+class ReplayResult(pyrrhic.bench.BenchResult):
+    """ A `BenchResult`, that also counts statuses that weren't as recorded """
+
+    def _reset(self):
+        pyrrhic.bench.BenchResult._reset(self)
+        self.differed = 0
+
+    def merge(self, other):
+        pyrrhic.bench.BenchResult.merge(self, other)
+        with self._lock:
+            self.differed += other.differed
+
+    def report(self):
+        lines = pyrrhic.bench.BenchResult.report(self)
+        lines.append('Mismatched:   %d (status not as recorded)' % self.differed)
+        return lines
+
+
+def replay_entry(entry, base, opener, result):
+    """ Send a recorded request again, and record how it went in `result` """
+    request = pyrrhic.http.Request(rebase(entry.url, base),
+                                   data=entry.request_body(),
+                                   req_method=entry.method)
+    for name, value in entry.headers:
+        if name.lower() not in REPLAY_SKIPPED_HEADERS:
+            request.add_header(name, value)
+    if base is not None:
+        for name, value in base._headers.items():
+            request.add_header(name, value)
+        request.http2 = base.http2
+        request.rate_limit = base.rate_limit
+    start = time.time()
+    try:
+        response = opener.open(request)
+        size = pyrrhic.bench.drain(response)
+    except (urllib2.URLError, socket.error, httplib.HTTPException), e:
+        result.record(time.time() - start, error=e.__class__.__name__)
+        return
+    result.record(time.time() - start, response.code, size)
+    if response.code != entry.status:
+        with result._lock:
+            result.differed += 1
+
+
+def replay(log, opener, base=None, concurrency=1, paced=False):
+    """
+    Send the requests in a `RecordingLog` again, over `concurrency`
+    threads, returning a `ReplayResult`. `base` is a Resource to send them
+    to instead of the recorded host, with its headers. `paced` keeps the
+    gaps between requests that were recorded; otherwise they're sent as
+    fast as the threads allow.
+    """
+    result = ReplayResult(concurrency)
+    entries = iter(log)
+    lock = threading.Lock()
+    stopped = threading.Event()
+    first = []
+    start = time.time()
+
+    def worker():
+        while not stopped.is_set():
+            with lock:
+                try:
+                    entry = entries.next()
+                except StopIteration:
+                    return
+                if not first:
+                    first.append(entry.started)
+            if paced:
+                due = start + entry.started - first[0]
+                while not stopped.is_set() and time.time() < due:
+                    time.sleep(min(due - time.time(), 0.1))
+                if stopped.is_set():
+                    return
+            replay_entry(entry, base, opener, result)
+
+    threads = [threading.Thread(target=worker) for i in range(concurrency)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    try:
+        for thread in threads:
+            # Join with a timeout so that Ctrl-C still gets through
+            while thread.is_alive():
+                thread.join(0.1)
+    except KeyboardInterrupt:
+        stopped.set()
+        for thread in threads:
+            thread.join()
+    result.elapsed = time.time() - start
+    return result
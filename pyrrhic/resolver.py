@@ -0,0 +1,119 @@
+"""
+Caches DNS lookups, so that new connections to a host don't wait on the
+system resolver every time, and resolves hosts (and optionally connects
+to them) ahead of the first request.
+"""
+import socket
+import threading
+import time
+import urllib
+
+import pyrrhic.http
+
+# Seconds a lookup is kept. getaddrinfo doesn't tell us the record's own
+# TTL, so this is a compromise between following DNS changes and lookups.
+DEFAULT_TTL = 60.0
+
+
+class CachedLookup(object):
+    """ The addresses getaddrinfo gave for a host and port, and when """
+
+    def __init__(self, addresses, expires):
+        self.addresses = addresses
+        self.expires = expires
+        self.hits = 0
+
+
+class DNSCache(object):
+    """
+    Keeps the results of getaddrinfo for `ttl` seconds. Lookups that fail
+    aren't kept, so a host that's down or mistyped is looked up again next
+    time.
+    """
+
+    def __init__(self, ttl=DEFAULT_TTL):
+        self.ttl = ttl
+        self._lookups = {}
+        self._lock = threading.Lock()
+
+    def resolve(self, host, port):
+        """ getaddrinfo for a TCP connection, from the cache if we can """
+        key = (host.lower(), port)
+        now = time.time()
+        with self._lock:
+            lookup = self._lookups.get(key)
+            if lookup is not None and lookup.expires > now:
+                lookup.hits += 1
+                return lookup.addresses
+        addresses = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+        if self.ttl > 0:
+            with self._lock:
+                self._lookups[key] = CachedLookup(addresses, now + self.ttl)
+        return addresses
+
+    def forget(self, host, port):
+        """ Drop a lookup, e.g. when none of its addresses would connect """
+        with self._lock:
+            self._lookups.pop((host.lower(), port), None)
+
+    def flush(self, host=None):
+        """ Drop the lookups for `host`, or all of them. Returns how many. """
+        with self._lock:
+            keys = [key for key in self._lookups
+                    if host is None or key[0] == host.lower()]
+            for key in keys:
+                del self._lookups[key]
+            return len(keys)
+
+    def entries(self):
+        """
+        Return a list of (host, port, addresses, seconds left, hits) for
+        the lookups that haven't expired, with the addresses as strings
+        """
+        now = time.time()
+        with self._lock:
+            result = []
+            for (host, port), lookup in sorted(self._lookups.items()):
+                if lookup.expires <= now:
+                    continue
+                addresses = []
+                for address in lookup.addresses:
+                    if address[4][0] not in addresses:
+                        addresses.append(address[4][0])
+                result.append((host, port, addresses, lookup.expires - now,
+                               lookup.hits))
+            return result
+
+
+def _prewarm(resource, resolver, pool):
+    url = resource.parsed_url
+    host, port = url.hostname, url.port
+    try:
+        resolver.resolve(host, port)
+        if pool is None or resource.http2 or \
+                urllib.getproxies().get(url.scheme):
+            # The connection wouldn't be the one that's used
+            return
+        if url.scheme == 'https':
+            conn = pyrrhic.http.TimedHTTPSConnection(url.netloc)
+        else:
+            conn = pyrrhic.http.TimedHTTPConnection(url.netloc)
+        conn.resolver = resolver
+        conn.connect()
+    except (socket.error, IOError):
+        # The request will fail, or succeed, in its own right
+        return
+    pool.add((url.scheme, url.netloc), conn)
+
+
+def prewarm(resource, resolver, pool=None):
+    """
+    Look up a resource's host in the background, and if `pool` is given,
+    open a connection to it and leave it idle in the pool, so that the
+    first request doesn't have to wait for either. Returns the thread.
+    """
+    thread = threading.Thread(target=_prewarm,
+                              args=(resource, resolver, pool))
+    thread.daemon = True
+    thread.start()
+    return thread
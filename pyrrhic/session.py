@@ -0,0 +1,269 @@
+"""
+Saves resources, named payloads and templates between runs of pyr.
+
+A session file is a log of records, one per line::
+
+  KIND<tab>NAME<tab>JSON
+
+Changes are appended, so saving never rewrites the file, and a later record
+for a name replaces an earlier one. A record with no JSON deletes the name.
+Loading only splits each line into its kind and name; the JSON is parsed,
+and the object built, when the name is first used.
+"""
+import base64
+import json
+import os
+import threading
+import UserDict
+
+import pyrrhic
+import pyrrhic.templates
+
+DEFAULT_PATH = os.path.join('~', '.pyrrhic-session')
+
+HEADER = 'pyrrhic-session 1\n'
+
+# Rewrite the file when loading if it has more than this many records...
+COMPACT_MIN_RECORDS = 1000
+
+# ...and fewer than this fraction of them are still current
+COMPACT_LIVE_FRACTION = 0.5
+
+
+def _str(value):
+    # json gives back unicode, but the rest of pyrrhic (and httplib) expects
+    # byte strings
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+class SessionStore(object):
+    """
+    The raw records of a session file, indexed by kind and name. Holds
+    each record's JSON text, unparsed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._records = {}
+        self._count = 0
+        self._file = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return self
+        f = open(self.path, 'rb')
+        try:
+            data = f.read()
+        finally:
+            f.close()
+        if not data.startswith(HEADER):
+            raise ValueError, '%s is not a pyrrhic session file' % self.path
+        for line in data[len(HEADER):].splitlines():
+            kind, _, rest = line.partition('\t')
+            name, _, text = rest.partition('\t')
+            self._count += 1
+            if text:
+                self._records[(kind, name)] = text
+            else:
+                self._records.pop((kind, name), None)
+        if self._count > COMPACT_MIN_RECORDS and \
+                len(self._records) < self._count * COMPACT_LIVE_FRACTION:
+            self.compact()
+        return self
+
+    def get(self, kind, name):
+        """ Return the JSON text for a record, or None """
+        return self._records.get((kind, name))
+
+    def names(self, kind):
+        return sorted(n for k, n in self._records if k == kind)
+
+    def put(self, kind, name, text):
+        """ Save a record; a `text` of None deletes it """
+        with self._lock:
+            if text is None:
+                if self._records.pop((kind, name), None) is None:
+                    return
+                self._append('%s\t%s\t\n' % (kind, name))
+            else:
+                self._records[(kind, name)] = text
+                self._append('%s\t%s\t%s\n' % (kind, name, text))
+
+    def _open(self, path, flags):
+        # Sessions can hold passwords, so keep them private
+        fd = os.open(path, flags, 0600)
+        empty = os.fstat(fd).st_size == 0
+        f = os.fdopen(fd, 'ab')
+        if empty:
+            f.write(HEADER)
+        return f
+
+    def _append(self, line):
+        if self._file is None:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            self._file = self._open(self.path,
+                                    os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+        self._file.write(line)
+        self._file.flush()
+        self._count += 1
+
+    def compact(self):
+        """ Rewrite the file with only the current records """
+        self.close()
+        temp = self.path + '.tmp'
+        f = self._open(temp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+        try:
+            for (kind, name), text in sorted(self._records.items()):
+                f.write('%s\t%s\t%s\n' % (kind, name, text))
+        finally:
+            f.close()
+        os.rename(temp, self.path)
+        self._count = len(self._records)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class StoredMapping(UserDict.DictMixin):
+    """
+    A dictionary whose values are saved in a `SessionStore`. Values are
+    only decoded when they're first looked up.
+    """
+
+    kind = None
+
+    def __init__(self, store):
+        self._store = store
+        self._loaded = {}
+
+    def encode(self, value):
+        return value
+
+    def decode(self, data):
+        return _str(data)
+
+    def _dumps(self, value):
+        return json.dumps(self.encode(value), sort_keys=True)
+
+    def __getitem__(self, name):
+        try:
+            return self._loaded[name]
+        except KeyError:
+            pass
+        text = self._store.get(self.kind, name)
+        if text is None:
+            raise KeyError, name
+        value = self._loaded[name] = self.decode(json.loads(text))
+        return value
+
+    def __setitem__(self, name, value):
+        self._loaded[name] = value
+        self._store.put(self.kind, name, self._dumps(value))
+
+    def __delitem__(self, name):
+        if name not in self:
+            raise KeyError, name
+        self._loaded.pop(name, None)
+        self._store.put(self.kind, name, None)
+
+    def __contains__(self, name):
+        return self._store.get(self.kind, name) is not None
+
+    has_key = __contains__
+
+    def keys(self):
+        return self._store.names(self.kind)
+
+    def sync(self):
+        """
+        Save any values that have been changed in place, e.g. a resource
+        that has had authentication added, since they were loaded or set.
+        """
+        for name, value in self._loaded.items():
+            text = self._dumps(value)
+            if text != self._store.get(self.kind, name):
+                self._store.put(self.kind, name, text)
+
+
+class StoredResources(StoredMapping):
+
+    kind = 'resource'
+
+    def encode(self, resource):
+        return {
+            'url': resource.url,
+            'headers': resource._headers,
+            'auth': resource.has_authentication,
+            'http2': resource.http2,
+            'rate_limit': resource.rate_limit and [resource.rate_limit.rate,
+                                                   resource.rate_limit.burst],
+        }
+
+    def decode(self, data):
+        resource = pyrrhic.Resource(_str(data['url']))
+        resource._headers = dict((_str(k), _str(v))
+                                 for k, v in data['headers'].items())
+        resource.has_authentication = data['auth']
+        resource.http2 = data.get('http2', False)
+        if data.get('rate_limit'):
+            from pyrrhic.throttling import TokenBucket
+            rate, burst = data['rate_limit']
+            resource.rate_limit = TokenBucket(rate, burst)
+        return resource
+
+
+class StoredPayloads(StoredMapping):
+
+    kind = 'payload'
+
+
+class StoredTemplates(StoredMapping):
+
+    kind = 'template'
+
+    def encode(self, template):
+        return {
+            'path': template.path,
+            'headers': template.headers,
+            # Bodies from files can be any bytes, which JSON can't hold
+            'body64': template.body is not None and
+                      base64.b64encode(template.body) or None,
+            'form': template.form,
+            'data': template.data,
+        }
+
+    def decode(self, data):
+        body = data.get('body64')
+        if body is not None:
+            body = base64.b64decode(body)
+        # A data file is only read when the template is first used
+        return pyrrhic.templates.Template(
+            _str(data['path']),
+            [(_str(name), _str(value)) for name, value in data['headers']],
+            body, data['form'], _str(data['data']))
+
+
+class Session(object):
+    """ Resources, named payloads and templates, saved in a session file """
+
+    def __init__(self, path):
+        self.store = SessionStore(path).load()
+        self.resources = StoredResources(self.store)
+        self.payloads = StoredPayloads(self.store)
+        self.templates = StoredTemplates(self.store)
+
+    def sync(self):
+        self.resources.sync()
+        self.payloads.sync()
+        self.templates.sync()
+
+    def close(self):
+        self.sync()
+        self.store.close()
@@ -0,0 +1,105 @@
+"""
+Measures how long pyr takes to start: how long each module takes to
+import, including what it does at import time, and how long the command
+then takes to run. `pyr --profile-startup` runs pyr again in a new Python
+process with this module as the script, so that nothing has been imported
+yet when the timing starts. For the same reason, this module mustn't
+import any of pyrrhic itself at the top.
+"""
+import __builtin__
+import os
+import sys
+import time
+
+# Modules shown in the report, slowest first
+REPORT_MODULES = 30
+
+
+class ImportTimer(object):
+    """
+    Times every import while installed, keeping, for each module that
+    was loaded, the time spent in the import itself and the time including
+    the modules it imported in turn.
+    """
+
+    def __init__(self):
+        self.modules = []
+        self._import = None
+        # The time spent in nested imports, for each import in progress
+        self._nested = []
+
+    def install(self):
+        self._import = __builtin__.__import__
+        __builtin__.__import__ = self._timed_import
+
+    def uninstall(self):
+        __builtin__.__import__ = self._import
+
+    def _timed_import(self, name, *args, **kwargs):
+        loaded = len(sys.modules)
+        self._nested.append(0.0)
+        start = time.time()
+        try:
+            return self._import(name, *args, **kwargs)
+        finally:
+            total = time.time() - start
+            nested = self._nested.pop()
+            if self._nested:
+                self._nested[-1] += total
+            if len(sys.modules) > loaded:
+                # Imports of modules that were already loaded are skipped
+                self.modules.append((total - nested, total, name))
+
+    def report(self, limit=REPORT_MODULES):
+        """ Lines listing the slowest `limit` modules to import """
+        lines = ['%8s  %8s  %s' % ('self ms', 'total ms', 'module')]
+        for own, total, name in sorted(self.modules, reverse=True)[:limit]:
+            lines.append('%8.1f  %8.1f  %s' % (own * 1000, total * 1000, name))
+        return lines
+
+
+def profile(argv):
+    """
+    Run pyr with the arguments `argv` in a new Python process, which
+    reports how long it took to start, on stderr. Returns its exit status.
+    """
+    import subprocess
+    script = os.path.splitext(os.path.abspath(__file__))[0] + '.py'
+    start = time.time()
+    status = subprocess.call([sys.executable, script] + list(argv))
+    print >> sys.stderr, '%8.1f  in all, including starting Python' % (
+        (time.time() - start) * 1000)
+    return status
+
+
+def main(argv):
+    timer = ImportTimer()
+    start = time.time()
+    timer.install()
+    status = 0
+    try:
+        import pyrrhic.ui
+        imported = time.time()
+        try:
+            pyrrhic.ui.console(argv)
+        except SystemExit, e:
+            status = e.code
+    finally:
+        finished = time.time()
+        timer.uninstall()
+    out = sys.stderr
+    print >> out
+    for line in timer.report():
+        print >> out, line
+    print >> out
+    print >> out, '%8.1f  importing pyrrhic.ui' % ((imported - start) * 1000)
+    print >> out, '%8.1f  running pyr' % ((finished - imported) * 1000)
+    return status
+
+
+if __name__ == '__main__':
+    # Python puts this module's directory first on the path, where the
+    # modules of pyrrhic would hide any of the standard library's with
+    # the same names. Import pyrrhic from the directory above instead.
+    sys.path[0] = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    sys.exit(main(sys.argv[1:]))
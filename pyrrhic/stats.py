@@ -0,0 +1,259 @@
+"""
+Keeps a running summary of every request: how many there were, how long
+they took and how big the responses were, for each resource and status
+class. Latencies and sizes go into histograms, and rates into a ring of
+per-second counts, so the summary takes the same memory however many
+requests are made.
+"""
+import threading
+import time
+import urllib2
+
+import pyrrhic.histogram
+
+# Seconds of per-second counts kept, and the seconds rates are shown over
+WINDOW = 60
+RATE_WINDOW = 10
+
+# Classes in the order they're shown; 'error' is for requests that got no
+# response at all
+STATUS_CLASSES = ('1xx', '2xx', '3xx', '4xx', '5xx', 'error')
+
+# Classes counted as errors for the error rate
+ERROR_CLASSES = ('5xx', 'error')
+
+
+def status_class(status):
+    if status is None:
+        return 'error'
+    try:
+        return STATUS_CLASSES[status // 100 - 1]
+    except IndexError:
+        return '%dxx' % (status // 100)
+
+
+class RateCounter(object):
+    """ Counts for each of the last `window` seconds, in a ring """
+
+    def __init__(self, window=WINDOW):
+        self._counts = [0] * window
+        self._seconds = [None] * window
+
+    def add(self, now, count=1):
+        second = int(now)
+        i = second % len(self._counts)
+        if self._seconds[i] != second:
+            self._seconds[i] = second
+            self._counts[i] = 0
+        self._counts[i] += count
+
+    def merge(self, other):
+        """ Add the counts of another ring, for seconds this one still has """
+        for second, count in zip(other._seconds, other._counts):
+            if second is None:
+                continue
+            at = self._seconds[second % len(self._counts)]
+            if at is None or at <= second:
+                self.add(second, count)
+
+    def total(self, now, seconds):
+        """ The count for the `seconds` whole seconds before `now` """
+        second = int(now)
+        return sum(count for at, count in zip(self._seconds, self._counts)
+                   if at is not None and second - seconds <= at < second)
+
+
+class Series(object):
+    """ The requests to one resource that got one class of status """
+
+    def __init__(self):
+        self.latency = pyrrhic.histogram.Histogram()
+        self.size = pyrrhic.histogram.Histogram(scale=1)
+        self.rate = RateCounter()
+
+    def merge(self, other):
+        self.latency.merge(other.latency)
+        self.size.merge(other.size)
+        self.rate.merge(other.rate)
+
+
+class Stats(object):
+    """
+    The summary of every request since the start, or since clear(). Each
+    is recorded under a label for its resource (see `StatsHandler`).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self.series = {}
+            self.started = time.time()
+
+    def record(self, label, status, latency, size=0, now=None):
+        """
+        Record a request that got `status`, or None if it failed without
+        a response, after `latency` seconds
+        """
+        if now is None:
+            now = time.time()
+        key = (label, status_class(status))
+        with self._lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = Series()
+            series.latency.record(latency)
+            series.size.record(size)
+            series.rate.add(now)
+
+    def take(self):
+        """
+        Return the series recorded since the last take(), and start them
+        again, e.g. to send them to another process
+        """
+        with self._lock:
+            series, self.series = self.series, {}
+        return series
+
+    def merge(self, series):
+        """ Add series from take(), e.g. in another process, to these """
+        with self._lock:
+            for key, other in series.items():
+                mine = self.series.get(key)
+                if mine is None:
+                    mine = self.series[key] = Series()
+                mine.merge(other)
+
+    def report(self, names=None, now=None):
+        """
+        Return the summary as a list of lines. `names` maps labels to the
+        names to show for them, e.g. resource names for their URLs. Errors,
+        for the error rate, are failures and 5xx responses.
+        """
+        if now is None:
+            now = time.time()
+        names = names or {}
+        with self._lock:
+            seconds = max(min(RATE_WINDOW, int(now - self.started)), 1)
+            rates = dict((key, series.rate.total(now, RATE_WINDOW))
+                         for key, series in self.series.items())
+            requests = sum(rates.values())
+            errors = sum(rate for key, rate in rates.items()
+                         if key[1] in ERROR_CLASSES)
+            total = sum(series.latency.count
+                        for series in self.series.values())
+            lines = [
+                '%s  %d requests in %ds' % (time.strftime('%H:%M:%S'),
+                                            total, now - self.started),
+                'Last %ds:     %.1f req/s, %.1f%% errors' % (seconds,
+                    float(requests) / seconds,
+                    requests and 100.0 * errors / requests or 0.0),
+                '',
+                '%-20s  %-6s  %8s  %7s  %8s  %8s  %8s  %8s  %9s' % (
+                    'resource', 'status', 'requests', 'req/s', 'p50 ms',
+                    'p90 ms', 'p99 ms', 'max ms', 'mean size'),
+            ]
+            order = dict((name, i) for i, name in enumerate(STATUS_CLASSES))
+            keys = sorted(self.series, key=lambda key: (
+                names.get(key[0], key[0]), order.get(key[1], key[1])))
+            for label, status in keys:
+                series = self.series[label, status]
+                latency = series.latency
+                lines.append(
+                    '%-20s  %-6s  %8d  %7.1f  %8.1f  %8.1f  %8.1f  %8.1f  '
+                    '%9d' % ((names.get(label, label), status, latency.count,
+                              float(rates[label, status]) / seconds) +
+                             tuple(latency.percentile(p) * 1000
+                                   for p in (50, 90, 99, 100)) +
+                             (series.size.mean,)))
+        return lines
+
+
+class StatsResponse(object):
+    """
+    Wraps a response, counting the body as it's read. `finish` is called
+    with the size once the body has been read, or the response is closed.
+    """
+
+    def __init__(self, response, finish):
+        self._response = response
+        self._finish = finish
+        self._size = 0
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+    def _count(self, data, eof):
+        if self._finish is None:
+            return
+        self._size += len(data)
+        if eof:
+            finish, self._finish = self._finish, None
+            finish(self._size)
+
+    def read(self, amt=-1):
+        data = self._response.read(amt)
+        self._count(data, amt is None or amt < 0 or not data)
+        return data
+
+    def readline(self, limit=-1):
+        data = self._response.readline(limit)
+        self._count(data, not data)
+        return data
+
+    def readlines(self, sizehint=0):
+        lines = []
+        while True:
+            line = self.readline()
+            if not line:
+                return lines
+            lines.append(line)
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+    def close(self):
+        self._count('', True)
+        self._response.close()
+
+
+class StatsHandler(urllib2.BaseHandler):
+    """
+    Records every response in a `Stats`, with its latency from when it
+    was sent (after any wait for a rate limit) until its body had been
+    read. Requests are labelled with their `stats_label`, which Resources
+    set to their URL, or else their scheme and host.
+    """
+
+    # After the rate limit, and ahead of the handlers that make requests
+    handler_order = 445
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def http_request(self, req):
+        # For responses from the cache, which don't reach http_open
+        req.stats_started = time.time()
+        return req
+
+    https_request = http_request
+
+    def http_open(self, req):
+        req.stats_started = time.time()
+        return None
+
+    https_open = http_open
+
+    def http_response(self, req, response):
+        started = getattr(req, 'stats_started', None) or time.time()
+        label = getattr(req, 'stats_label', None) or \
+            '%s://%s' % (req.get_type(), req.get_host())
+        stats = self.stats
+
+        def finish(size):
+            stats.record(label, response.code, time.time() - started, size)
+        return StatsResponse(response, finish)
+
+    https_response = http_response
@@ -0,0 +1,193 @@
+import os
+import stat
+import sys
+import time
+
+# Size of the reads used when streaming response bodies
+CHUNK_SIZE = 64 * 1024
+
+# Minimum number of seconds between updates of a live progress readout
+UPDATE_INTERVAL = 0.25
+
+
+def format_bytes(count):
+    """ Format a byte count for people, e.g. 1536 -> '1.5 KB' """
+    for unit in ('bytes', 'KB', 'MB', 'GB'):
+        if count < 1024 or unit == 'GB':
+            break
+        count /= 1024.0
+    if unit == 'bytes':
+        return '%d %s' % (count, unit)
+    return '%.1f %s' % (count, unit)
+
+
+class Progress(object):
+    """
+    Tracks how much of a body has been transferred and how quickly.
+    `start` is when the request was sent, `first_byte` when the response
+    headers arrived.
+    """
+
+    def __init__(self, start, first_byte, stream=None):
+        self.start = start
+        self.first_byte = first_byte
+        self.stream = stream
+        self.bytes = 0
+        self._last_update = 0
+
+    @property
+    def ttfb(self):
+        return self.first_byte - self.start
+
+    def rate(self, now=None):
+        elapsed = (now or time.time()) - self.first_byte
+        if elapsed <= 0:
+            return 0.0
+        return self.bytes / elapsed
+
+    def readout(self, now=None):
+        return '%s received, %s/s, first byte after %.3fs' % (
+            format_bytes(self.bytes), format_bytes(self.rate(now)), self.ttfb)
+
+    def update(self, size):
+        self.bytes += size
+        if self.stream is None:
+            return
+        now = time.time()
+        if now - self._last_update >= UPDATE_INTERVAL:
+            self._last_update = now
+            self.stream.write('\r' + self.readout(now))
+            self.stream.flush()
+
+    def finish(self):
+        if self.stream is not None:
+            self.stream.write('\r' + self.readout() + '\n')
+            self.stream.flush()
+
+
+def copy(response, out, progress=None, chunk_size=CHUNK_SIZE):
+    """
+    Copy a response body to `out` a chunk at a time, so that only one chunk
+    is ever held in memory. Returns the number of bytes copied.
+    """
+    size = 0
+    while True:
+        data = response.read(chunk_size)
+        if not data:
+            break
+        out.write(data)
+        size += len(data)
+        if progress is not None:
+            progress.update(len(data))
+    return size
+
+
+class UploadProgress(Progress):
+    """ Tracks how much of a request body has been sent, and how quickly """
+
+    def __init__(self, start, stream=None):
+        Progress.__init__(self, start, start, stream)
+
+    def readout(self, now=None):
+        return '%s sent, %s/s' % (format_bytes(self.bytes),
+                                  format_bytes(self.rate(now)))
+
+
+class Upload(object):
+    """
+    A request body read from a file a chunk at a time as it's sent, so
+    that only one chunk is ever held in memory. If the size isn't known,
+    e.g. for stdin, it's sent with chunked transfer encoding.
+    """
+
+    def __init__(self, f, size=None, progress=None, close=False):
+        self.file = f
+        self.size = size
+        self.progress = progress
+        # A file-like object that's sent a copy of the body as it goes,
+        # e.g. to record it
+        self.tee = None
+        self._close = close
+        try:
+            self._start = f.tell()
+        except (AttributeError, IOError):
+            # Not seekable, so it can only be sent once
+            self._start = None
+
+    @classmethod
+    def from_file(cls, f, progress=None, close=False):
+        """ Wrap a file object, finding its size if it's a regular file """
+        size = None
+        try:
+            st = os.fstat(f.fileno())
+            if stat.S_ISREG(st.st_mode):
+                size = st.st_size - f.tell()
+        except (AttributeError, IOError, OSError):
+            pass
+        return cls(f, size, progress, close)
+
+    @property
+    def chunked(self):
+        return self.size is None
+
+    def rewind(self):
+        """ Go back to the start, to send again. Returns False if we can't """
+        if self._start is None:
+            return False
+        if self.file.closed:
+            # We close our own files once they've been sent, so open it
+            # again. A file someone else closed can't be sent again.
+            if not self._close:
+                return False
+            try:
+                self.file = open(self.file.name, 'rb')
+            except (AttributeError, IOError):
+                return False
+        self.file.seek(self._start)
+        if self.tee is not None:
+            self.tee.seek(0)
+            self.tee.truncate()
+        return True
+
+    def chunks(self, chunk_size=CHUNK_SIZE):
+        """ Yield the body a chunk at a time, updating the progress """
+        try:
+            while True:
+                data = self.file.read(chunk_size)
+                if not data:
+                    break
+                if self.progress is not None:
+                    self.progress.update(len(data))
+                if self.tee is not None:
+                    self.tee.write(data)
+                yield data
+        finally:
+            if self._close:
+                self.file.close()
+        if self.progress is not None:
+            self.progress.finish()
+
+    def send(self, conn, chunk_size=CHUNK_SIZE):
+        """ Send the body on an httplib connection whose headers are sent """
+        for data in self.chunks(chunk_size):
+            if self.chunked:
+                conn.send('%x\r\n%s\r\n' % (len(data), data))
+            else:
+                conn.send(data)
+        if self.chunked:
+            conn.send('0\r\n\r\n')
+
+
+class FileSource(object):
+    """
+    Names a file, or '-' for stdin, to use as a request body. Each call to
+    open() gives a fresh `Upload`, so the same source can be sent again.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def open(self, progress=None):
+        if self.path == '-':
+            return Upload.from_file(sys.stdin, progress)
+        return Upload.from_file(open(self.path, 'rb'), progress, close=True)
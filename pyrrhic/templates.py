@@ -0,0 +1,242 @@
+"""
+Request templates: a path, headers and body with {name} placeholders, for
+requests that vary, such as by a counter, a random id or the rows of a CSV
+file. Each part is compiled once into a %-format string, so making a
+request is one string format per part rather than building it up again.
+"""
+import itertools
+import random
+import re
+import threading
+import time
+
+# {name}, where name is an identifier. Anything else in braces, such as
+# JSON, is left as it is.
+PLACEHOLDER_RE = re.compile(r'\{([A-Za-z_]\w*)\}')
+
+# Largest value of {random}
+RANDOM_MAX = 2 ** 31 - 1
+
+# The version and variant bits of a random (version 4) UUID
+UUID_MASK = ~(0xf000 << 64 | 0xc << 60)
+UUID_BITS = 0x4000 << 64 | 0x8 << 60
+
+
+def random_uuid():
+    """
+    A version 4 UUID as a string. Unlike uuid.uuid4(), it comes from the
+    random module rather than os.urandom, so isn't fit for secrets, but is
+    several times quicker.
+    """
+    h = '%032x' % (random.getrandbits(128) & UUID_MASK | UUID_BITS)
+    return '%s-%s-%s-%s-%s' % (h[:8], h[8:12], h[12:16], h[16:20], h[20:])
+
+
+# Variables every template has, made afresh for each request. They can't
+# be overridden by a data file's columns.
+BUILTINS = {
+    # 1, 2, 3... counting requests made with the template
+    'n': lambda template: next(template._count),
+    'uuid': lambda template: random_uuid(),
+    'random': lambda template: random.randint(0, RANDOM_MAX),
+    'time': lambda template: int(time.time()),
+    'time_ms': lambda template: int(time.time() * 1000),
+}
+
+def _quote_path(value):
+    # urllib is imported when it's needed, as it's slow to import
+    import urllib
+    return urllib.quote(str(value), safe='')
+
+
+def _quote_form(value):
+    import urllib
+    return urllib.quote_plus(str(value))
+
+
+# How values are quoted in each part of a request. Header values, and
+# bodies other than forms, are sent as they are.
+QUOTES = {
+    'path': _quote_path,
+    'form': _quote_form,
+}
+
+
+def _key(name, quoting):
+    # The key a value is formatted from: its name, or its name and how
+    # it's quoted, as the same value may be needed quoted and unquoted
+    if quoting is None:
+        return name
+    return '%s:%s' % (name, quoting)
+
+
+def compile_text(text, quoting=None):
+    """
+    Compile text with {name} placeholders into a %-format string, e.g.
+    'items/{id}' into 'items/%(id:path)s' when quoting for a path. Returns
+    the format and the names used in it.
+    """
+    parts = PLACEHOLDER_RE.split(text)
+    names = parts[1::2]
+    for i in range(0, len(parts), 2):
+        parts[i] = parts[i].replace('%', '%%')
+    for i in range(1, len(parts), 2):
+        parts[i] = '%%(%s)s' % _key(parts[i], quoting)
+    return ''.join(parts), names
+
+
+def read_rows(path):
+    """ The rows of a CSV file, as dicts keyed by the names in its first row """
+    import csv
+    f = open(path, 'rb')
+    try:
+        return list(csv.DictReader(f))
+    finally:
+        f.close()
+
+
+class Template(object):
+    """
+    A request's path (relative to the resource it's sent to, as with
+    `Resource.join`), headers and body, any of which can have {name}
+    placeholders. Names are BUILTINS, or columns of the `data` file, whose
+    rows are used in turn, one per request, starting again at the end.
+    `rows` can be given instead: any iterable of dicts, which is used once.
+    A `form` body, like ':key=value' data, has its values quoted.
+    """
+
+    def __init__(self, path='', headers=(), body=None, form=False,
+                 data=None, rows=None):
+        self.path = path
+        self.headers = list(headers)
+        self.body = body
+        self.form = form
+        self.data = data
+        uses = []
+        self._path = self._compile(path, 'path', uses)
+        self._headers = [(name, self._compile(value, None, uses))
+                         for name, value in self.headers]
+        self._body = None
+        if body is not None:
+            self._body = self._compile(body, form and 'form' or None, uses)
+
+        # The keys each variable is formatted from, and how each is quoted
+        keys = {}
+        for name, quoting in uses:
+            keys.setdefault(name, set()).add((_key(name, quoting),
+                                              QUOTES.get(quoting)))
+        self._builtins = [(BUILTINS[name], [key for key, quote in keys[name]])
+                          for name in sorted(keys) if name in BUILTINS]
+        self._columns = [(name, sorted(keys[name])) for name in sorted(keys)
+                         if name not in BUILTINS]
+        if self._columns and data is None and rows is None:
+            raise ValueError, 'Unknown variable {%s}' % self._columns[0][0]
+
+        self._count = itertools.count(1)
+        self._lock = threading.Lock()
+        # The data file's rows, ready to format from, once it's been read
+        self._table = None
+        self._share = 0, 1
+        self._rows = rows is not None and iter(rows) or None
+
+    def _compile(self, text, quoting, uses):
+        format, names = compile_text(text, quoting)
+        uses.extend((name, quoting) for name in names)
+        return format
+
+    def _values(self, row):
+        # The values to format from for a row, quoted for each part
+        values = {}
+        for name, keys in self._columns:
+            value = row[name]
+            for key, quote in keys:
+                if quote is None:
+                    values[key] = value
+                else:
+                    values[key] = quote(value)
+        return values
+
+    def load(self):
+        """
+        Read the data file, if there is one and it hasn't been read yet,
+        checking it has a column for each variable. Raises IOError if it
+        can't be read, or ValueError if it's no use.
+        """
+        with self._lock:
+            self._load()
+
+    def _load(self):
+        # Called with the lock held, so that threads sharing the template
+        # read the file once, and take their rows from the same cycle
+        if self._table is not None or self.data is None:
+            return
+        rows = read_rows(self.data)
+        if not rows:
+            raise ValueError, '%s has no rows' % self.data
+        for name, keys in self._columns:
+            if name not in rows[0]:
+                raise ValueError, 'No column %s in %s' % (name, self.data)
+        self._table = [self._values(row) for row in rows]
+        self._slice()
+
+    def _slice(self):
+        # Called with the lock held
+        index, parts = self._share
+        self._rows = itertools.islice(itertools.cycle(self._table), index,
+                                      None, parts)
+
+    def share(self, index, parts):
+        """
+        Take the index'th of `parts` shares of the counter and the data
+        file's rows, for one of several processes sending requests, so that
+        no two send the same values.
+        """
+        with self._lock:
+            start = next(self._count)
+            self._count = itertools.count(start + index, parts)
+            self._share = index, parts
+            if self._table is not None:
+                self._slice()
+
+    def render(self):
+        """
+        Return the path, headers and body for the next request. Raises
+        ValueError once the `rows` it was given have run out.
+        """
+        if self._columns:
+            with self._lock:
+                self._load()
+                try:
+                    row = next(self._rows)
+                except StopIteration:
+                    raise ValueError, 'template rows exhausted'
+            if self._table is None:
+                values = self._values(row)
+            else:
+                # Builtins are added, so don't change the shared row
+                values = dict(row)
+        else:
+            values = {}
+        for make, keys in self._builtins:
+            value = make(self)
+            for key in keys:
+                values[key] = value
+        body = self._body
+        if body is not None:
+            body = body % values
+        return (self._path % values,
+                [(name, value % values) for name, value in self._headers],
+                body)
+
+    def __str__(self):
+        bits = []
+        if self.path:
+            bits.append(self.path)
+        if self.body is not None:
+            bits.append(self.form and ':' + self.body or '<%d byte body>'
+                        % len(self.body))
+        for name, value in self.headers:
+            bits.append('-H %s:%s' % (name, value))
+        if self.data is not None:
+            bits.append('-f %s' % self.data)
+        return ' '.join(bits)
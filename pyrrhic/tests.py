@@ -1,13 +1,29 @@
 import base64
+import os
 import sys
 
 import unittest
 import mock
 
 import pyrrhic
+import pyrrhic.bench
+import pyrrhic.caching
+import pyrrhic.checks
+import pyrrhic.compression
+import pyrrhic.formatting
+import pyrrhic.histogram
+import pyrrhic.jobs
+import pyrrhic.recording
+import pyrrhic.resolver
+import pyrrhic.startup
+import pyrrhic.stats
+import pyrrhic.streaming
+import pyrrhic.templates
+import pyrrhic.throttling
 import pyrrhic.ui
 import pyrrhic.commands
 import pyrrhic.http
+import pyrrhic.http2
 
 def build_mock_response(mock_get, code=200, msg='OK', headers={}, data=''):
     mock_response = mock.Mock()
@@ -30,6 +46,9 @@ class Writeable(object):
     def write(self, str):
         self.written.append(str)
 
+    def flush(self):
+        pass
+
 class StdoutRedirectorBase(unittest.TestCase):
 
     def _stdout(self):
@@ -62,6 +81,35 @@ class ResourceTestCase(StdoutRedirectorBase):
         r = pyrrhic.Resource('foo.com:123')        
         self.assertEqual('http://foo.com:123', r.url)
 
+    def testUrlInQuery(self):
+        # A URL later on doesn't count as the scheme
+        r = pyrrhic.Resource('foo.com/go?to=http://bar.com/')
+        self.assertEqual('http://foo.com:80/go?to=http://bar.com/', r.url)
+        self.assertEqual('foo.com:80', r.parsed_url.netloc)
+
+    def testSlots(self):
+        self.failIf(hasattr(self.resource, '__dict__'))
+        self.assertRaises(AttributeError, setattr, self.resource, 'foo', 1)
+
+    def testFromUrls(self):
+        resources = pyrrhic.Resource.from_urls(['foo.com', 'https://bar.com/x'])
+        self.assertEqual(['http://foo.com:80', 'https://bar.com:443/x'],
+                         [r.url for r in resources])
+
+    @mock.patch('urllib2.OpenerDirector.open')
+    def testRequestTarget(self, mock_open):
+        build_mock_response(mock_open)
+        for url, selector in (('foo.com', '/'),
+                              ('foo.com/a/b;p?q=1#frag', '/a/b;p?q=1'),
+                              ('https://foo.com:8443?q', '/?q')):
+            pyrrhic.Resource(url).get()
+            request = mock_open.call_args[0][0]
+            self.assertEqual(selector, request.get_selector())
+            self.assertEqual(pyrrhic.Resource(url).parsed_url.netloc,
+                             request.get_host())
+            self.assertEqual(url.startswith('https') and 'https' or 'http',
+                             request.get_type())
+
     @mock.patch('urllib2.OpenerDirector.open')
     def testGet(self, mock_open):
         mock_response = build_mock_response(mock_open)
@@ -73,6 +121,8 @@ class ResourceTestCase(StdoutRedirectorBase):
     @mock.patch('httplib.HTTPConnection.request')
     def test40x(self, mock_request, mock_getresponse):
         mock_response = build_mock_response(mock_getresponse, code=405, msg='Method not allowed')
+        # httplib responses keep their headers in msg
+        mock_response.msg = build_headers()
         response = self.resource.get()
         self.assertEqual(405, response.code)
         
@@ -191,7 +241,7 @@ class HelpCommandTestCase(StdoutRedirectorBase):
     
     def testHelp(self):
         out, err = self._stdout()        
-        c = pyrrhic.ui.HelpCommand({})
+        c = pyrrhic.commands.HelpCommand({})
         c.run()
         
         # Don't bet on what commands are there. Just check for the help 
@@ -235,7 +285,8 @@ class ResourceCommandTestCase(StdoutRedirectorBase):
         # A straight hostname is also OK, http will be assumed
         c.validate('foo.com')
 
-    def testResource(self):
+    @mock.patch('pyrrhic.resolver.prewarm')
+    def testResource(self, mock_prewarm):
         resources = {}
         c = pyrrhic.commands.ResourceCommand(resources)
         c.run('http://foo.com')
@@ -253,6 +304,19 @@ class ResourceCommandTestCase(StdoutRedirectorBase):
         self.failUnless(resources.has_key('cheese'))
         cheese = resources['cheese']
         self.failIf(cheese is unnamed2)
+
+        # Each host is looked up ahead of time, but not connected to
+        # unless prewarm is on
+        self.assertEqual(mock.call(cheese, pyrrhic.get_dns_cache(), None),
+                         mock_prewarm.call_args)
+        pyrrhic.commands.settings['prewarm'] = True
+        try:
+            c.run('http://cheese.com', 'cheese')
+        finally:
+            pyrrhic.commands.settings['prewarm'] = False
+        self.assertEqual(mock.call(resources['cheese'],
+                                   pyrrhic.get_dns_cache(),
+                                   pyrrhic.get_pool()), mock_prewarm.call_args)
         
         
 class AuthCommandTestCase(StdoutRedirectorBase):
@@ -466,7 +530,20 @@ class CustomRequestTestCase(unittest.TestCase):
         self.assertEqual('PUT', request.get_method())
         request = pyrrhic.http.Request('http://foo.com/', req_method='DELETE')
         self.assertEqual('DELETE', request.get_method())
-        
+
+    def testSetTarget(self):
+        request = pyrrhic.http.Request('http://foo.com:80/a?b=1')
+        request.set_target('http', 'foo.com:80', '/a?b=1')
+        self.assertEqual('http', request.get_type())
+        self.assertEqual('foo.com:80', request.get_host())
+        self.assertEqual('/a?b=1', request.get_selector())
+        self.assertEqual(False, request.has_proxy())
+        # Through a proxy, the target is the whole URL
+        request.set_proxy('proxy.com:3128', 'http')
+        self.assertEqual('proxy.com:3128', request.get_host())
+        self.assertEqual('http://foo.com:80/a?b=1', request.get_selector())
+        self.assertEqual(True, request.has_proxy())
+
 
 class UiTestCase(StdoutRedirectorBase):
         
@@ -491,4 +568,2973 @@ class UiTestCase(StdoutRedirectorBase):
         written = ''.join(self.err.written)
         self.failUnless(written.find('gaierror') > -1)
 
-    
\ No newline at end of file
+
+class ConnectionPoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = pyrrhic.http.ConnectionPool(max_per_host=2)
+        self.key = ('http', 'foo.com:80')
+
+    def _connection(self):
+        conn = mock.Mock()
+        conn.sock = mock.Mock()
+        return conn
+
+    @mock.patch('select.select')
+    def testReuse(self, mock_select):
+        mock_select.return_value = ([], [], [])
+        conn = self._connection()
+        got, reused = self.pool.get(self.key, lambda: conn)
+        self.failUnless(got is conn)
+        self.assertEqual(False, reused)
+        self.pool.release(self.key, conn)
+
+        got, reused = self.pool.get(self.key, self._connection)
+        self.failUnless(got is conn)
+        self.assertEqual(True, reused)
+        self.assertEqual([(self.key, 1, 0, 1, 1)], self.pool.stats())
+
+    @mock.patch('select.select')
+    def testStale(self, mock_select):
+        # A readable idle socket means the server hung up on us
+        conn = self._connection()
+        self.pool.get(self.key, lambda: conn)
+        self.pool.release(self.key, conn)
+        mock_select.return_value = ([conn.sock], [], [])
+        got, reused = self.pool.get(self.key, self._connection)
+        self.failIf(got is conn)
+        self.assertEqual(False, reused)
+        self.assertEqual(True, conn.close.called)
+
+    def testIdleTimeout(self):
+        self.pool.idle_timeout = -1
+        conn = self._connection()
+        self.pool.get(self.key, lambda: conn)
+        self.pool.release(self.key, conn)
+        got, reused = self.pool.get(self.key, self._connection)
+        self.failIf(got is conn)
+        self.assertEqual(True, conn.close.called)
+
+    def testMaxPerHost(self):
+        conns = [self.pool.get(self.key, self._connection)[0]
+                 for i in range(3)]
+        for conn in conns:
+            self.pool.release(self.key, conn)
+        self.assertEqual([(self.key, 2, 2, 3, 0)], self.pool.stats())
+        self.assertEqual(True, conns[-1].close.called)
+
+    def testClosedNotPooled(self):
+        # If the server sent Connection: close, httplib will already have
+        # dropped the socket, so there's nothing to keep.
+        conn = self._connection()
+        conn.sock = None
+        self.pool.get(self.key, lambda: conn)
+        self.pool.release(self.key, conn)
+        self.assertEqual([(self.key, 0, 0, 1, 0)], self.pool.stats())
+
+    def testDiscard(self):
+        conn = self._connection()
+        self.pool.get(self.key, lambda: conn)
+        self.pool.discard(self.key, conn)
+        self.assertEqual(True, conn.close.called)
+        self.assertEqual([(self.key, 0, 0, 1, 0)], self.pool.stats())
+
+
+class PoolCommandTestCase(StdoutRedirectorBase):
+
+    def testPoolValidation(self):
+        c = pyrrhic.commands.PoolCommand({})
+        c.validate()
+        c.validate('clear')
+        self.assertRaises(pyrrhic.commands.ValidationError, c.validate, 'foo')
+
+    @mock.patch('pyrrhic.pool')
+    def testPool(self, mock_pool):
+        out, err = self._stdout()
+        mock_pool.stats.return_value = [(('http', 'foo.com:80'), 3, 1, 4, 7)]
+        c = pyrrhic.commands.PoolCommand({})
+        c.run()
+        written = [x for x in out.written if x != '\n']
+        self.assertEqual('http://foo.com:80\t\t3\t1\t7', written[1])
+
+    @mock.patch('pyrrhic.pool')
+    def testPoolClear(self, mock_pool):
+        c = pyrrhic.commands.PoolCommand({})
+        c.run('clear')
+        self.assertEqual(True, mock_pool.clear.called)
+
+
+class BenchTestCase(unittest.TestCase):
+
+    def testRun(self):
+        responses = []
+        def send():
+            response = mock.Mock()
+            response.code = 200
+            response.read.side_effect = ['abc', '']
+            responses.append(response)
+            return response
+        result = pyrrhic.bench.run(send, 10, 3)
+        self.assertEqual(10, result.count)
+        self.assertEqual({200: 10}, result.statuses)
+        self.assertEqual(30, result.bytes)
+        self.assertEqual(True, all(r.close.called for r in responses))
+
+    def testErrors(self):
+        import urllib2
+        def send():
+            raise urllib2.URLError('dummy')
+        result = pyrrhic.bench.run(send, 4, 2)
+        self.assertEqual({'URLError': 4}, result.errors)
+        self.assertEqual({}, result.statuses)
+
+    def testBadResponses(self):
+        # e.g. the server hanging up part way through a response
+        import httplib
+        def send():
+            response = mock.Mock()
+            response.read.side_effect = httplib.IncompleteRead('abc')
+            return response
+        result = pyrrhic.bench.run(send, 4, 2)
+        self.assertEqual({'IncompleteRead': 4}, result.errors)
+        self.assertEqual(4, result.count)
+
+
+class BenchCommandTestCase(StdoutRedirectorBase):
+
+    def setUp(self):
+        self.resources = {'news': pyrrhic.Resource('http://foo.com')}
+        self.c = pyrrhic.commands.BenchCommand(self.resources)
+
+    def testBenchValidation(self):
+        ValidationError = pyrrhic.commands.ValidationError
+        self.assertRaises(ValidationError, self.c.validate)
+        self.assertRaises(ValidationError, self.c.validate, 'ten', 'get')
+        self.assertRaises(ValidationError, self.c.validate, '10')
+        self.assertRaises(ValidationError, self.c.validate, '10', '-c')
+        self.assertRaises(ValidationError, self.c.validate, '0', 'get', 'news')
+        self.assertRaises(ValidationError, self.c.validate, '10', 's')
+        # The benchmarked command is validated too
+        self.assertRaises(ValidationError, self.c.validate, '10', 'get')
+        self.assertRaises(ValidationError, self.c.validate, '10', 'get', '@all')
+        self.c.validate('10', 'get', 'news')
+        self.c.validate('10', '-c', '4', 'post', 'news', ':a=b')
+
+    @mock.patch('pyrrhic.Resource.post')
+    def testBench(self, mock_post):
+        out, err = self._stdout()
+        mock_response = build_mock_response(mock_post)
+        mock_response.read.side_effect = lambda amt: ''
+        self.c.run('5', '-c', '2', 'post', 'news', ':key=value')
+        self.assertEqual(5, mock_post.call_count)
+        args, kwargs = mock_post.call_args
+        self.assertEqual({'data': {'key': ['value']}}, kwargs)
+        written = ''.join(out.written)
+        self.failUnless(written.find('Status codes: 200: 5') > -1)
+        self.failUnless(written.find('p99') > -1)
+
+
+class JobTestCase(StdoutRedirectorBase):
+
+    def testResult(self):
+        job = pyrrhic.jobs.submit(lambda a, b: a + b, 1, b=2)
+        self.assertEqual(3, job.result(1))
+        self.assertEqual(True, job.done())
+
+    def testException(self):
+        def fail():
+            raise ValueError('dummy')
+        job = pyrrhic.jobs.submit(fail)
+        self.assertRaises(ValueError, job.result, 1)
+
+    @mock.patch('pyrrhic.Resource.get')
+    def testResourceAsync(self, mock_get):
+        mock_response = build_mock_response(mock_get)
+        job = pyrrhic.Resource('http://foo.com').get_async()
+        self.failUnless(job.result(1) is mock_response)
+
+    @mock.patch('pyrrhic.Resource.post')
+    def testResourceAsyncData(self, mock_post):
+        build_mock_response(mock_post)
+        pyrrhic.Resource('http://foo.com').post_async({'a': 'b'}).result(1)
+        args, kw = mock_post.call_args
+        self.assertEqual(({'a': 'b'},), args)
+
+    def testManagerCapturesOutput(self):
+        out, err = self._stdout()
+        manager = pyrrhic.jobs.JobManager()
+        finished = []
+        def hello():
+            print 'hello'
+        job = manager.start('hello', hello, on_done=finished.append)
+        job.wait(1)
+        print 'outside'
+        self.assertEqual(['hello', '\n'], job.output)
+        self.assertEqual(['outside', '\n'], out.written)
+        self.assertEqual([job], finished)
+        self.assertEqual([], manager.running())
+
+
+class BackgroundUiTestCase(StdoutRedirectorBase):
+
+    def testSplitBackground(self):
+        self.assertEqual(('get news', True),
+                         pyrrhic.ui.split_background('get news &'))
+        self.assertEqual(('get', True), pyrrhic.ui.split_background('get&'))
+        self.assertEqual(('get news', False),
+                         pyrrhic.ui.split_background('get news'))
+
+    @mock.patch('pyrrhic.Resource.get')
+    def testRunBackground(self, mock_get):
+        out, err = self._stdout()
+        build_mock_response(mock_get, data='Body Content')
+        resources = {'__default__': pyrrhic.Resource('http://foo.com')}
+        command = pyrrhic.commands.GetCommand(resources)
+        with mock.patch('pyrrhic.ui.show_job_result') as mock_show:
+            job = pyrrhic.ui.run_background(command, (), 'get')
+            job.wait(1)
+        self.failUnless(''.join(out.written).find('] get') > -1)
+        mock_show.assert_called_with(job)
+        self.failUnless('Body Content' in job.output)
+
+    def testJobsValidation(self):
+        c = pyrrhic.commands.JobsCommand({})
+        c.validate()
+        c.validate('wait')
+        self.assertRaises(pyrrhic.commands.ValidationError, c.validate, 'foo')
+
+
+def chunked_reader(*chunks):
+    """ Return a side effect for response.read which yields chunks """
+    chunks = list(chunks)
+    def read(amt=None):
+        if chunks:
+            return chunks.pop(0)
+        return ''
+    return read
+
+
+class StreamingTestCase(unittest.TestCase):
+
+    def testFormatBytes(self):
+        self.assertEqual('12 bytes', pyrrhic.streaming.format_bytes(12))
+        self.assertEqual('1.5 KB', pyrrhic.streaming.format_bytes(1536))
+        self.assertEqual('2.0 MB', pyrrhic.streaming.format_bytes(2 * 1024 ** 2))
+
+    def testCopy(self):
+        response = mock.Mock()
+        response.read.side_effect = chunked_reader('abc', 'de')
+        out = Writeable()
+        progress = pyrrhic.streaming.Progress(0, 1)
+        self.assertEqual(5, pyrrhic.streaming.copy(response, out, progress))
+        self.assertEqual(['abc', 'de'], out.written)
+        self.assertEqual(5, progress.bytes)
+        self.assertEqual(1, progress.ttfb)
+
+    def testLiveReadout(self):
+        stream = Writeable()
+        progress = pyrrhic.streaming.Progress(0, 1, stream)
+        progress.update(10)
+        progress.finish()
+        self.failUnless(stream.written[0].startswith('\r10 bytes received'))
+        self.failUnless(stream.written[-1].endswith('\n'))
+
+
+class StreamCommandTestCase(StdoutRedirectorBase):
+
+    def setUp(self):
+        self.resources = {'__default__': pyrrhic.Resource('http://foo.com')}
+
+    @mock.patch.dict('pyrrhic.commands.settings', {'stream': False})
+    def testToggle(self):
+        out, err = self._stdout()
+        c = pyrrhic.commands.StreamCommand({})
+        c.validate('on')
+        self.assertRaises(pyrrhic.commands.ValidationError, c.validate, 'up')
+        c.run('on')
+        self.assertEqual(True, pyrrhic.commands.settings['stream'])
+        c.run()
+        self.assertEqual(['stream is on', '\n'], out.written)
+        c.run('off')
+        self.assertEqual(False, pyrrhic.commands.settings['stream'])
+
+    @mock.patch.dict('pyrrhic.commands.settings', {'stream': True})
+    @mock.patch('pyrrhic.Resource.get')
+    def testStream(self, mock_get):
+        out, err = self._stdout()
+        mock_response = build_mock_response(mock_get, headers={'header': 'value'})
+        mock_response.read.side_effect = chunked_reader('Body ', 'Content')
+        c = pyrrhic.commands.GetCommand(self.resources)
+        c.run()
+        written = [x for x in out.written if x != '\n']
+        self.assertEqual(['200 OK', 'header: value', 'Body ', 'Content'],
+                         written[:4])
+        self.failUnless(written[4].startswith('12 bytes received'))
+
+    def testRedirectValidation(self):
+        c = pyrrhic.commands.GetCommand(self.resources)
+        c.validate('>', 'out.json')
+        c.validate('>out.json')
+        c.validate('__default__', '>', 'out.json')
+        self.assertRaises(pyrrhic.commands.ValidationError, c.validate, '>')
+        self.assertRaises(pyrrhic.commands.ValidationError, c.validate,
+                          '>', 'a', 'b')
+
+    @mock.patch('pyrrhic.Resource.post')
+    def testRedirect(self, mock_post):
+        import os
+        import tempfile
+        out, err = self._stdout()
+        mock_response = build_mock_response(mock_post, headers={'header': 'value'})
+        mock_response.read.side_effect = chunked_reader('Body ', 'Content')
+        fd, filename = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            c = pyrrhic.commands.PostCommand(self.resources)
+            c.run(':key=value', '>', filename)
+            self.assertEqual('Body Content', open(filename).read())
+        finally:
+            os.remove(filename)
+        args, kwargs = mock_post.call_args
+        self.assertEqual({'data': {'key': ['value']}}, kwargs)
+        written = [x for x in out.written if x != '\n']
+        self.assertEqual(['200 OK', 'header: value'], written[:2])
+        self.failIf('Body Content' in written)
+        self.assertEqual(True, mock_response.close.called)
+
+
+class TimingsTestCase(unittest.TestCase):
+
+    def testTimings(self):
+        timings = pyrrhic.http.Timings()
+        timings.ttfb = 0.01
+        timings.transfer = 0.002
+        self.assertEqual(0.012, timings.total)
+        self.assertEqual('dns -  connect -  tls -  ttfb 10.0ms  '
+                         'transfer 2.0ms  total 12.0ms', str(timings))
+        timings.reused = True
+        self.failUnless(str(timings).endswith('(reused connection)'))
+        self.assertEqual(0.01, timings.as_dict()['ttfb'])
+        self.assertEqual(None, timings.as_dict()['dns'])
+
+    @mock.patch('socket.socket')
+    @mock.patch('socket.getaddrinfo')
+    def testConnect(self, mock_getaddrinfo, mock_socket):
+        mock_getaddrinfo.return_value = [
+            (2, 1, 6, '', ('127.0.0.1', 80)),
+        ]
+        conn = pyrrhic.http.TimedHTTPConnection('foo.com', 80)
+        conn.timings = pyrrhic.http.Timings()
+        conn.connect()
+        self.failUnless(conn.sock is mock_socket.return_value)
+        conn.sock.connect.assert_called_with(('127.0.0.1', 80))
+        self.failIf(conn.timings.dns is None)
+        self.failIf(conn.timings.connect is None)
+        self.assertEqual(None, conn.timings.tls)
+
+    @mock.patch('httplib.HTTPConnection.getresponse')
+    @mock.patch('httplib.HTTPConnection.request')
+    def testResponseTimings(self, mock_request, mock_getresponse):
+        mock_response = build_mock_response(mock_getresponse)
+        mock_response.msg = build_headers()
+        mock_response.isclosed.return_value = True
+        response = pyrrhic.Resource('http://foo.com').get()
+        self.failIf(response.timings.ttfb is None)
+        self.failIf(response.timings.transfer is None)
+
+
+class TimingCommandTestCase(StdoutRedirectorBase):
+
+    @mock.patch.dict('pyrrhic.commands.settings', {'timing': True})
+    @mock.patch('pyrrhic.Resource.get')
+    def testPrintTiming(self, mock_get):
+        out, err = self._stdout()
+        mock_response = build_mock_response(mock_get, headers={'header': 'value'},
+                                            data='Body Content')
+        mock_response.timings = pyrrhic.http.Timings()
+        mock_response.compression = None
+        resources = {'__default__': pyrrhic.Resource('http://foo.com')}
+        pyrrhic.commands.GetCommand(resources).run()
+        written = [x for x in out.written if x != '\n']
+        self.assertEqual('header: value', written[1])
+        self.failUnless(written[2].startswith('timing: dns -'))
+        self.assertEqual('Body Content', written[3])
+
+
+def build_headers(**headers):
+    import httplib
+    import StringIO
+    raw = ''.join('%s: %s\r\n' % (k.replace('_', '-'), v)
+                  for k, v in headers.items())
+    return httplib.HTTPMessage(StringIO.StringIO(raw))
+
+
+class CacheTestCase(unittest.TestCase):
+
+    def _entry(self, body='body', vary=(), fresh_until=0, **headers):
+        return pyrrhic.caching.CacheEntry('http://foo.com:80/', vary, 200, 'OK',
+            ''.join(build_headers(**headers).headers), body, fresh_until)
+
+    def testParseCacheControl(self):
+        self.assertEqual({'no-cache': None, 'max-age': '60'},
+            pyrrhic.caching.parse_cache_control('no-cache, Max-Age=60'))
+        self.assertEqual({}, pyrrhic.caching.parse_cache_control(None))
+
+    def testFreshnessLifetime(self):
+        lifetime = pyrrhic.caching.freshness_lifetime
+        self.assertEqual(60, lifetime(build_headers(cache_control='max-age=60'), 0))
+        self.assertEqual(0, lifetime(build_headers(cache_control='no-cache'), 0))
+        self.assertEqual(None, lifetime(build_headers(cache_control='no-store'), 0))
+        self.assertEqual(None, lifetime(build_headers(vary='*'), 0))
+        self.assertEqual(3600, lifetime(build_headers(
+            date='Tue, 19 Jan 2010 14:00:00 GMT',
+            expires='Tue, 19 Jan 2010 15:00:00 GMT'), 0))
+        self.assertEqual(0, lifetime(build_headers(expires='0'), 0))
+        self.assertEqual(0, lifetime(build_headers(), 0))
+
+    def testVary(self):
+        cache = pyrrhic.caching.ResponseCache()
+        cache.store('GET', 'http://foo.com:80/',
+                    self._entry('json', (('accept', 'application/json'),)))
+        cache.store('GET', 'http://foo.com:80/',
+                    self._entry('xml', (('accept', 'text/xml'),)))
+        entry = cache.lookup('GET', 'http://foo.com:80/', {'accept': 'text/xml'})
+        self.assertEqual('xml', entry.body)
+        self.assertEqual(None, cache.lookup('GET', 'http://foo.com:80/', {}))
+        self.assertEqual(None, cache.lookup('GET', 'http://bar.com:80/', {}))
+
+    def testLRU(self):
+        entry_size = self._entry('x' * 100).size
+        cache = pyrrhic.caching.ResponseCache(max_bytes=entry_size * 2)
+        for url in 'abc':
+            cache.store('GET', url, self._entry('x' * 100))
+            if url == 'b':
+                # Touch a, so b becomes least recently used
+                cache.lookup('GET', 'a', {})
+        self.failIf(cache.lookup('GET', 'a', {}) is None)
+        self.assertEqual(None, cache.lookup('GET', 'b', {}))
+        self.failIf(cache.lookup('GET', 'c', {}) is None)
+        self.assertEqual(1, cache.stats.evictions)
+        self.assertEqual((entry_size * 2, 0), cache.usage())
+
+    def testTooBig(self):
+        cache = pyrrhic.caching.ResponseCache(max_entry_bytes=10)
+        cache.store('GET', 'a', self._entry('x' * 100))
+        self.assertEqual(None, cache.lookup('GET', 'a', {}))
+
+    def testDisk(self):
+        import shutil
+        import tempfile
+        directory = tempfile.mkdtemp()
+        try:
+            cache = pyrrhic.caching.ResponseCache(max_bytes=0,
+                                                  directory=directory)
+            cache.store('GET', 'a', self._entry('from disk'))
+            # Nothing fits in memory, so this has to come from disk
+            self.assertEqual('from disk', cache.lookup('GET', 'a', {}).body)
+
+            # A new cache in the same directory picks up what's there
+            cache = pyrrhic.caching.ResponseCache(directory=directory)
+            self.assertEqual('from disk', cache.lookup('GET', 'a', {}).body)
+            cache.purge()
+            self.assertEqual([], os.listdir(directory))
+        finally:
+            shutil.rmtree(directory)
+
+    def testDiskLRU(self):
+        import shutil
+        import tempfile
+        directory = tempfile.mkdtemp()
+        try:
+            cache = pyrrhic.caching.ResponseCache(directory=directory,
+                                                  max_disk_bytes=1)
+            cache.store('GET', 'a', self._entry())
+            self.assertEqual([], os.listdir(directory))
+        finally:
+            shutil.rmtree(directory)
+
+
+class CacheHandlerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = pyrrhic.caching.ResponseCache()
+        self.cache.enabled = True
+        self.handler = pyrrhic.caching.CacheHandler(self.cache)
+
+    def _response(self, code=200, body='body', **headers):
+        response = mock.Mock()
+        response.code = code
+        response.msg = 'OK'
+        response.info.return_value = build_headers(**headers)
+        response.read.side_effect = chunked_reader(body)
+        return response
+
+    def _fetch(self, response):
+        req = pyrrhic.http.Request('http://foo.com:80/')
+        req = self.handler.http_request(req)
+        cached = self.handler.default_open(req)
+        if cached is not None:
+            response = cached
+        response = self.handler.http_response(req, response)
+        return req, response
+
+    def testFresh(self):
+        req, response = self._fetch(self._response(cache_control='max-age=60'))
+        self.assertEqual('body', response.read())
+        req, response = self._fetch(None)
+        self.assertEqual(True, response.from_cache)
+        self.assertEqual('body', response.read())
+        self.assertEqual(1, self.cache.stats.hits)
+        self.assertEqual(1, self.cache.stats.misses)
+
+    def testRevalidate(self):
+        req, response = self._fetch(self._response(etag='"v1"',
+            last_modified='Tue, 19 Jan 2010 14:00:00 GMT'))
+        response.read()
+        req, response = self._fetch(self._response(304, '', etag='"v1"'))
+        self.assertEqual('"v1"', req.unredirected_hdrs['If-none-match'])
+        self.assertEqual('Tue, 19 Jan 2010 14:00:00 GMT',
+                         req.unredirected_hdrs['If-modified-since'])
+        self.assertEqual(200, response.code)
+        self.assertEqual('body', response.read())
+        self.assertEqual(1, self.cache.stats.revalidations)
+
+    def testNotStored(self):
+        # Without freshness information or validators there's no point
+        # keeping a response
+        req, response = self._fetch(self._response())
+        response.read()
+        req, response = self._fetch(self._response(cache_control='no-store',
+                                                    etag='"v1"'))
+        response.read()
+        self.assertEqual(0, self.cache.stats.stores)
+
+    def testPartialRead(self):
+        # Nothing is stored until the whole body has been read
+        response = self._response(cache_control='max-age=60')
+        response.read.side_effect = chunked_reader('a', 'b')
+        req, response = self._fetch(response)
+        self.assertEqual('a', response.read(1))
+        self.assertEqual(0, self.cache.stats.stores)
+        response.read(1)
+        response.read(1)
+        self.assertEqual('ab', self.cache.lookup('GET', 'http://foo.com:80/', {}).body)
+
+    def testDisabled(self):
+        self.cache.enabled = False
+        response = self._response(cache_control='max-age=60')
+        req, wrapped = self._fetch(response)
+        self.failUnless(wrapped is response)
+
+
+class CacheCommandTestCase(StdoutRedirectorBase):
+
+    def testCacheValidation(self):
+        c = pyrrhic.commands.CacheCommand({})
+        for args in [(), ('on',), ('on', '/tmp/cache'), ('off',), ('purge',)]:
+            c.validate(*args)
+        ValidationError = pyrrhic.commands.ValidationError
+        for args in [('foo',), ('off', 'x'), ('on', 'a', 'b')]:
+            self.assertRaises(ValidationError, c.validate, *args)
+
+    @mock.patch('pyrrhic.cache', pyrrhic.caching.ResponseCache())
+    def testCacheCommand(self):
+        out, err = self._stdout()
+        c = pyrrhic.commands.CacheCommand({})
+        c.run('on')
+        self.assertEqual(True, pyrrhic.get_cache().enabled)
+        pyrrhic.get_cache().stats.hits = 3
+        c.run()
+        written = [x for x in out.written if x != '\n']
+        self.assertEqual('cache is on', written[0])
+        self.assertEqual('hits: 3', written[1])
+        c.run('off')
+        self.assertEqual(False, pyrrhic.get_cache().enabled)
+
+
+class CompressionTestCase(unittest.TestCase):
+
+    def _response(self, body, encoding):
+        response = mock.Mock()
+        response.info.return_value = build_headers(content_encoding=encoding)
+        chunks = [body[i:i + 7] for i in range(0, len(body), 7)]
+        response.read.side_effect = chunked_reader(*chunks)
+        return response
+
+    def _gzip(self, data):
+        import gzip
+        import StringIO
+        out = StringIO.StringIO()
+        f = gzip.GzipFile(fileobj=out, mode='wb')
+        f.write(data)
+        f.close()
+        return out.getvalue()
+
+    def testAcceptEncoding(self):
+        handler = pyrrhic.compression.ContentEncodingHandler()
+        req = handler.http_request(pyrrhic.http.Request('http://foo.com/'))
+        self.assertEqual('gzip, deflate', req.unredirected_hdrs['Accept-encoding'])
+
+        # Don't override an explicit header
+        req = pyrrhic.http.Request('http://foo.com/',
+                                   headers={'Accept-Encoding': 'identity'})
+        req = handler.http_request(req)
+        self.failIf('Accept-encoding' in req.unredirected_hdrs)
+
+    def testGzip(self):
+        import zlib
+        body = 'Body Content ' * 1000
+        handler = pyrrhic.compression.ContentEncodingHandler()
+        response = handler.http_response(None,
+            self._response(self._gzip(body), 'gzip'))
+        # Read in small pieces, to exercise the incremental decoding
+        chunks = []
+        while True:
+            data = response.read(100)
+            if not data:
+                break
+            self.failUnless(len(data) <= 100)
+            chunks.append(data)
+        self.assertEqual(body, ''.join(chunks))
+        self.assertEqual(len(body), response.compression.decoded)
+        self.assertEqual(len(self._gzip(body)), response.compression.compressed)
+        self.failUnless(response.compression.saving > 0.9)
+
+    def testDeflate(self):
+        import zlib
+        body = 'line one\nline two\n'
+        handler = pyrrhic.compression.ContentEncodingHandler()
+        for data in (zlib.compress(body), zlib.compress(body)[2:-4]):
+            # Both zlib-wrapped and raw deflate data are accepted
+            response = handler.http_response(None,
+                self._response(data, 'deflate'))
+            self.assertEqual(['line one\n', 'line two\n'], response.readlines())
+
+    def testUncompressed(self):
+        handler = pyrrhic.compression.ContentEncodingHandler()
+        response = mock.Mock()
+        response.info.return_value = build_headers()
+        self.failUnless(handler.http_response(None, response) is response)
+
+    def testStats(self):
+        stats = pyrrhic.compression.CompressionStats('gzip')
+        stats.compressed = 256
+        stats.decoded = 1024
+        self.assertEqual('gzip, 256 bytes -> 1.0 KB (75% saved)', str(stats))
+
+
+class BatchTestCase(StdoutRedirectorBase):
+
+    def testParseStatuses(self):
+        expected = pyrrhic.ui.parse_statuses('2xx, 404')
+        self.assertEqual(True, expected(200))
+        self.assertEqual(True, expected(204))
+        self.assertEqual(True, expected(404))
+        self.assertEqual(False, expected(301))
+        self.assertEqual(False, expected(500))
+        self.assertRaises(ValueError, pyrrhic.ui.parse_statuses, '2x')
+        self.assertRaises(ValueError, pyrrhic.ui.parse_statuses, 'abc')
+
+    def testReadScript(self):
+        lines = pyrrhic.ui.read_script([
+            '# Comment\n',
+            'r http://foo.com news\n',
+            '\n',
+            'get news\n',
+        ], {})
+        self.assertEqual([2, 4], [line.number for line in lines])
+        self.assertEqual(('news',), lines[1].args)
+        self.failUnless(isinstance(lines[1].command, pyrrhic.commands.GetCommand))
+
+    @mock.patch('pyrrhic.Resource.get')
+    def testBatch(self, mock_get):
+        out, err = self._stdout()
+        build_mock_response(mock_get, data='Body Content')
+        script = ['r http://foo.com\n', 'get\n', 'get\n']
+        expected = pyrrhic.ui.parse_statuses('2xx')
+        self.assertEqual(0, pyrrhic.ui.batch(script, expected))
+        self.assertEqual(2, mock_get.call_count)
+        written = ''.join(out.written)
+        self.failUnless(written.find('3 commands, 0 failed') > -1)
+
+    @mock.patch('pyrrhic.Resource.get')
+    def testUnexpectedStatus(self, mock_get):
+        out, err = self._stdout()
+        build_mock_response(mock_get, code=404, msg='Not Found')
+        script = ['r http://foo.com\n', 'get\n']
+        expected = pyrrhic.ui.parse_statuses('2xx')
+        self.assertEqual(1, pyrrhic.ui.batch(script, expected))
+        written = ''.join(out.written)
+        self.failUnless(written.find('unexpected status 404') > -1)
+        self.failUnless(written.find('FAIL 404') > -1)
+
+    def testValidationError(self):
+        out, err = self._stdout()
+        expected = pyrrhic.ui.parse_statuses('2xx')
+        self.assertEqual(1, pyrrhic.ui.batch(['get nosuchresource\n'], expected))
+
+    def testUnknownCommand(self):
+        out, err = self._stdout()
+        expected = pyrrhic.ui.parse_statuses('2xx')
+        self.assertEqual(1, pyrrhic.ui.batch(['gett foo\n', 'q\n'], expected))
+        written = ''.join(out.written)
+        self.failUnless('Unknown command' in written)
+        self.failUnless('2 commands, 1 failed' in written)
+        self.failUnless('1\tFAIL\t' in written)
+
+    @mock.patch('pyrrhic.Resource.get')
+    def testUnexpectedError(self, mock_get):
+        out, err = self._stdout()
+        build_mock_response(mock_get, data='Body Content')
+        mock_get.side_effect = [ValueError('oops'), mock_get.return_value]
+        script = ['r http://foo.com\n', 'get\n', 'get\n']
+        expected = pyrrhic.ui.parse_statuses('2xx')
+        # The rest of the script still runs, and the summary is printed
+        self.assertEqual(1, pyrrhic.ui.batch(script, expected))
+        self.assertEqual(2, mock_get.call_count)
+        self.failUnless('ValueError: oops' in ''.join(err.written))
+        written = ''.join(out.written)
+        self.failUnless(written.find('3 commands, 1 failed') > -1)
+
+    @mock.patch('pyrrhic.Resource.get')
+    def testParallel(self, mock_get):
+        out, err = self._stdout()
+        mock_get.side_effect = lambda: build_mock_response(mock.Mock(),
+            data=str(mock_get.call_count))
+        script = ['r http://foo.com\n'] + ['get\n'] * 6 + ['s\n', 'get\n']
+        expected = pyrrhic.ui.parse_statuses('2xx')
+        self.assertEqual(0, pyrrhic.ui.batch(script, expected, parallel=3))
+        self.assertEqual(7, mock_get.call_count)
+        written = ''.join(out.written)
+        self.failUnless(written.find('9 commands, 0 failed') > -1)
+
+    def testOptions(self):
+        out, err = self._stdout()
+        options = pyrrhic.ui.parse_options(['-f', 'script.pyr', '-j', '4',
+                                            '--expect', '2xx,404'])
+        self.assertEqual('script.pyr', options.script)
+        self.assertEqual(4, options.parallel)
+        self.assertEqual(True, options.expect(404))
+        options = pyrrhic.ui.parse_options([])
+        self.assertEqual(None, options.script)
+        self.assertRaises(SystemExit, pyrrhic.ui.parse_options, ['-j', '0'])
+        self.assertRaises(SystemExit, pyrrhic.ui.parse_options,
+                          ['--expect', 'oops'])
+
+
+class FanOutTestCase(StdoutRedirectorBase):
+
+    def setUp(self):
+        self.resources = {
+            'node1': pyrrhic.Resource('http://node1.foo.com'),
+            'node2': pyrrhic.Resource('http://node2.foo.com'),
+            'other': pyrrhic.Resource('http://other.foo.com'),
+        }
+        self.c = pyrrhic.commands.GetCommand(self.resources)
+
+    def testParallelMap(self):
+        import time
+        def slow_square(x):
+            time.sleep(0.001 * (5 - x))
+            return x * x
+        parallel_map = pyrrhic.jobs.parallel_map
+        self.assertEqual([0, 1, 4, 9, 16],
+                         parallel_map(slow_square, range(5), 3))
+        self.assertEqual([], parallel_map(slow_square, [], 3))
+
+    def testFanOutValidation(self):
+        ValidationError = pyrrhic.commands.ValidationError
+        self.c.validate('node*')
+        self.c.validate('@all')
+        self.c.validate('node[12]', '-c', '2')
+        self.assertRaises(ValidationError, self.c.validate, 'nothing*')
+        self.assertRaises(ValidationError, self.c.validate, 'node*', '-c', 'x')
+        self.assertRaises(ValidationError, self.c.validate, 'node*', '-c', '0')
+        self.assertRaises(ValidationError, self.c.validate, 'node1', '-c', '2')
+        self.assertRaises(ValidationError, self.c.validate, 'node*', '>', 'f')
+        self.assertEqual(True, self.c.is_fan_out('@all'))
+        self.assertEqual(False, self.c.is_fan_out('node1'))
+
+    @mock.patch('pyrrhic.Resource.get')
+    def testFanOut(self, mock_get):
+        out, err = self._stdout()
+        def get():
+            response = build_mock_response(mock.Mock())
+            response.read.side_effect = chunked_reader('Body Content')
+            return response
+        mock_get.side_effect = get
+        self.c.run('node*')
+        self.assertEqual(2, mock_get.call_count)
+        lines = ''.join(out.written).splitlines()
+        self.assertEqual(3, len(lines))
+        self.failUnless(lines[0].startswith('resource  status'))
+        self.failUnless(lines[1].startswith('node1     200'))
+        self.failUnless(lines[2].startswith('node2     200'))
+        self.failUnless(lines[1].endswith('12 bytes'))
+        self.failIf('Body Content' in ''.join(out.written))
+
+    @mock.patch('pyrrhic.Resource.get')
+    def testFanOutError(self, mock_get):
+        import urllib2
+        out, err = self._stdout()
+        mock_get.side_effect = urllib2.URLError('dummy')
+        self.c.run('@all', '-c', '1')
+        lines = ''.join(out.written).splitlines()
+        self.assertEqual(4, len(lines))
+        self.failUnless(lines[3].startswith('other     URLError'))
+        self.failUnless(lines[3].endswith('-'))
+        import httplib
+        mock_get.side_effect = httplib.BadStatusLine('')
+        self.c.run('@all')
+        self.failUnless('other     BadStatusLine' in ''.join(out.written))
+
+
+class RequestBatchTestCase(StdoutRedirectorBase):
+
+    def setUp(self):
+        self.resource = pyrrhic.Resource('http://foo.com:8080/resource')
+        self.resources = {'__default__': self.resource}
+        self.c = pyrrhic.commands.BatchCommand(self.resources)
+
+    def _open(self, request):
+        response = build_mock_response(mock.Mock(), data=request.get_full_url())
+        response.geturl.return_value = request.get_full_url()
+        response.timings = pyrrhic.http.Timings()
+        response.compression = None
+        return response
+
+    def testJoin(self):
+        self.assertEqual('http://foo.com:8080/resource/items/1',
+                         self.resource.join('items/1').url)
+        self.assertEqual('http://foo.com:8080/resource/items?a=b',
+                         self.resource.join('/items?a=b').url)
+        self.assertEqual('http://foo.com:8080/resource?page=2',
+                         self.resource.join('?page=2').url)
+        self.resource.set_authentication('user', 'pass')
+        child = self.resource.join('items')
+        self.assertEqual(True, child.has_authentication)
+        self.assertEqual(self.resource._headers, child._headers)
+
+    def testImap(self):
+        import time
+        def slow_square(x):
+            time.sleep(0.001 * (5 - x))
+            return x * x
+        for concurrency in (1, 3):
+            results = pyrrhic.jobs.imap(slow_square, range(5), concurrency)
+            self.assertEqual([0, 1, 4, 9, 16], list(results))
+
+    def testImapThreads(self):
+        import threading
+        threads = set()
+        def record(x):
+            threads.add(threading.current_thread())
+            return x
+        # However many items there are, only `concurrency` threads run them
+        self.assertEqual(range(50), list(pyrrhic.jobs.imap(record, range(50),
+                                                           3)))
+        self.failUnless(len(threads) <= 3)
+        self.failIf(threading.current_thread() in threads)
+        results = pyrrhic.jobs.imap(record, range(50), 3)
+        self.assertEqual(0, next(results))
+        results.close()
+
+    @mock.patch('urllib2.OpenerDirector.open')
+    def testBatch(self, mock_open):
+        mock_open.side_effect = self._open
+        paths = ['items/%d' % i for i in range(5)]
+        for connections in (1, 2):
+            responses = list(self.resource.batch(paths,
+                                                 connections=connections))
+            self.assertEqual(5, len(responses))
+            for path, response in zip(paths, responses):
+                url = 'http://foo.com:8080/resource/' + path
+                self.assertEqual(url, response.geturl())
+                self.assertEqual(url, response.read())
+                self.assertEqual(200, response.code)
+
+    @mock.patch('urllib2.OpenerDirector.open')
+    def testBatchReadsBody(self, mock_open):
+        mock_open.side_effect = self._open
+        response = self.resource.batch(['a']).next()
+        self.failUnless(isinstance(response, pyrrhic.http.BufferedResponse))
+        opened = mock_open.call_args[0][0]
+        self.assertEqual('GET', opened.get_method())
+
+    def testBatchCommandValidation(self):
+        ValidationError = pyrrhic.commands.ValidationError
+        self.c.validate('a', 'b')
+        self.c.validate('a', '-c', '2')
+        self.assertRaises(ValidationError, self.c.validate)
+        self.assertRaises(ValidationError, self.c.validate, '-c', '2')
+        self.assertRaises(ValidationError, self.c.validate, '@/no/such/file')
+        self.assertRaises(ValidationError, pyrrhic.commands.BatchCommand({}).validate, 'a')
+
+    @mock.patch('urllib2.OpenerDirector.open')
+    def testBatchCommand(self, mock_open):
+        import tempfile
+        mock_open.side_effect = self._open
+        self.resources['news'] = pyrrhic.Resource('http://foo.com/news')
+        f = tempfile.NamedTemporaryFile()
+        f.write('2\n\n3\n')
+        f.flush()
+        out, err = self._stdout()
+        self.c.run('news', '1', '@' + f.name, '-c', '2')
+        f.close()
+        lines = ''.join(out.written).splitlines()
+        self.assertEqual(5, len(lines))
+        self.failUnless(lines[0].startswith('status'))
+        for line, path in zip(lines[1:4], '123'):
+            self.failUnless(line.startswith('200'))
+            self.failUnless(line.endswith(' ' + path))
+        self.failUnless(lines[4].startswith('3 requests over 2 connection(s)'))
+
+    @mock.patch('urllib2.OpenerDirector.open')
+    def testBatchCommandError(self, mock_open):
+        import urllib2
+        mock_open.side_effect = urllib2.URLError('dummy')
+        out, err = self._stdout()
+        self.c.run('a', 'b')
+        lines = ''.join(out.written).splitlines()
+        self.failUnless(lines[1].startswith('Stopped after 0 of 2'))
+
+
+class BenchmarksTestCase(StdoutRedirectorBase):
+
+    def testRun(self):
+        import pyrrhic.benchmarks
+        results = pyrrhic.benchmarks.run(3, ['resource-get*', 'console-get'])
+        names = [scenario['name'] for scenario in results['scenarios']]
+        self.assertEqual(['resource-get', 'resource-get-close',
+                          'resource-get-chunked', 'resource-get-1mb',
+                          'resource-get-latency', 'console-get'], names)
+        for scenario in results['scenarios']:
+            self.assertEqual(3, scenario['requests'])
+            self.assertEqual({'200': 3}, scenario['status_codes'])
+            self.failUnless(scenario['requests_per_sec'] > 0)
+        # The console prints the response, the Resource API doesn't
+        self.assertEqual(0, results['scenarios'][0]['printed_bytes'])
+        self.failUnless(results['scenarios'][-1]['printed_bytes'] > 1024)
+
+    def testRunIsolated(self):
+        import pyrrhic.benchmarks
+        result = pyrrhic.benchmarks.run_isolated(
+            'resource-get', pyrrhic.benchmarks.resource_get, {}, 2)
+        self.assertEqual({'200': 2}, result['status_codes'])
+        if pyrrhic.benchmarks.resource is not None:
+            self.failUnless(result['peak_memory_kb'] > 0)
+        # A scenario that fails in its process fails the run
+        self.assertRaises(RuntimeError, pyrrhic.benchmarks.run_isolated,
+                          'broken', lambda resources: 1 / 0, {}, 1)
+
+    def testMain(self):
+        import json
+        import tempfile
+        import pyrrhic.benchmarks
+        out, err = self._stdout()
+        f = tempfile.NamedTemporaryFile()
+        pyrrhic.benchmarks.main(['-n', '2', '-o', f.name, 'command-get'])
+        results = json.load(open(f.name))
+        f.close()
+        self.assertEqual(1, len(results['scenarios']))
+        scenario = results['scenarios'][0]
+        self.assertEqual('command-get', scenario['name'])
+        self.assertEqual(['p100', 'p50', 'p90', 'p99'],
+                         sorted(scenario['latency_ms']))
+        self.failUnless(''.join(out.written).startswith('command-get'))
+
+
+class SessionTestCase(StdoutRedirectorBase):
+
+    def setUp(self):
+        import tempfile
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'session')
+
+    def tearDown(self):
+        import shutil
+        StdoutRedirectorBase.tearDown(self)
+        pyrrhic.commands.payloads = {}
+        shutil.rmtree(self.directory)
+
+    def _lines(self):
+        return open(self.path).read().splitlines()
+
+    def testSaveAndLoad(self):
+        import pyrrhic.session
+        session = pyrrhic.session.Session(self.path)
+        session.resources['news'] = pyrrhic.Resource('news.bbc.co.uk')
+        session.resources['news'].set_authentication('user', 'pass')
+        session.payloads['login'] = 'user=bob'
+        session.close()
+        self.assertEqual(0600, os.stat(self.path).st_mode & 0777)
+
+        session = pyrrhic.session.Session(self.path)
+        self.assertEqual(['news'], session.resources.keys())
+        self.failUnless(session.resources.has_key('news'))
+        self.failIf('other' in session.resources)
+        # Nothing is built until it's used
+        self.assertEqual({}, session.resources._loaded)
+        news = session.resources['news']
+        self.assertEqual('http://news.bbc.co.uk:80', news.url)
+        self.failUnless(isinstance(news.url, str))
+        self.assertEqual(True, news.has_authentication)
+        self.assertEqual('Basic %s' % base64.b64encode('user:pass'),
+                         news._headers['Authorization'])
+        self.assertEqual('user=bob', session.payloads['login'])
+        self.assertRaises(KeyError, lambda: session.resources['other'])
+
+    def testIncrementalSave(self):
+        import pyrrhic.session
+        session = pyrrhic.session.Session(self.path)
+        session.resources['a'] = pyrrhic.Resource('a.com')
+        session.resources['b'] = pyrrhic.Resource('b.com')
+        self.assertEqual(3, len(self._lines()))
+        # Only changed resources are written again
+        session.resources['a'].set_authentication('user', 'pass')
+        session.sync()
+        session.sync()
+        lines = self._lines()
+        self.assertEqual(4, len(lines))
+        self.failUnless(lines[-1].startswith('resource\ta\t'))
+        del session.resources['b']
+        self.assertEqual('resource\tb\t', self._lines()[-1])
+        session.close()
+
+        session = pyrrhic.session.Session(self.path)
+        self.assertEqual(['a'], session.resources.keys())
+        self.assertEqual(True, session.resources['a'].has_authentication)
+
+    def testCompact(self):
+        import pyrrhic.session
+        session = pyrrhic.session.Session(self.path)
+        for i in range(pyrrhic.session.COMPACT_MIN_RECORDS + 1):
+            session.resources['a'] = pyrrhic.Resource('a.com:%d' % i)
+        session.close()
+        session = pyrrhic.session.Session(self.path)
+        self.assertEqual(2, len(self._lines()))
+        self.assertEqual('http://a.com:1000', session.resources['a'].url)
+
+    def testNotASession(self):
+        import pyrrhic.session
+        open(self.path, 'w').write('junk\n')
+        self.assertRaises(ValueError, pyrrhic.session.Session, self.path)
+
+    def testOpenSession(self):
+        options = pyrrhic.ui.parse_options(['--session', self.path])
+        session = pyrrhic.ui.open_session(options)
+        self.failUnless(pyrrhic.commands.payloads is session.payloads)
+        session.close()
+        options = pyrrhic.ui.parse_options(['--no-session'])
+        self.assertEqual(None, pyrrhic.ui.open_session(options))
+        # Scripts don't use the default session
+        options = pyrrhic.ui.parse_options(['-f', 'script.pyr'])
+        self.assertEqual(None, pyrrhic.ui.open_session(options))
+        # Nor do single commands, unless they're given one
+        options = pyrrhic.ui.parse_options(['-c', 'get news'])
+        with mock.patch('pyrrhic.session.DEFAULT_PATH', self.path):
+            self.assertEqual(None, pyrrhic.ui.open_session(options))
+        self.failIf(os.path.exists(self.path))
+        options = pyrrhic.ui.parse_options(['-c', 'get news', '--session',
+                                            self.path])
+        session = pyrrhic.ui.open_session(options)
+        self.failUnless(pyrrhic.commands.payloads is session.payloads)
+        session.close()
+
+    @mock.patch('pyrrhic.ui.raw_input', create=True)
+    def testConsoleSavesSession(self, mock_input):
+        import pyrrhic.session
+        out, err = self._stdout()
+        mock_input.side_effect = ['r foo.com foo', 'auth user pass foo',
+                                  EOFError]
+        pyrrhic.ui.console(['--session', self.path])
+        session = pyrrhic.session.Session(self.path)
+        self.assertEqual(True, session.resources['foo'].has_authentication)
+
+    def testPayloadCommand(self):
+        out, err = self._stdout()
+        ValidationError = pyrrhic.commands.ValidationError
+        c = pyrrhic.commands.PayloadCommand({})
+        c.validate()
+        c.validate('login', ':user=bob')
+        self.assertRaises(ValidationError, c.validate, 'login')
+        self.assertRaises(ValidationError, c.validate, '-d', 'login')
+        self.assertRaises(ValidationError, c.validate, 'login', 'user=bob')
+        c.run('login', ':user=bob')
+        c.validate('login')
+        c.run('login')
+        c.run()
+        self.assertEqual(':user=bob\nlogin\t\t:user=bob\n', ''.join(out.written))
+        c.run('-d', 'login')
+        self.assertEqual({}, pyrrhic.commands.payloads)
+
+    @mock.patch('pyrrhic.Resource.post')
+    def testUsePayload(self, mock_post):
+        out, err = self._stdout()
+        build_mock_response(mock_post)
+        pyrrhic.commands.payloads['login'] = 'user=bob'
+        resources = {'__default__': pyrrhic.Resource('foo.com'),
+                     'news': pyrrhic.Resource('news.com')}
+        c = pyrrhic.commands.PostCommand(resources)
+        c.validate('+login')
+        c.validate('news', '+login')
+        self.assertRaises(pyrrhic.commands.ValidationError, c.validate, '+other')
+        c.run('news', '+login')
+        mock_post.assert_called_with(data={'user': ['bob']})
+
+
+class UploadTestCase(StdoutRedirectorBase):
+
+    def setUp(self):
+        import tempfile
+        self.file = tempfile.NamedTemporaryFile()
+        self.file.write('x' * 100)
+        self.file.flush()
+        self.file.seek(0)
+        self.conn = mock.Mock()
+        self.resources = {'__default__': pyrrhic.Resource('http://foo.com'),
+                          'news': pyrrhic.Resource('http://news.com')}
+
+    def tearDown(self):
+        StdoutRedirectorBase.tearDown(self)
+        self.file.close()
+
+    def _sent(self):
+        return ''.join(args[0] for args, kw in self.conn.send.call_args_list)
+
+    def testFromFile(self):
+        import StringIO
+        upload = pyrrhic.streaming.Upload.from_file(self.file)
+        self.assertEqual(100, upload.size)
+        self.assertEqual(False, upload.chunked)
+        upload = pyrrhic.streaming.Upload.from_file(StringIO.StringIO('abc'))
+        self.assertEqual(None, upload.size)
+        self.assertEqual(True, upload.chunked)
+
+    def testSendWithLength(self):
+        upload = pyrrhic.streaming.Upload.from_file(self.file)
+        upload.send(self.conn, chunk_size=30)
+        self.assertEqual(4, self.conn.send.call_count)
+        self.assertEqual('x' * 100, self._sent())
+        self.failIf(self.file.closed)
+        self.assertEqual(True, upload.rewind())
+        self.assertEqual(0, self.file.tell())
+
+    def testSendChunked(self):
+        import StringIO
+        upload = pyrrhic.streaming.Upload(StringIO.StringIO('x' * 40),
+                                          close=True)
+        upload.send(self.conn, chunk_size=30)
+        self.assertEqual('1e\r\n%s\r\na\r\n%s\r\n0\r\n\r\n' % ('x' * 30, 'x' * 10),
+                         self._sent())
+        self.failUnless(upload.file.closed)
+
+    def testProgress(self):
+        out, err = self._stdout()
+        progress = pyrrhic.streaming.UploadProgress(0, sys.stdout)
+        upload = pyrrhic.streaming.Upload.from_file(self.file, progress)
+        upload.send(self.conn)
+        self.assertEqual(100, progress.bytes)
+        self.failUnless(''.join(out.written).startswith('\r100 bytes sent, '))
+
+    def testNotRewindable(self):
+        upload = pyrrhic.streaming.Upload(mock.Mock(spec=['read']))
+        self.assertEqual(False, upload.rewind())
+
+    def testRewindClosed(self):
+        # Files from a FileSource are closed once sent, and opened again
+        upload = pyrrhic.streaming.FileSource(self.file.name).open()
+        upload.send(self.conn)
+        self.failUnless(upload.file.closed)
+        self.assertEqual(True, upload.rewind())
+        upload.send(self.conn)
+        self.assertEqual('x' * 200, self._sent())
+        # Files closed by someone else can't be sent again
+        upload = pyrrhic.streaming.Upload.from_file(self.file)
+        self.file.close()
+        self.assertEqual(False, upload.rewind())
+
+    @mock.patch('select.select')
+    def testRetryOnDroppedConnection(self, mock_select):
+        import httplib
+        mock_select.return_value = ([], [], [])
+        pool = pyrrhic.http.ConnectionPool()
+        handler = pyrrhic.http.KeepAliveHTTPHandler(pool)
+        handler.parent = mock.Mock()
+        handler.parent.addheaders = []
+        key = ('http', 'foo.com')
+        # An idle connection that the server has since closed
+        dropped = mock.Mock()
+        dropped.getresponse.side_effect = httplib.BadStatusLine('')
+        pool.get(key, lambda: dropped)
+        pool.release(key, dropped)
+        fresh = mock.Mock()
+        fresh.sock = None
+        response = fresh.getresponse.return_value
+        response.status = 200
+        response.version = 11
+        response.isclosed.return_value = False
+        upload = pyrrhic.streaming.FileSource(self.file.name).open()
+        req = handler.http_request(pyrrhic.http.Request(
+            'http://foo.com/', data=upload, req_method='PUT'))
+        req.timeout = None
+        result = handler.do_open(lambda host, **kw: fresh, req)
+        self.assertEqual(200, result.code)
+        self.conn = dropped
+        self.assertEqual('x' * 100, self._sent())
+        self.conn = fresh
+        self.assertEqual('x' * 100, self._sent())
+
+    def testUnparseableResponse(self):
+        import httplib
+        import urllib2
+        pool = pyrrhic.http.ConnectionPool()
+        handler = pyrrhic.http.KeepAliveHTTPHandler(pool)
+        handler.parent = mock.Mock()
+        handler.parent.addheaders = []
+        conn = mock.Mock()
+        conn.sock = None
+        conn.getresponse.side_effect = httplib.LineTooLong('header line')
+        req = handler.http_request(pyrrhic.http.Request('http://foo.com/'))
+        req.timeout = None
+        self.assertRaises(urllib2.URLError, handler.do_open,
+                          lambda host, **kw: conn, req)
+        # Closed, and no longer counted as in use
+        self.failUnless(conn.close.called)
+        self.assertEqual([(('http', 'foo.com'), 0, 0, 1, 0)], pool.stats())
+
+    def testRequestHeaders(self):
+        import StringIO
+        handler = pyrrhic.http.KeepAliveHTTPHandler(pyrrhic.http.ConnectionPool())
+        handler.parent = mock.Mock()
+        handler.parent.addheaders = []
+        upload = pyrrhic.streaming.Upload.from_file(self.file)
+        req = pyrrhic.http.Request('http://foo.com/', data=upload,
+                                   req_method='PUT')
+        req = handler.http_request(req)
+        self.failUnless(req.data is upload)
+        self.assertEqual('100', req.unredirected_hdrs['Content-length'])
+        self.assertEqual('application/octet-stream',
+                         req.unredirected_hdrs['Content-type'])
+        upload = pyrrhic.streaming.Upload(StringIO.StringIO('abc'))
+        req = pyrrhic.http.Request('http://foo.com/', data=upload,
+                                   req_method='PUT')
+        req.add_header('Content-type', 'application/json')
+        req = handler.http_request(req)
+        self.assertEqual('chunked', req.unredirected_hdrs['Transfer-encoding'])
+        self.failIf('Content-length' in req.unredirected_hdrs)
+        self.assertEqual('application/json', req.get_header('Content-type'))
+
+    @mock.patch('urllib2.OpenerDirector.open')
+    def testResourceFile(self, mock_open):
+        build_mock_response(mock_open)
+        self.resources['news'].put(self.file)
+        request = mock_open.call_args[0][0]
+        self.failUnless(isinstance(request.data, pyrrhic.streaming.Upload))
+        self.failUnless(request.data.file is self.file)
+
+    def testParseData(self):
+        c = pyrrhic.commands.PutCommand(self.resources)
+        for args in (('@' + self.file.name, 'news'),
+                     ('news', '@' + self.file.name)):
+            name, data = c._parse_resource_data(*args)
+            self.assertEqual('news', name)
+            self.assertEqual(self.file.name, data.path)
+        self.assertEqual(('news', {'a': ['b']}),
+                         c._parse_resource_data(':a=b', 'news'))
+        self.assertEqual(('@all', {}), c._parse_resource_data('@all'))
+
+    def testValidate(self):
+        ValidationError = pyrrhic.commands.ValidationError
+        c = pyrrhic.commands.PutCommand(self.resources)
+        c.validate('@' + self.file.name)
+        c.validate('news', '@-')
+        self.assertRaises(ValidationError, c.validate, '@/no/such/file')
+        self.assertRaises(ValidationError, c.validate, '@all', '@-')
+        get = pyrrhic.commands.GetCommand(self.resources)
+        self.assertRaises(ValidationError, get.validate, '@' + self.file.name)
+        self.assertRaises(ValidationError, get.validate, ':a=b')
+
+    @mock.patch('pyrrhic.Resource.put')
+    def testCommand(self, mock_put):
+        out, err = self._stdout()
+        def put(data):
+            data.send(mock.Mock())
+            return build_mock_response(mock.Mock(), data='ok')
+        mock_put.side_effect = put
+        c = pyrrhic.commands.PutCommand(self.resources)
+        c.run('@' + self.file.name, 'news')
+        output = ''.join(out.written)
+        self.failUnless(output.startswith('\r100 bytes sent'))
+        self.failUnless('200 OK' in output)
+
+
+class WatchCommandTestCase(StdoutRedirectorBase):
+
+    def setUp(self):
+        self.resources = {'__default__': pyrrhic.Resource('http://foo.com'),
+                          'news': pyrrhic.Resource('http://news.com')}
+        self.c = pyrrhic.commands.WatchCommand(self.resources)
+
+    def _responses(self, *bodies):
+        def get():
+            code, etag, body = bodies[get.calls]
+            get.calls += 1
+            response = build_mock_response(mock.Mock(), code=code)
+            response.info.return_value = build_headers(
+                etag=etag, date='Mon, 01 Jan 2024 00:00:0%d GMT' % get.calls)
+            response.read.side_effect = chunked_reader(body)
+            return response
+        get.calls = 0
+        return get
+
+    def testValidate(self):
+        ValidationError = pyrrhic.commands.ValidationError
+        self.c.validate()
+        self.c.validate('news', '-n', '0.5', '-t', '3')
+        self.assertRaises(ValidationError, self.c.validate, '-n', 'x')
+        self.assertRaises(ValidationError, self.c.validate, '-n', '0')
+        self.assertRaises(ValidationError, self.c.validate, 'nothing')
+        self.assertRaises(ValidationError, self.c.validate, '@all')
+        self.assertRaises(ValidationError, self.c.validate, '>', 'file')
+
+    @mock.patch('time.sleep')
+    @mock.patch('pyrrhic.Resource.get')
+    def testWatch(self, mock_get, mock_sleep):
+        out, err = self._stdout()
+        mock_get.side_effect = self._responses(
+            (200, '"1"', 'a\nb\nc\n'),
+            (200, '"1"', 'a\nb\nc\n'),
+            (200, '"2"', 'a\nB\nc\n'),
+            (404, '"2"', 'a\nB\nc\n'))
+        self.c.run('news', '-t', '4', '-n', '5')
+        self.assertEqual(4, mock_get.call_count)
+        self.assertEqual([((5.0,), {})] * 3, mock_sleep.call_args_list)
+        lines = ''.join(out.written).splitlines()
+        # The first response in full, but not the Date header
+        self.assertEqual(['200 OK', 'etag: "1"', 'a', 'b', 'c', ''], lines[:6])
+        # The second was the same, so nothing is printed for it
+        self.failUnless(lines[6].endswith('] changed'))
+        self.assertEqual(['- etag: "1"', '+ etag: "2"', '@@ -1,3 +1,3 @@',
+                          ' a', '-b', '+B', ' c'], lines[7:14])
+        self.failUnless(lines[14].endswith('] changed'))
+        self.assertEqual(['- 200 OK', '+ 404 OK'], lines[15:17])
+        self.assertEqual('4 requests, 2 changed', lines[17])
+
+    @mock.patch('pyrrhic.commands.WATCH_DIFF_LIMIT', 4)
+    @mock.patch('time.sleep')
+    @mock.patch('pyrrhic.Resource.get')
+    def testWatchLargeBody(self, mock_get, mock_sleep):
+        import hashlib
+        out, err = self._stdout()
+        mock_get.side_effect = self._responses(
+            (200, '"1"', 'abcdefgh'),
+            (200, '"1"', 'abcdefgX'))
+        self.c.run('news', '-t', '2')
+        lines = ''.join(out.written).splitlines()
+        # Still printed in full, but only compared by its hash
+        self.assertEqual(['200 OK', 'etag: "1"', 'abcdefgh'], lines[:3])
+        self.assertEqual(['- body: 8 bytes, sha1 %s'
+                          % hashlib.sha1('abcdefgh').hexdigest(),
+                          '+ body: 8 bytes, sha1 %s'
+                          % hashlib.sha1('abcdefgX').hexdigest()], lines[4:6])
+        response = self._responses((200, '"1"', 'abcd'))()
+        self.assertEqual('abcd', pyrrhic.commands.Snapshot(response).read(
+            response).body)
+
+    @mock.patch('time.sleep')
+    @mock.patch('pyrrhic.Resource.get')
+    def testInterrupt(self, mock_get, mock_sleep):
+        import urllib2
+        out, err = self._stdout()
+        mock_get.side_effect = urllib2.URLError('dummy')
+        mock_sleep.side_effect = [None, KeyboardInterrupt]
+        self.c.run()
+        lines = ''.join(out.written).splitlines()
+        self.assertEqual(4, len(lines))
+        self.failUnless(lines[0].endswith('dummy>'))
+        self.assertEqual('2 requests, 0 changed', lines[-1])
+
+
+class H2Server(object):
+    """
+    A minimal h2c server for the HTTP/2 tests, answering each request with
+    its method, path and body size
+    """
+
+    def __init__(self):
+        import socket
+        import threading
+        self.sock = socket.socket()
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(5)
+        self.url = 'http://%s:%d/' % self.sock.getsockname()
+        thread = threading.Thread(target=self._accept)
+        thread.daemon = True
+        thread.start()
+
+    def _accept(self):
+        import socket
+        import threading
+        while True:
+            try:
+                client, _ = self.sock.accept()
+            except socket.error:
+                return
+            thread = threading.Thread(target=self._serve, args=(client,))
+            thread.daemon = True
+            thread.start()
+
+    def _serve(self, client):
+        import h2.config
+        import h2.connection
+        import h2.events
+        conn = h2.connection.H2Connection(
+            config=h2.config.H2Configuration(client_side=False))
+        conn.initiate_connection()
+        client.sendall(conn.data_to_send())
+        requests = {}
+        while True:
+            data = client.recv(65536)
+            if not data:
+                return
+            for event in conn.receive_data(data):
+                if isinstance(event, h2.events.RequestReceived):
+                    requests[event.stream_id] = (dict(event.headers), [])
+                elif isinstance(event, h2.events.DataReceived):
+                    requests[event.stream_id][1].append(event.data)
+                    conn.acknowledge_received_data(
+                        event.flow_controlled_length, event.stream_id)
+                elif isinstance(event, h2.events.StreamEnded):
+                    headers, body = requests.pop(event.stream_id)
+                    out = '%s %s %d\n' % (headers[':method'], headers[':path'],
+                                          len(''.join(body)))
+                    conn.send_headers(event.stream_id, [(':status', '200'),
+                                      ('content-type', 'text/plain')])
+                    conn.send_data(event.stream_id, out, end_stream=True)
+            client.sendall(conn.data_to_send())
+
+    def close(self):
+        self.sock.close()
+
+
+class Http2TestCase(StdoutRedirectorBase):
+
+    def setUp(self):
+        self.handler = pyrrhic.http2.HTTP2Handler()
+        self.resources = {'__default__': pyrrhic.Resource('http://foo.com')}
+
+    def _request(self, url='http://foo.com/', http2=True):
+        request = pyrrhic.http.Request(url)
+        request.http2 = http2
+        request.timeout = None
+        return request
+
+    def testNotRequested(self):
+        self.assertEqual(None, self.handler.http_open(self._request(http2=False)))
+
+    @mock.patch('pyrrhic.http2.h2', None)
+    def testNotInstalled(self):
+        import urllib2
+        self.assertRaises(urllib2.URLError, self.handler.http_open,
+                          self._request())
+
+    @unittest.skipIf(pyrrhic.http2.h2 is None, 'h2 is not installed')
+    @mock.patch('pyrrhic.http2.HTTP2Connection.connect')
+    def testFallBackToHttp1(self, mock_connect):
+        mock_connect.side_effect = pyrrhic.http2.NotNegotiated('foo.com:443')
+        request = self._request('https://foo.com/')
+        self.assertEqual(None, self.handler.https_open(request))
+        self.assertEqual(None, self.handler.https_open(request))
+        # The host is remembered, so it isn't asked twice
+        self.assertEqual(1, mock_connect.call_count)
+
+    def testResponse(self):
+        conn = mock.Mock()
+        conn.get_headers.return_value = [(':status', '404'),
+                                         ('content-type', 'text/plain')]
+        conn.read_chunk.side_effect = ['one\ntw', 'o\n', '']
+        response = pyrrhic.http2.HTTP2Response(conn, mock.Mock(), 'http://foo.com/',
+                                               pyrrhic.http.Timings())
+        self.assertEqual(404, response.getcode())
+        self.assertEqual('Not Found', response.msg)
+        self.assertEqual('text/plain', response.info()['Content-Type'])
+        self.assertEqual('HTTP/2', response.protocol)
+        self.assertEqual(['one\n', 'two\n'], list(response))
+        response.close()
+        self.failIf(conn.cancel.called)
+
+    def testCloseUnread(self):
+        conn = mock.Mock()
+        conn.get_headers.return_value = [(':status', '200')]
+        conn.read_chunk.side_effect = ['abc']
+        response = pyrrhic.http2.HTTP2Response(conn, mock.Mock(), 'http://foo.com/',
+                                               pyrrhic.http.Timings())
+        self.assertEqual('a', response.read(1))
+        response.close()
+        self.failUnless(conn.cancel.called)
+
+    def testResourceOption(self):
+        resource = pyrrhic.Resource('http://foo.com/a')
+        self.assertEqual(False, resource.http2)
+        resource.http2 = True
+        self.assertEqual(True, resource.join('b').http2)
+
+    @mock.patch('pyrrhic.opener')
+    def testRequestMarked(self, mock_opener):
+        mock_open = mock_opener.open
+        resource = pyrrhic.Resource('http://foo.com/a')
+        resource.get()
+        self.assertEqual(False, mock_open.call_args[0][0].http2)
+        resource.http2 = True
+        resource.get()
+        self.assertEqual(True, mock_open.call_args[0][0].http2)
+
+    @mock.patch('pyrrhic.http2.available')
+    def testCommand(self, mock_available):
+        mock_available.return_value = True
+        c = pyrrhic.commands.Http2Command(self.resources)
+        c.validate('on')
+        c.run('on')
+        self.assertEqual(True, self.resources['__default__'].http2)
+        c.run('off', '__default__')
+        self.assertEqual(False, self.resources['__default__'].http2)
+        self.assertRaises(pyrrhic.commands.ValidationError, c.validate, 'on', 'news')
+        self.assertRaises(pyrrhic.commands.ValidationError, c.validate, 'maybe')
+        mock_available.return_value = False
+        self.assertRaises(pyrrhic.commands.ValidationError, c.validate, 'on')
+        c.validate('off')
+
+    @mock.patch.dict('pyrrhic.commands.settings', {'timing': True})
+    @mock.patch('pyrrhic.Resource.get')
+    def testPrintProtocol(self, mock_get):
+        out, err = self._stdout()
+        mock_response = build_mock_response(mock_get, data='Body Content')
+        mock_response.protocol = 'HTTP/2'
+        mock_response.timings = None
+        mock_response.compression = None
+        pyrrhic.commands.GetCommand(self.resources).run()
+        self.failUnless('protocol: HTTP/2' in out.written)
+
+    def testSessionSavesOption(self):
+        import shutil
+        import tempfile
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'session')
+            session = pyrrhic.session.Session(path)
+            resource = pyrrhic.Resource('http://foo.com')
+            resource.http2 = True
+            session.resources['news'] = resource
+            session.close()
+            session = pyrrhic.session.Session(path)
+            self.assertEqual(True, session.resources['news'].http2)
+            session.close()
+        finally:
+            shutil.rmtree(directory)
+
+    @unittest.skipIf(pyrrhic.http2.h2 is None, 'h2 is not installed')
+    def testMultiplexed(self):
+        import StringIO
+        server = H2Server()
+        try:
+            resource = pyrrhic.Resource(server.url)
+            resource.http2 = True
+            response = resource.post(StringIO.StringIO('x' * 100000))
+            self.assertEqual('HTTP/2', response.protocol)
+            self.assertEqual('POST / 100000\n', response.read())
+            responses = list(resource.batch(['a', 'b', 'c', 'd'], connections=4))
+            self.assertEqual(['GET /a 0\n', 'GET /b 0\n', 'GET /c 0\n',
+                              'GET /d 0\n'], [r.read() for r in responses])
+            # All of them went over one connection
+            self.assertEqual(1, len(pyrrhic.get_http2_handler().stats()))
+        finally:
+            pyrrhic.get_http2_handler().clear()
+            server.close()
+
+
+class FormattingTestCase(unittest.TestCase):
+
+    def _format(self, formatter_class, data, chunk_size=3):
+        import StringIO
+        out = StringIO.StringIO()
+        formatter = formatter_class(out)
+        for i in range(0, len(data), chunk_size):
+            formatter.feed(data[i:i + chunk_size])
+        formatter.close()
+        return out.getvalue()
+
+    def testJson(self):
+        data = '{"a": [1, 2, {"b": "x\\"y}"}], "c": {}, "d": [], "e": null}'
+        expected = '\n'.join([
+            '{',
+            '  "a": [',
+            '    1,',
+            '    2,',
+            '    {',
+            '      "b": "x\\"y}"',
+            '    }',
+            '  ],',
+            '  "c": {},',
+            '  "d": [],',
+            '  "e": null',
+            '}'])
+        # However the body is split into chunks
+        for chunk_size in (1, 2, 3, 7, 100):
+            self.assertEqual(expected, self._format(pyrrhic.formatting.JsonFormatter,
+                                                    data, chunk_size))
+
+    def testJsonRoundTrip(self):
+        import json
+        value = {'list': range(20), 'text': 'a "quoted" \\ string',
+                 'nested': [{'x': None, 'y': True}] * 3}
+        output = self._format(pyrrhic.formatting.JsonFormatter,
+                              json.dumps(value), 5)
+        self.assertEqual(value, json.loads(output))
+
+    def testJsonLines(self):
+        self.assertEqual('{\n  "a": 1\n}\n{}\n12\n"x"',
+                         self._format(pyrrhic.formatting.JsonFormatter,
+                                      '{"a":1}\n{}\n12 "x"'))
+
+    def testNotJson(self):
+        self.assertEqual('<html>{oops}</html>',
+                         self._format(pyrrhic.formatting.JsonFormatter,
+                                      '<html>{oops}</html>'))
+
+    def testXml(self):
+        data = ('<?xml version="1.0"?><a x="1"><b>text</b><c/>'
+                '<!-- a > b --><d>\n  <e>1</e></d><f></f></a>')
+        expected = '\n'.join([
+            '<?xml version="1.0"?>',
+            '<a x="1">',
+            '  <b>text</b>',
+            '  <c/>',
+            '  <!-- a > b -->',
+            '  <d>',
+            '    <e>1</e>',
+            '  </d>',
+            '  <f></f>',
+            '</a>'])
+        for chunk_size in (1, 4, 100):
+            self.assertEqual(expected, self._format(pyrrhic.formatting.XmlFormatter,
+                                                    data, chunk_size))
+
+    def testHex(self):
+        self.assertEqual(
+            '00000000  61 62 63 00 64 65 66 67  68 69 6a 6b 6c 6d 6e 6f  '
+            '|abc.defghijklmno|\n'
+            '00000010  70 71                                             |pq|',
+            self._format(pyrrhic.formatting.HexFormatter,
+                         'abc\x00defghijklmnopq', 5))
+
+    def testGuessStyle(self):
+        guess = pyrrhic.formatting.guess_style
+        self.assertEqual('json', guess('application/json; charset=utf-8'))
+        self.assertEqual('json', guess('application/problem+json'))
+        self.assertEqual('xml', guess('text/xml'))
+        self.assertEqual('xml', guess('application/atom+xml'))
+        self.assertEqual('plain', guess('text/html'))
+        self.assertEqual('hex', guess('image/png', '\x89PNG\r\n\x1a\n\x00'))
+        self.assertEqual('plain', guess(None, 'just text\n'))
+
+    def testLineLimiter(self):
+        import StringIO
+        out = StringIO.StringIO()
+        limiter = pyrrhic.formatting.LineLimiter(out, 3, 2)
+        for data in ('1\n2\n', '3\n4\n5', '\n6\n7\n8'):
+            limiter.write(data)
+        limiter.close()
+        self.assertEqual('1\n2\n3\n... 3 lines omitted ...\n7\n8',
+                         out.getvalue())
+
+    def testLineLimiterShortBody(self):
+        import StringIO
+        out = StringIO.StringIO()
+        limiter = pyrrhic.formatting.LineLimiter(out, 3, 2)
+        limiter.write('1\n2\n3\n')
+        limiter.close()
+        self.assertEqual('1\n2\n3\n', out.getvalue())
+
+    def testBodyWriter(self):
+        out = Writeable()
+        body = pyrrhic.formatting.BodyWriter(out, 'application/json', 'auto')
+        body.write('[1,')
+        # Output starts before the body has all arrived
+        self.assertEqual(['[\n  1,\n  '], out.written)
+        body.write('2]')
+        body.close()
+        self.assertEqual('[\n  1,\n  2\n]', ''.join(out.written))
+
+
+class FormatCommandTestCase(StdoutRedirectorBase):
+
+    def setUp(self):
+        self.resources = {'__default__': pyrrhic.Resource('http://foo.com')}
+
+    @mock.patch.dict('pyrrhic.commands.settings', {'format': 'auto'})
+    def testFormatCommand(self):
+        out, err = self._stdout()
+        c = pyrrhic.commands.FormatCommand({})
+        c.validate('json')
+        self.assertRaises(pyrrhic.commands.ValidationError, c.validate, 'yaml')
+        c.run('hex')
+        self.assertEqual('hex', pyrrhic.commands.settings['format'])
+        c.run()
+        self.assertEqual(['format is hex', '\n'], out.written)
+
+    @mock.patch.dict('pyrrhic.commands.settings', {'head': 200, 'tail': 20})
+    def testLinesCommand(self):
+        c = pyrrhic.commands.LinesCommand({})
+        c.validate('10')
+        c.validate('off')
+        self.assertRaises(pyrrhic.commands.ValidationError, c.validate)
+        self.assertRaises(pyrrhic.commands.ValidationError, c.validate, 'x')
+        c.run('10', '5')
+        self.assertEqual((10, 5), (pyrrhic.commands.settings['head'],
+                                   pyrrhic.commands.settings['tail']))
+        c.run('off')
+        self.assertEqual(None, pyrrhic.commands.settings['head'])
+
+    @mock.patch.dict('pyrrhic.commands.settings', {'format': 'auto',
+                                                   'head': 3, 'tail': 1})
+    @mock.patch('pyrrhic.Resource.get')
+    def testPrettyPrinted(self, mock_get):
+        out, err = self._stdout()
+        build_mock_response(mock_get, data='{"a": [1, 2, 3]}',
+                            headers={'Content-Type': 'application/json'})
+        pyrrhic.commands.GetCommand(self.resources).run()
+        lines = ''.join(out.written).splitlines()
+        self.assertEqual(['{', '  "a": [', '    1,',
+                          '... 3 lines omitted ...', '}'], lines[2:])
+
+    @mock.patch.dict('pyrrhic.commands.settings', {'stream': True,
+                                                   'format': 'json'})
+    @mock.patch('pyrrhic.Resource.get')
+    def testStreamPrettyPrinted(self, mock_get):
+        out, err = self._stdout()
+        mock_response = build_mock_response(mock_get)
+        mock_response.read.side_effect = chunked_reader('{"a":', '1}')
+        pyrrhic.commands.GetCommand(self.resources).run()
+        self.assertEqual(['200 OK', '\n', '{\n  "a": ', '1\n}', '\n'],
+                         out.written[:5])
+
+
+class RecordingTestCase(StdoutRedirectorBase):
+
+    def setUp(self):
+        import tempfile
+        import pyrrhic.benchmarks
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'recording')
+        self.server = pyrrhic.benchmarks.BenchmarkServer(body_size=100).start()
+        self.resources = {'__default__': pyrrhic.Resource(self.server.url)}
+
+    def tearDown(self):
+        import shutil
+        StdoutRedirectorBase.tearDown(self)
+        pyrrhic.get_recorder().stop()
+        self.server.shutdown()
+        self.server.server_close()
+        pyrrhic.get_pool().clear()
+        shutil.rmtree(self.directory)
+
+    def _record(self):
+        import StringIO
+        resource = self.resources['__default__']
+        pyrrhic.get_recorder().start(self.path)
+        resource.join('a').get().read()
+        resource.post({'key': 'value'}).read()
+        resource.put(StringIO.StringIO('x' * 5000)).read()
+        # Only part of the body is read
+        response = resource.join('b').get()
+        response.read(10)
+        response.close()
+        pyrrhic.get_recorder().stop()
+
+    def testRecord(self):
+        self._record()
+        log = pyrrhic.recording.RecordingLog(self.path)
+        entries = list(log)
+        self.assertEqual(['GET', 'POST', 'PUT', 'GET'],
+                         [entry.method for entry in entries])
+        self.assertEqual(self.server.url + 'a', entries[0].url)
+        self.assertEqual(200, entries[0].status)
+        self.assertEqual(None, entries[0].request_body())
+        self.assertEqual('x' * 100, entries[0].response_body())
+        self.assertEqual('key=value', entries[1].request_body())
+        self.assertEqual('x' * 5000, entries[2].request_body())
+        self.assertEqual('x' * 10, entries[3].response_body())
+        self.failUnless(('Host', self.server.url[7:-1]) in entries[0].headers)
+        log.close()
+
+    def testRecordAppends(self):
+        self._record()
+        self._record()
+        log = pyrrhic.recording.RecordingLog(self.path)
+        entries = list(log)
+        self.assertEqual(8, len(entries))
+        self.assertEqual('x' * 5000, entries[6].request_body())
+        log.close()
+
+    def testNotRecording(self):
+        self.resources['__default__'].get().read()
+        self.failIf(os.path.exists(self.path))
+
+    def testNotARecording(self):
+        open(self.path, 'w').write('hello\n')
+        self.assertRaises(ValueError, pyrrhic.recording.RecordingLog, self.path)
+
+    def testReplay(self):
+        self._record()
+        log = pyrrhic.recording.RecordingLog(self.path)
+        for concurrency in (1, 3):
+            result = pyrrhic.recording.replay(log, pyrrhic.get_opener(),
+                                              concurrency=concurrency)
+            self.assertEqual(4, result.count)
+            self.assertEqual({200: 4}, result.statuses)
+            self.assertEqual(0, result.differed)
+        log.close()
+
+    def testRebase(self):
+        base = pyrrhic.Resource('https://other.com:8443/api')
+        self.assertEqual('https://other.com:8443/a/b?c=1',
+                         pyrrhic.recording.rebase('http://foo.com:80/a/b?c=1', base))
+        self.assertEqual('http://foo.com:80/a',
+                         pyrrhic.recording.rebase('http://foo.com:80/a', None))
+
+    def testCommands(self):
+        out, err = self._stdout()
+        record = pyrrhic.commands.RecordCommand(self.resources)
+        self.assertRaises(pyrrhic.commands.ValidationError, record.validate, 'on')
+        record.validate('on', self.path)
+        record.run('on', self.path)
+        pyrrhic.commands.GetCommand(self.resources).run()
+        out.written = []
+        record.run()
+        record.run('off')
+        record.run()
+        self.assertEqual(['recording to %s (1 requests)' % self.path,
+                          'recording is off'],
+                         ''.join(out.written).splitlines())
+        replay = pyrrhic.commands.ReplayCommand(self.resources)
+        self.assertRaises(pyrrhic.commands.ValidationError, replay.validate)
+        self.assertRaises(pyrrhic.commands.ValidationError, replay.validate,
+                          self.path, 'missing')
+        self.assertRaises(pyrrhic.commands.ValidationError, replay.validate,
+                          os.path.join(self.directory, 'missing'))
+        replay.validate(self.path, '__default__', '-c', '2', '-p')
+        out.written = []
+        replay.run(self.path, '-c', '2')
+        lines = ''.join(out.written).splitlines()
+        self.failUnless(lines[0].startswith('Requests:     1 in'))
+        self.assertEqual('Concurrency:  2', lines[1])
+        self.assertEqual('Mismatched:   0 (status not as recorded)', lines[-1])
+
+
+class ThrottlingTestCase(StdoutRedirectorBase):
+
+    def setUp(self):
+        import BaseHTTPServer
+        import SocketServer
+        import threading
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                status, headers = self.server.statuses.pop(0)
+                self.send_response(status)
+                for name, value in headers:
+                    self.send_header(name, value)
+                self.send_header('Content-Length', '2')
+                self.end_headers()
+                self.wfile.write('ok')
+
+            def do_PUT(self):
+                length = int(self.headers['Content-Length'])
+                self.server.bodies.append(self.rfile.read(length))
+                self.do_GET()
+
+            def log_message(self, format, *args):
+                pass
+
+        class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.server.statuses = []
+        self.server.bodies = []
+        thread = threading.Thread(target=self.server.serve_forever,
+                                  args=(0.01,))
+        thread.daemon = True
+        thread.start()
+        self.resource = pyrrhic.Resource('http://127.0.0.1:%d/' %
+                                         self.server.server_address[1])
+
+    def tearDown(self):
+        StdoutRedirectorBase.tearDown(self)
+        self.server.shutdown()
+        self.server.server_close()
+        pyrrhic.get_pool().clear()
+        pyrrhic.get_throttle().clear()
+
+    def testParseRate(self):
+        parse_rate = pyrrhic.throttling.parse_rate
+        self.assertEqual(10, parse_rate('10'))
+        self.assertEqual(10, parse_rate('10/s'))
+        self.assertEqual(10, parse_rate('600/m'))
+        self.assertEqual(0.5, parse_rate('1800/h'))
+        for spec in ('ten', '10/d', '0', '-1'):
+            self.assertRaises(ValueError, parse_rate, spec)
+        format_rate = pyrrhic.throttling.format_rate
+        self.assertEqual('10/s', format_rate(10))
+        self.assertEqual('30/m', format_rate(0.5))
+        self.assertEqual('36/h', format_rate(0.01))
+
+    def testParseRetryAfter(self):
+        parse = pyrrhic.throttling.parse_retry_after
+        self.assertEqual(120, parse('120', 0))
+        self.assertEqual(None, parse(None, 0))
+        self.assertEqual(None, parse('soon', 0))
+        # 784111777 is Sun, 06 Nov 1994 08:49:37 GMT
+        self.assertEqual(10, parse('Sun, 06 Nov 1994 08:49:37 GMT', 784111767))
+        self.assertEqual(0, parse('Sun, 06 Nov 1994 08:49:37 GMT', 784111787))
+
+    def testTokenBucket(self):
+        bucket = pyrrhic.throttling.TokenBucket(10, burst=2)
+        now = bucket._updated
+        self.assertEqual(0, bucket.reserve(now))
+        self.assertEqual(0, bucket.reserve(now))
+        # Each request waiting reserves the next slot
+        self.assertAlmostEqual(0.1, bucket.reserve(now))
+        self.assertAlmostEqual(0.2, bucket.reserve(now))
+        # Tokens come back over time, up to the burst
+        self.assertEqual(0, bucket.reserve(now + 10))
+        self.assertEqual(0, bucket.reserve(now + 10))
+        self.assertAlmostEqual(0.1, bucket.reserve(now + 10))
+        self.assertEqual(7, bucket.requests)
+        self.assertEqual(3, bucket.throttled)
+        self.assertAlmostEqual(0.4, bucket.waited)
+        self.assertEqual('10/s, bursts of 2', str(bucket))
+
+    def testHostLimit(self):
+        throttle = pyrrhic.throttling.Throttle()
+        throttle.set_limit('Foo.com', 1)
+        now = throttle.limits['foo.com']._updated
+        self.assertEqual(0, throttle.delay('foo.com:443', now=now))
+        # The limit is for every port
+        self.assertAlmostEqual(1, throttle.delay('foo.com:80', now=now))
+        self.assertEqual(0, throttle.delay('bar.com:80', now=now))
+        # Both the host's and the resource's limits apply
+        bucket = pyrrhic.throttling.TokenBucket(0.25)
+        self.assertEqual(0, throttle.delay('bar.com:80', bucket, now))
+        self.assertAlmostEqual(4, throttle.delay('bar.com:80', bucket, now))
+        throttle.block('bar.com', 30, now)
+        self.assertEqual(30, throttle.delay('bar.com:80', now=now))
+        self.assertEqual(1, throttle.stats['bar.com'].slow_downs)
+        throttle.remove_limit('FOO.com')
+        self.assertEqual({}, throttle.limits)
+        # A port given with the host is ignored, as for requests
+        throttle.set_limit('Foo.com:8080', 1)
+        self.assertEqual(['foo.com'], throttle.limits.keys())
+        self.assertEqual(0, throttle.delay('foo.com:8080', now=now))
+        self.assertAlmostEqual(1, throttle.delay('foo.com:8080', now=now))
+        throttle.remove_limit('foo.com:8080')
+        self.assertEqual({}, throttle.limits)
+
+    @mock.patch('time.sleep')
+    def testResourceLimit(self, mock_sleep):
+        self.server.statuses = [(200, [])] * 3
+        self.resource.rate_limit = pyrrhic.throttling.TokenBucket(1)
+        self.resource.get().read()
+        self.assertEqual(0, mock_sleep.call_count)
+        # Paths joined to the resource share its limit
+        self.resource.join('a').get().read()
+        self.assertEqual(1, mock_sleep.call_count)
+        self.failUnless(0.5 < mock_sleep.call_args[0][0] <= 1)
+        self.assertEqual(2, self.resource.rate_limit.requests)
+
+    @mock.patch('time.sleep')
+    def testRetry(self, mock_sleep):
+        self.server.statuses = [(429, [('Retry-After', '2')]), (429, []),
+                                (200, [])]
+        response = self.resource.get()
+        self.assertEqual(200, response.code)
+        self.assertEqual('ok', response.read())
+        # As long as the server asked, then backing off
+        waits = [args[0] for args, kwargs in mock_sleep.call_args_list]
+        self.assertEqual(2, len(waits))
+        self.assertAlmostEqual(2, waits[0], 1)
+        self.assertAlmostEqual(2, waits[1], 1)
+        stats = pyrrhic.get_throttle().stats['127.0.0.1']
+        self.assertEqual(2, stats.retries)
+        self.assertEqual(2, stats.slow_downs)
+
+    @mock.patch('time.sleep')
+    def testRetryUpload(self, mock_sleep):
+        # The file is sent again, though it was closed after the first go
+        import tempfile
+        f = tempfile.NamedTemporaryFile()
+        f.write('body')
+        f.flush()
+        self.server.statuses = [(429, [('Retry-After', '1')]), (200, [])]
+        upload = pyrrhic.streaming.FileSource(f.name).open()
+        response = self.resource.put(upload)
+        self.assertEqual(200, response.code)
+        self.assertEqual(['body', 'body'], self.server.bodies)
+        f.close()
+
+    @mock.patch('time.sleep')
+    def testNoRetry(self, mock_sleep):
+        # A 503 without Retry-After, or a wait that's too long, is returned
+        self.server.statuses = [(503, []), (429, [('Retry-After', '3600')])]
+        self.assertEqual(503, self.resource.get().code)
+        self.assertEqual(429, self.resource.get().code)
+        self.assertEqual(0, mock_sleep.call_count)
+
+    @mock.patch('time.sleep')
+    def testRetryLimit(self, mock_sleep):
+        statuses = [(503, [('Retry-After', '1')])] * 4
+        self.server.statuses = list(statuses)
+        self.assertEqual(503, self.resource.get().code)
+        self.assertEqual(3, mock_sleep.call_count)
+        self.assertEqual(3, pyrrhic.get_throttle().stats['127.0.0.1'].retries)
+
+    def testLimitCommand(self):
+        ValidationError = pyrrhic.commands.ValidationError
+        resources = {'news': self.resource}
+        c = pyrrhic.commands.LimitCommand(resources)
+        self.assertRaises(ValidationError, c.validate, 'news')
+        self.assertRaises(ValidationError, c.validate, 'news', 'fast')
+        self.assertRaises(ValidationError, c.validate, 'news', '10', 'x')
+        self.assertRaises(ValidationError, c.validate, 'news', '10', '0')
+        self.assertRaises(ValidationError, c.validate, 'news', 'off', '1')
+        c.validate()
+        c.validate('off')
+        c.validate('news', '600/m', '5')
+        c.run('news', '600/m', '5')
+        self.assertEqual(10, self.resource.rate_limit.rate)
+        self.assertEqual(5, self.resource.rate_limit.burst)
+        c.run('api.example.com', '2')
+        self.assertEqual(['api.example.com'],
+                         pyrrhic.get_throttle().limits.keys())
+        pyrrhic.get_throttle().block('api.example.com', 0)
+        out, err = self._stdout()
+        c.run()
+        lines = ''.join(out.written).splitlines()
+        self.assertEqual(['limit', 'rate', 'requests', 'throttled', 'waited'],
+                         lines[0].split())
+        self.failUnless(lines[1].startswith('news (resource) '))
+        self.failUnless('10/s, bursts of 5' in lines[1])
+        self.failUnless(lines[2].startswith('api.example.com '))
+        self.assertEqual('api.example.com asked us to slow down 1 times: '
+                         '0 retries, 0.00s waited', lines[3])
+        c.run('news', 'off')
+        self.assertEqual(None, self.resource.rate_limit)
+        c.run('off')
+        self.assertEqual({}, pyrrhic.get_throttle().limits)
+
+    def testPacedBench(self):
+        def send():
+            response = mock.Mock()
+            response.code = 200
+            response.read.side_effect = ['abc', '']
+            return response
+        result = pyrrhic.bench.run_paced(send, 10, 500, 4)
+        self.assertEqual(10, result.count)
+        self.assertEqual({200: 10}, result.statuses)
+        # Ten requests at 500 a second take about 18ms
+        self.failUnless(result.elapsed >= 0.018)
+        self.assertEqual('Target rate:  500.0 req/s, %d started late' %
+                         result.late, result.report()[1])
+
+    @mock.patch('pyrrhic.bench.run_paced')
+    def testPacedBenchCommand(self, mock_run_paced):
+        ValidationError = pyrrhic.commands.ValidationError
+        c = pyrrhic.commands.BenchCommand({'news': self.resource})
+        self.assertRaises(ValidationError, c.validate, '10', '-r', 'x', 'get')
+        self.assertRaises(ValidationError, c.validate, '10', '-r')
+        c.validate('10', '-r', '600/m', '-c', '2', 'get', 'news')
+        mock_run_paced.return_value.report.return_value = []
+        c.run('10', '-r', '600/m', 'get', 'news')
+        args, kwargs = mock_run_paced.call_args
+        self.assertEqual((10, 10, pyrrhic.commands.PACED_CONCURRENCY),
+                         args[1:])
+
+
+class ResolverTestCase(StdoutRedirectorBase):
+
+    ADDRESSES = [(2, 1, 6, '', ('10.0.0.1', 80)),
+                 (2, 1, 6, '', ('10.0.0.2', 80))]
+
+    def tearDown(self):
+        StdoutRedirectorBase.tearDown(self)
+        pyrrhic.get_dns_cache().flush()
+        pyrrhic.get_dns_cache().ttl = pyrrhic.resolver.DEFAULT_TTL
+        pyrrhic.get_pool().clear()
+
+    @mock.patch('socket.getaddrinfo')
+    def testCache(self, mock_getaddrinfo):
+        mock_getaddrinfo.return_value = self.ADDRESSES
+        cache = pyrrhic.resolver.DNSCache(ttl=30)
+        self.assertEqual(self.ADDRESSES, cache.resolve('Foo.com', 80))
+        self.assertEqual(self.ADDRESSES, cache.resolve('foo.com', 80))
+        self.assertEqual(1, mock_getaddrinfo.call_count)
+        cache.resolve('foo.com', 443)
+        self.assertEqual(2, mock_getaddrinfo.call_count)
+        entries = cache.entries()
+        self.assertEqual([('foo.com', 80), ('foo.com', 443)],
+                         [entry[:2] for entry in entries])
+        self.assertEqual(['10.0.0.1', '10.0.0.2'], entries[0][2])
+        self.failUnless(29 < entries[0][3] <= 30)
+        self.assertEqual(1, entries[0][4])
+        cache.forget('foo.com', 443)
+        self.assertEqual(1, len(cache.entries()))
+        self.assertEqual(1, cache.flush('FOO.com'))
+        self.assertEqual([], cache.entries())
+
+    @mock.patch('socket.getaddrinfo')
+    def testExpiry(self, mock_getaddrinfo):
+        mock_getaddrinfo.return_value = self.ADDRESSES
+        cache = pyrrhic.resolver.DNSCache(ttl=30)
+        cache.resolve('foo.com', 80)
+        with mock.patch('time.time') as mock_time:
+            mock_time.return_value = cache._lookups[('foo.com', 80)].expires
+            self.assertEqual([], cache.entries())
+            cache.resolve('foo.com', 80)
+        self.assertEqual(2, mock_getaddrinfo.call_count)
+        # Failed lookups, and lookups with a TTL of 0, aren't kept
+        cache.ttl = 0
+        cache.flush()
+        cache.resolve('foo.com', 80)
+        self.assertEqual([], cache.entries())
+        import socket
+        mock_getaddrinfo.side_effect = socket.gaierror('dummy')
+        cache.ttl = 30
+        self.assertRaises(socket.gaierror, cache.resolve, 'bar.com', 80)
+        self.assertEqual([], cache.entries())
+
+    def testConnectionForgetsUnreachable(self):
+        import socket
+        conn = pyrrhic.http.TimedHTTPConnection('foo.com')
+        conn.resolver = mock.Mock()
+        conn.resolver.resolve.return_value = self.ADDRESSES
+        with mock.patch.object(conn, '_connect_first') as mock_connect:
+            mock_connect.side_effect = socket.error('refused')
+            self.assertRaises(socket.error, conn.connect)
+        conn.resolver.resolve.assert_called_with('foo.com', 80)
+        conn.resolver.forget.assert_called_with('foo.com', 80)
+
+    def testPrewarm(self):
+        import pyrrhic.benchmarks
+        server = pyrrhic.benchmarks.BenchmarkServer(body_size=10).start()
+        try:
+            resource = pyrrhic.Resource(server.url)
+            pyrrhic.resolver.prewarm(resource, pyrrhic.get_dns_cache(),
+                                     pyrrhic.get_pool()).join()
+            self.assertEqual(1, len(pyrrhic.get_dns_cache().entries()))
+            response = resource.get()
+            response.read()
+            # The request went on the connection that was opened for it
+            self.assertEqual(True, response.timings.reused)
+            stats = dict((key, opened) for key, _, _, opened, _
+                         in pyrrhic.get_pool().stats())
+            self.assertEqual(1, stats[('http', server.url[7:-1])])
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    @mock.patch('socket.getaddrinfo')
+    def testPrewarmFails(self, mock_getaddrinfo):
+        import socket
+        mock_getaddrinfo.side_effect = socket.gaierror('dummy')
+        resource = pyrrhic.Resource('http://foo.com')
+        pyrrhic.resolver.prewarm(resource, pyrrhic.get_dns_cache(),
+                                 pyrrhic.get_pool()).join()
+        self.failIf(('http', 'foo.com:80') in
+                    [stats[0] for stats in pyrrhic.get_pool().stats()])
+
+    @mock.patch('socket.getaddrinfo')
+    def testDnsCommand(self, mock_getaddrinfo):
+        ValidationError = pyrrhic.commands.ValidationError
+        mock_getaddrinfo.return_value = self.ADDRESSES
+        c = pyrrhic.commands.DnsCommand({})
+        self.assertRaises(ValidationError, c.validate, 'list')
+        self.assertRaises(ValidationError, c.validate, 'ttl')
+        self.assertRaises(ValidationError, c.validate, 'ttl', 'x')
+        self.assertRaises(ValidationError, c.validate, 'ttl', '-1')
+        self.assertRaises(ValidationError, c.validate, 'flush', 'a', 'b')
+        c.validate()
+        c.validate('flush')
+        c.validate('flush', 'foo.com')
+        c.validate('ttl', '0')
+        pyrrhic.get_dns_cache().resolve('foo.com', 80)
+        out, err = self._stdout()
+        c.run()
+        lines = ''.join(out.written).splitlines()
+        self.assertEqual(['host', 'port', 'ttl', 'hits', 'addresses'],
+                         lines[0].split())
+        self.assertEqual(['foo.com', '80', '60s', '0', '10.0.0.1,',
+                          '10.0.0.2'], lines[1].split())
+        out.written = []
+        c.run('flush', 'bar.com')
+        c.run('flush')
+        self.assertEqual('Flushed 0 lookups\nFlushed 1 lookups\n',
+                         ''.join(out.written))
+        c.run('ttl', '5')
+        self.assertEqual(5, pyrrhic.get_dns_cache().ttl)
+
+
+class HistogramTestCase(unittest.TestCase):
+
+    def testBuckets(self):
+        bucket_index = pyrrhic.histogram.bucket_index
+        bucket_range = pyrrhic.histogram.bucket_range
+        previous = -1
+        for value in range(0, 1 << 16, 7):
+            index = bucket_index(value)
+            low, high = bucket_range(index)
+            self.failUnless(low <= value <= high)
+            # Buckets are no wider than 1/128th of their values
+            self.failUnless(high - low <= max(low / 128, 0))
+            self.failUnless(index >= previous)
+            previous = index
+
+    def testPercentiles(self):
+        histogram = pyrrhic.histogram.Histogram()
+        self.assertEqual(0.0, histogram.percentile(50))
+        self.assertEqual(0.0, histogram.mean)
+        for ms in range(1, 1001):
+            histogram.record(ms / 1000.0)
+        self.assertEqual(1000, histogram.count)
+        for p, expected in ((50, 0.5), (90, 0.9), (99, 0.99), (100, 1.0)):
+            self.assertAlmostEqual(expected, histogram.percentile(p),
+                                   delta=expected / 100)
+        self.assertEqual(1.0, histogram.percentile(100))
+        self.assertAlmostEqual(0.5005, histogram.mean)
+
+    def testMerge(self):
+        Histogram = pyrrhic.histogram.Histogram
+        first, second, both = Histogram(), Histogram(), Histogram()
+        for ms in range(1, 101):
+            first.record(ms / 1000.0)
+            both.record(ms / 1000.0)
+            second.record(ms / 10.0)
+            both.record(ms / 10.0)
+        first.merge(second)
+        first.merge(Histogram())
+        self.assertEqual(both.counts, first.counts)
+        self.assertEqual(200, first.count)
+        self.assertEqual(0.001, first.min / 1e6)
+        self.assertEqual(10.0, first.max / 1e6)
+        self.assertEqual(both.percentile(75), first.percentile(75))
+
+
+class ProcessBenchTestCase(StdoutRedirectorBase):
+
+    def testTakeAndMerge(self):
+        import pickle
+        result = pyrrhic.bench.BenchResult(2)
+        result.record(0.01, 200, 10)
+        result.record(0.02, error='URLError')
+        taken = pickle.loads(pickle.dumps(result.take(), 2))
+        self.assertEqual(0, result.count)
+        self.assertEqual({}, result.statuses)
+        result.record(0.03, 200, 5)
+        result.merge(taken)
+        self.assertEqual(3, result.count)
+        self.assertEqual({200: 2}, result.statuses)
+        self.assertEqual({'URLError': 1}, result.errors)
+        self.assertEqual(15, result.bytes)
+        paced = pyrrhic.bench.PacedResult(2, 10)
+        paced.late = 3
+        paced.merge(paced.take())
+        self.assertEqual(3, paced.late)
+
+    def testRunProcesses(self):
+        import pyrrhic.benchmarks
+        server = pyrrhic.benchmarks.BenchmarkServer(body_size=10).start()
+        try:
+            resource = pyrrhic.Resource(server.url)
+            prepare = lambda index: pyrrhic.after_fork(3, [resource])
+            stats = pyrrhic.get_request_stats()
+            stats.clear()
+            stats.record(resource.url, 200, 0.1)
+            result = pyrrhic.bench.run_processes(resource.get, 20, 4, 3,
+                                                 prepare=prepare, stats=stats)
+            series = stats.take()
+        finally:
+            server.shutdown()
+            server.server_close()
+            pyrrhic.get_pool().clear()
+            pyrrhic.get_request_stats().clear()
+        self.assertEqual(20, result.count)
+        # The workers' requests are counted in the parent's stats, and
+        # what the parent had counted already isn't counted again
+        self.assertEqual(21, series[resource.url, '2xx'].latency.count)
+        self.assertEqual({200: 20}, result.statuses)
+        self.assertEqual(200, result.bytes)
+        self.assertEqual('Concurrency:  4 (over 3 processes)',
+                         result.report()[1])
+
+    def testAfterFork(self):
+        saved = (pyrrhic.get_pool(), pyrrhic.get_http2_handler(),
+                 pyrrhic.get_recorder(), pyrrhic.get_opener())
+        resource = pyrrhic.Resource('http://foo.com')
+        resource.rate_limit = pyrrhic.throttling.TokenBucket(12, 8)
+        pyrrhic.get_throttle().set_limit('foo.com', 30)
+        try:
+            pyrrhic.after_fork(4, [resource, resource.join('a')])
+            # Made again when they're next needed
+            self.assertEqual(None, pyrrhic.pool)
+            self.assertEqual(None, pyrrhic.opener)
+            self.failIf(pyrrhic.get_pool() is saved[0])
+            self.failIf(pyrrhic.get_opener() is saved[3])
+            self.failUnless(pyrrhic.get_dns_cache() is pyrrhic.dns_cache)
+            self.assertEqual(3, resource.rate_limit.rate)
+            self.assertEqual(2, resource.rate_limit.burst)
+            self.assertEqual(7.5,
+                             pyrrhic.get_throttle().limits['foo.com'].rate)
+        finally:
+            (pyrrhic.pool, pyrrhic.http2_handler, pyrrhic.recorder,
+             pyrrhic.opener) = saved
+            pyrrhic.get_throttle().clear()
+
+    @mock.patch('pyrrhic.bench.run_processes')
+    def testBenchCommand(self, mock_run_processes):
+        ValidationError = pyrrhic.commands.ValidationError
+        c = pyrrhic.commands.BenchCommand(
+            {'news': pyrrhic.Resource('foo.com')})
+        self.assertRaises(ValidationError, c.validate, '10', '-P', '0', 'get')
+        self.assertRaises(ValidationError, c.validate, '10', '-P', 'x', 'get')
+        c.validate('10', '-P', '4', '-c', '8', 'get', 'news')
+        mock_run_processes.return_value.report.return_value = []
+        c.run('10', '-c', '8', '-P', '4', 'get', 'news')
+        args, kwargs = mock_run_processes.call_args
+        self.assertEqual((10, 8, 4, None), args[1:5])
+        # No more processes than threads
+        c.run('10', '-c', '2', '-P', '8', 'get', 'news')
+        args, kwargs = mock_run_processes.call_args
+        self.assertEqual((10, 2, 2, None), args[1:5])
+
+
+class StatsTestCase(StdoutRedirectorBase):
+
+    def setUp(self):
+        pyrrhic.get_request_stats().clear()
+
+    def tearDown(self):
+        StdoutRedirectorBase.tearDown(self)
+        pyrrhic.get_request_stats().clear()
+        pyrrhic.get_pool().clear()
+
+    def testRateCounter(self):
+        counter = pyrrhic.stats.RateCounter(window=5)
+        for now in (100.1, 100.5, 101.2, 103.9, 104.0):
+            counter.add(now)
+        self.assertEqual(2, counter.total(101.5, 1))
+        self.assertEqual(3, counter.total(102, 2))
+        self.assertEqual(4, counter.total(104.5, 5))
+        # The ring forgets seconds outside its window
+        counter.add(105.5)
+        counter.add(106.5)
+        self.assertEqual(3, counter.total(106, 5))
+        self.assertEqual(4, counter.total(107, 5))
+
+    def testTakeAndMerge(self):
+        import pickle
+        stats = pyrrhic.stats.Stats()
+        stats.record('http://foo.com:80/', 200, 0.01, 100, 100.5)
+        stats.record('http://foo.com:80/', None, 2.0, 0, 101.5)
+        taken = pickle.loads(pickle.dumps(stats.take(), 2))
+        self.assertEqual({}, stats.series)
+        stats.record('http://foo.com:80/', 200, 0.03, 50, 101.5)
+        stats.merge(taken)
+        series = stats.series['http://foo.com:80/', '2xx']
+        self.assertEqual(2, series.latency.count)
+        self.assertEqual(150, series.size.total)
+        self.assertEqual(2, series.rate.total(102, 2))
+        self.assertEqual(1, stats.series[
+            'http://foo.com:80/', 'error'].latency.count)
+        # Seconds the ring has moved on from aren't merged
+        counter = pyrrhic.stats.RateCounter(window=5)
+        counter.add(110.5)
+        old = pyrrhic.stats.RateCounter(window=5)
+        old.add(105.5, 3)
+        old.add(109.5)
+        counter.merge(old)
+        self.assertEqual(2, counter.total(111, 5))
+
+    def testRecord(self):
+        stats = pyrrhic.stats.Stats()
+        now = stats.started + 20
+        for i in range(90):
+            stats.record('http://foo.com:80/', 200, 0.01, 1000, now - 5)
+        stats.record('http://foo.com:80/', 404, 0.02, 10, now - 5)
+        stats.record('http://foo.com:80/', 503, 0.5, 0, now - 5)
+        stats.record('http://bar.com:80/', None, 2.0, now=now - 5)
+        stats.record('http://bar.com:80/', 200, 0.01, now=now - 30)
+        self.assertEqual(['1xx', '2xx', '3xx', '4xx', '5xx', 'error'],
+                         [pyrrhic.stats.status_class(status)
+                          for status in (100, 204, 302, 429, 500, None)])
+        lines = stats.report({'http://foo.com:80/': 'foo'}, now)
+        self.assertEqual('94 requests in 20s', lines[0].split('  ', 1)[1])
+        self.assertEqual('Last 10s:     9.3 req/s, 2.2% errors', lines[1])
+        self.assertEqual(['resource', 'status', 'requests', 'req/s'],
+                         lines[3].split()[:4])
+        rows = [line.split() for line in lines[4:]]
+        self.assertEqual(['foo', 'foo', 'foo', 'http://bar.com:80/',
+                          'http://bar.com:80/'], [row[0] for row in rows])
+        self.assertEqual(['2xx', '4xx', '5xx', '2xx', 'error'],
+                         [row[1] for row in rows])
+        self.assertEqual(['foo', '2xx', '90', '9.0', '10.0', '10.0', '10.0',
+                          '10.0', '1000'], rows[0])
+        self.assertEqual('0.0', rows[3][3])
+
+    def testHandler(self):
+        import pyrrhic.benchmarks
+        server = pyrrhic.benchmarks.BenchmarkServer(body_size=100).start()
+        try:
+            resource = pyrrhic.Resource(server.url)
+            resource.get().read()
+            response = resource.get()
+            response.read(10)
+            # Not counted until the whole body's read, or it's closed
+            self.assertEqual(1, pyrrhic.get_request_stats().series[
+                resource.url, '2xx'].latency.count)
+            response.close()
+            list(resource.batch(['a', 'b']))
+        finally:
+            server.shutdown()
+            server.server_close()
+        series = pyrrhic.get_request_stats().series
+        self.assertEqual([(resource.url, '2xx')], series.keys())
+        # Paths joined to the resource are counted with it
+        self.assertEqual(4, series[resource.url, '2xx'].latency.count)
+        self.assertEqual(310, series[resource.url, '2xx'].size.total)
+
+    def testErrors(self):
+        import urllib2
+        resource = pyrrhic.Resource('http://127.0.0.1:1/')
+        self.assertRaises(urllib2.URLError, resource.get)
+        self.assertEqual([(resource.url, 'error')],
+                         pyrrhic.get_request_stats().series.keys())
+
+    def testStatsCommand(self):
+        ValidationError = pyrrhic.commands.ValidationError
+        resources = {'news': pyrrhic.Resource('http://foo.com')}
+        c = pyrrhic.commands.StatsCommand(resources)
+        self.assertRaises(ValidationError, c.validate, 'all')
+        self.assertRaises(ValidationError, c.validate, '-n', '0')
+        c.validate()
+        c.validate('clear')
+        c.validate('-n', '0.5', '-t', '2')
+        pyrrhic.get_request_stats().record(resources['news'].url, 200, 0.1)
+        pyrrhic.get_request_stats().record('http://bar.com:80/', 200, 0.1)
+        out, err = self._stdout()
+        with mock.patch('time.sleep') as mock_sleep:
+            c.run('-t', '2', '-n', '5')
+        mock_sleep.assert_called_once_with(5)
+        lines = ''.join(out.written).splitlines()
+        self.assertEqual(13, len(lines))
+        self.assertEqual('', lines[6])
+        self.assertEqual(['http://bar.com:80/', 'news'],
+                         [line.split()[0] for line in lines[-2:]])
+        c.run('clear')
+        self.assertEqual({}, pyrrhic.get_request_stats().series)
+
+
+class TemplatesTestCase(StdoutRedirectorBase):
+
+    def setUp(self):
+        import tempfile
+        self.directory = tempfile.mkdtemp()
+        self.csv = os.path.join(self.directory, 'skus.csv')
+        open(self.csv, 'w').write('sku,name\nA1,red shoe\nB2,blue&hat\n'
+                                  'C3,green/sock\n')
+
+    def tearDown(self):
+        import shutil
+        StdoutRedirectorBase.tearDown(self)
+        pyrrhic.commands.templates = {}
+        shutil.rmtree(self.directory)
+
+    def testCompile(self):
+        compile_text = pyrrhic.templates.compile_text
+        self.assertEqual(('items/%(id:path)s?q=100%%', ['id']),
+                         compile_text('items/{id}?q=100%', 'path'))
+        # Only identifiers in braces are placeholders, so JSON is left alone
+        self.assertEqual(('{"n": %(n)s, "a": {"b": {}}}', ['n']),
+                         compile_text('{"n": {n}, "a": {"b": {}}}'))
+        self.assertRaises(ValueError, pyrrhic.templates.Template, '{sku}')
+
+    def testRender(self):
+        template = pyrrhic.templates.Template(
+            'orders/{name}', [('X-Count', '{n}')], 'sku={sku}&name={name}',
+            form=True, data=self.csv)
+        rendered = [template.render() for i in range(4)]
+        self.assertEqual(['orders/red%20shoe', 'orders/blue%26hat',
+                          'orders/green%2Fsock', 'orders/red%20shoe'],
+                         [r[0] for r in rendered])
+        self.assertEqual([('X-Count', '1')], rendered[0][1])
+        self.assertEqual([('X-Count', '4')], rendered[3][1])
+        self.assertEqual('sku=B2&name=blue%26hat', rendered[1][2])
+        self.assertEqual('orders/{name} :sku={sku}&name={name} '
+                         '-H X-Count:{n} -f %s' % self.csv, str(template))
+        template = pyrrhic.templates.Template(
+            body='{"id": "{uuid}", "at": {time}}')
+        path, headers, body = template.render()
+        import json
+        import uuid
+        self.assertEqual(4, uuid.UUID(json.loads(body)['id']).version)
+        self.assertEqual(('', []), (path, headers))
+        template = pyrrhic.templates.Template('{user}', rows=iter(
+            [{'user': 'bob'}]))
+        self.assertEqual('bob', template.render()[0])
+        self.assertRaises(ValueError, template.render)
+
+    def testLoad(self):
+        template = pyrrhic.templates.Template('{colour}', data=self.csv)
+        self.assertRaises(ValueError, template.load)
+        template = pyrrhic.templates.Template('{sku}', data=self.csv + 'x')
+        self.assertRaises(IOError, template.load)
+
+    def testLoadOnce(self):
+        # Threads rendering at once read the file once, and share its rows
+        import threading
+        import time
+        read_rows = pyrrhic.templates.read_rows
+
+        def slow_read_rows(path):
+            time.sleep(0.01)
+            return read_rows(path)
+        template = pyrrhic.templates.Template('{sku}', data=self.csv)
+        paths = []
+        with mock.patch('pyrrhic.templates.read_rows') as mock_read_rows:
+            mock_read_rows.side_effect = slow_read_rows
+            threads = [threading.Thread(
+                target=lambda: paths.append(template.render()[0]))
+                for i in range(6)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(1, mock_read_rows.call_count)
+        self.assertEqual(['A1', 'A1', 'B2', 'B2', 'C3', 'C3'], sorted(paths))
+
+    def testMissingDataFile(self):
+        # e.g. a template from the session whose data file has gone
+        pyrrhic.commands.templates['order'] = pyrrhic.templates.Template(
+            '{sku}', data=self.csv + 'x')
+        c = pyrrhic.commands.PostCommand({'__default__':
+                                          pyrrhic.Resource('foo.com')})
+        self.assertRaises(pyrrhic.commands.ValidationError, c.validate,
+                          '%order')
+
+    def testShare(self):
+        template = pyrrhic.templates.Template('{sku}/{n}', data=self.csv)
+        template.share(1, 2)
+        self.assertEqual(['B2/2', 'A1/4', 'C3/6'],
+                         [template.render()[0] for i in range(3)])
+
+    @mock.patch('pyrrhic.opener')
+    def testSendTemplate(self, mock_opener):
+        mock_open = mock_opener.open
+        resource = pyrrhic.Resource('http://foo.com/api/')
+        resource.set_authentication('user', 'pass')
+        template = pyrrhic.templates.Template('items/{n}?v=1',
+                                              [('X-Id', '{n}')])
+        resource.send_template('GET', template)
+        request = mock_open.call_args[0][0]
+        self.assertEqual('/api/items/1?v=1', request.get_selector())
+        self.assertEqual('http://foo.com:80/api/items/1?v=1',
+                         request.get_full_url())
+        self.assertEqual('1', request.get_header('X-id'))
+        self.failUnless(request.has_header('Authorization'))
+        self.assertEqual(None, request.get_data())
+        resource.send_template('POST', template)
+        request = mock_open.call_args[0][0]
+        self.assertEqual('', request.get_data())
+        resource.send_template('PUT', pyrrhic.templates.Template(body='a=b c'))
+        request = mock_open.call_args[0][0]
+        self.assertEqual('/api/', request.get_selector())
+        self.assertEqual('a=b c', request.get_data())
+
+    def testTemplateCommand(self):
+        out, err = self._stdout()
+        ValidationError = pyrrhic.commands.ValidationError
+        c = pyrrhic.commands.TemplateCommand({})
+        c.validate()
+        self.assertRaises(ValidationError, c.validate, 'order')
+        self.assertRaises(ValidationError, c.validate, '-d', 'order')
+        self.assertRaises(ValidationError, c.validate, 'order', '{sku}')
+        self.assertRaises(ValidationError, c.validate, 'order', '-H', 'X')
+        self.assertRaises(ValidationError, c.validate, 'order', 'a', 'b')
+        self.assertRaises(ValidationError, c.validate, 'order', '{colour}',
+                          '-f', self.csv)
+        c.validate('order', 'orders/{sku}', ':qty=1', '-f', self.csv)
+        c.run('order', 'orders/{n}', ':qty={n}', '-H', 'X-Id:{uuid}')
+        c.run('order')
+        c.run()
+        self.assertEqual('orders/{n} :qty={n} -H X-Id:{uuid}\n'
+                         'order\t\torders/{n} :qty={n} -H X-Id:{uuid}\n',
+                         ''.join(out.written))
+        c.run('-d', 'order')
+        self.assertEqual({}, pyrrhic.commands.templates)
+
+    @mock.patch('pyrrhic.opener')
+    def testUseTemplate(self, mock_opener):
+        mock_open = mock_opener.open
+        out, err = self._stdout()
+        build_mock_response(mock_open)
+        pyrrhic.commands.templates['order'] = pyrrhic.templates.Template(
+            'orders/{n}', body='qty={n}', form=True)
+        pyrrhic.commands.templates['search'] = pyrrhic.templates.Template(
+            '?q={n}')
+        resources = {'news': pyrrhic.Resource('news.com')}
+        c = pyrrhic.commands.PostCommand(resources)
+        c.validate('news', '%order')
+        self.assertRaises(pyrrhic.commands.ValidationError, c.validate,
+                          'news', '%other')
+        c.run('news', '%order')
+        request = mock_open.call_args[0][0]
+        self.assertEqual('/orders/1', request.get_selector())
+        self.assertEqual('qty=1', request.get_data())
+        c = pyrrhic.commands.GetCommand(resources)
+        self.assertRaises(pyrrhic.commands.ValidationError, c.validate,
+                          'news', '%order')
+        c.validate('%search', 'news')
+        self.failUnless(c.template('news', '%search') is
+                        pyrrhic.commands.templates['search'])
+        self.assertEqual(None, c.template('news'))
+        send = c.sender('news', '%search')
+        send()
+        send()
+        self.assertEqual('/?q=2', mock_open.call_args[0][0].get_selector())
+
+    def testSession(self):
+        import pyrrhic.session
+        path = os.path.join(self.directory, 'session')
+        session = pyrrhic.session.Session(path)
+        session.templates['order'] = pyrrhic.templates.Template(
+            'orders/{sku}', [('X-Id', '{uuid}')], 'qty=1', True, self.csv)
+        session.close()
+        session = pyrrhic.session.Session(path)
+        template = session.templates['order']
+        self.assertEqual([('X-Id', '{uuid}')], template.headers)
+        self.failUnless(isinstance(template.path, str))
+        self.assertEqual('orders/A1', template.render()[0])
+        # Bodies that aren't text, e.g. from an image file
+        session.templates['image'] = pyrrhic.templates.Template(
+            'images/{n}', body='\xff\xfe\x00{n}')
+        session.close()
+        session = pyrrhic.session.Session(path)
+        self.assertEqual('\xff\xfe\x00{n}', session.templates['image'].body)
+        self.assertEqual('qty=1', session.templates['order'].body)
+        session.close()
+
+
+def build_body_response(data, code=200, headers={}, chunk_size=None):
+    """ A mock response whose body is read in pieces, and can be closed """
+    response = mock.Mock()
+    response.code = code
+    response.msg = 'OK'
+    response.info.return_value = headers
+    chunks = [data[i:i + (chunk_size or len(data) or 1)]
+              for i in range(0, len(data), chunk_size or len(data) or 1)]
+    response.read.side_effect = chunks + [''] * 10
+    return response
+
+
+class ChecksTestCase(StdoutRedirectorBase):
+
+    document = ('{"id": 42, "name": "b\\"ob {[", "items": [{"sku": "A1", '
+                '"tags": ["x}", {"deep": [1, 2.5e3]}]}, {"sku": "B2"}], '
+                '"skip": {"a": ["\\"]", {}]}, "ok": true, "last": -12}')
+
+    def tearDown(self):
+        StdoutRedirectorBase.tearDown(self)
+        pyrrhic.commands.variables = {}
+
+    def testParsePath(self):
+        parse_path = pyrrhic.checks.parse_path
+        self.assertEqual(('items', 0, 'id'), parse_path('$.items[0].id'))
+        self.assertEqual(('a b', 'c'), parse_path('$["a b"].c'))
+        self.assertEqual(('id',), parse_path('id'))
+        self.assertEqual((), parse_path('$'))
+        self.assertRaises(ValueError, parse_path, '$.items[x]')
+
+    def testMatcher(self):
+        paths = ['$.id', '$.name', '$.items[0].tags[1]', '$.items[1].sku',
+                 '$.items[5]', '$.missing', '$.last', '$.ok.x']
+        paths = [pyrrhic.checks.parse_path(path) for path in paths]
+        # However the document is split up, the same values are found
+        for size in (1, 2, 3, 7, len(self.document)):
+            matcher = pyrrhic.checks.JSONPathMatcher(paths)
+            for i in range(0, len(self.document), size):
+                matcher.feed(self.document[i:i + size])
+            matcher.finish()
+            self.assertEqual(None, matcher.error)
+            self.assertEqual({('id',): 42, ('name',): u'b"ob {[',
+                              ('items', 0, 'tags', 1): {'deep': [1, 2500.0]},
+                              ('items', 1, 'sku'): u'B2', ('last',): -12},
+                             matcher.found)
+            self.assertEqual(set([('items', 5), ('missing',), ('ok', 'x')]),
+                             matcher.missing)
+
+    def testMatcherDone(self):
+        matcher = pyrrhic.checks.JSONPathMatcher([('items', 0, 'sku')])
+        matcher.feed(self.document[:60])
+        self.assertEqual(True, matcher.done)
+        self.assertEqual({('items', 0, 'sku'): 'A1'}, matcher.found)
+        # Missing as soon as the array ends without it
+        matcher = pyrrhic.checks.JSONPathMatcher([('items', 2)])
+        matcher.feed(self.document[:self.document.index('"skip"')])
+        self.assertEqual(True, matcher.done)
+        self.assertEqual(set([('items', 2)]), matcher.missing)
+
+    def testMatcherNested(self):
+        # A path inside the value at another is found from that value
+        paths = [('items',), ('items', 0, 'id'), ('items', 1), ('items', 0, 'x')]
+        document = '{"items": [{"id": 7}], "id": 1}'
+        for size in (1, len(document)):
+            matcher = pyrrhic.checks.JSONPathMatcher(paths)
+            for i in range(0, len(document), size):
+                matcher.feed(document[i:i + size])
+            self.assertEqual(True, matcher.done)
+            self.assertEqual({('items',): [{'id': 7}], ('items', 0, 'id'): 7},
+                             matcher.found)
+            self.assertEqual(set([('items', 1), ('items', 0, 'x')]),
+                             matcher.missing)
+
+    def testMatcherErrors(self):
+        matcher = pyrrhic.checks.JSONPathMatcher([('id',)])
+        matcher.feed('<html>')
+        self.assertEqual(True, matcher.done)
+        self.failUnless(matcher.error.startswith('Invalid JSON'))
+        matcher = pyrrhic.checks.JSONPathMatcher([('id',)])
+        matcher.feed('{"a": [1, 2')
+        matcher.finish()
+        self.assertEqual('Invalid JSON: the body ended early', matcher.error)
+
+    def testParse(self):
+        parse_check = pyrrhic.checks.parse_check
+        for spec in ('status', 'body~', 'header:', 'json:$.a[', 'other=1',
+                     'status=20'):
+            self.assertRaises(ValueError, parse_check, spec)
+        for spec in ('1d=json:$.id', 'id=', 'id=json:', 'id=body'):
+            self.assertRaises(ValueError, pyrrhic.checks.parse_extraction,
+                              spec)
+        check = parse_check('json:$.name=bob')
+        self.assertEqual((('name',), '=', u'bob'),
+                         (check.path, check.op, check.value))
+        self.assertEqual([1, 2], parse_check('json:$.a=[1,2]').value)
+        self.assertEqual(('Cache-Control', '=', 'max-age=60'),
+                         pyrrhic.checks._split('', 'Cache-Control=max-age=60'))
+
+    def testChecks(self):
+        checks = pyrrhic.checks.Checks([
+            pyrrhic.checks.parse_check(spec) for spec in (
+                'status=2xx', 'header:Content-Type~json', 'header:ETag',
+                'json:$.id=42', 'json:$.name~ob', 'json:$.ok=false',
+                'json:$.nope', 'body~sku": "B')] + [
+            pyrrhic.checks.parse_extraction('sku=json:$.items[1].sku'),
+            pyrrhic.checks.parse_extraction('type=header:Content-Type')])
+        response = build_body_response(
+            self.document, headers={'Content-Type': 'application/json'},
+            chunk_size=5)
+        checks.run(response, 5)
+        self.assertEqual(True, response.close.called)
+        self.assertEqual([True, True, False, True, True, False, False, True,
+                          True, True],
+                         [check.passed for check in checks.checks])
+        self.assertEqual(['', '', 'missing', '', '', 'got true', 'missing'],
+                         [check.detail for check in checks.checks[:7]])
+        self.assertEqual(False, checks.passed)
+        self.assertEqual({'sku': 'B2', 'type': 'application/json'},
+                         checks.values)
+
+    def testStopEarly(self):
+        checks = pyrrhic.checks.Checks([
+            pyrrhic.checks.parse_check('body~"id"'),
+            pyrrhic.checks.parse_extraction('id=json:$.id')])
+        response = build_body_response(self.document, chunk_size=5)
+        checks.run(response, 5)
+        # '{"id": 42,' is in the first two pieces
+        self.assertEqual(2, response.read.call_count)
+        self.assertEqual(True, response.close.called)
+        self.assertEqual(True, checks.passed)
+        self.assertEqual({'id': '42'}, checks.values)
+
+    def testBodySplit(self):
+        check = pyrrhic.checks.parse_check('body~needle')
+        for piece in ('hay ne', 'e', 'dle hay'):
+            check.feed(piece)
+        self.assertEqual(True, check.passed)
+        check = pyrrhic.checks.parse_check('body~needle')
+        check.feed('needl')
+        check.finish()
+        self.assertEqual((False, 'not found'), (check.passed, check.detail))
+
+    @mock.patch('pyrrhic.Resource.post')
+    def testRestCommand(self, mock_post):
+        out, err = self._stdout()
+        ValidationError = pyrrhic.commands.ValidationError
+        mock_post.return_value = build_body_response(self.document, 201)
+        resources = {'api': pyrrhic.Resource('foo.com'),
+                     'b': pyrrhic.Resource('bar.com')}
+        c = pyrrhic.commands.PostCommand(resources)
+        self.assertRaises(ValidationError, c.validate, 'api', '-a')
+        self.assertRaises(ValidationError, c.validate, 'api', '-a', 'body')
+        self.assertRaises(ValidationError, c.validate, 'api', '-a',
+                          'header:X~[')
+        self.assertRaises(ValidationError, c.validate, '@all', '-a',
+                          'status=200')
+        self.assertRaises(ValidationError, c.validate, 'api', '-a',
+                          'status=200', '>', 'out')
+        c.validate('api', ':a=b', '-a', 'status=201', '-x', 'id=json:$.id')
+        c.run('api', ':a=b', '-a', 'status=201', '-x', 'id=json:$.id',
+              '-a', 'json:$.last=0')
+        mock_post.assert_called_with(data={'a': ['b']})
+        self.assertEqual(['201 OK', 'ok      status=201', '$id = 42',
+                          'FAILED  json:$.last=0 (got -12)'],
+                         ''.join(out.written).splitlines())
+        self.assertEqual(False, c.checks.passed)
+        self.assertEqual({'id': '42'}, pyrrhic.commands.variables)
+
+    def testVariables(self):
+        out, err = self._stdout()
+        ValidationError = pyrrhic.commands.ValidationError
+        expand = pyrrhic.commands.expand_variables
+        c = pyrrhic.commands.VarCommand({})
+        c.validate()
+        self.assertRaises(ValidationError, c.validate, 'id')
+        self.assertRaises(ValidationError, c.validate, '1d', '1')
+        c.validate('id', '42')
+        c.run('id', '42')
+        c.run('id')
+        c.run()
+        self.assertEqual('42\nid\t\t42\n', ''.join(out.written))
+        self.assertEqual(('items/42', 'pa$s', '$', ':a=42&b=42'),
+                         expand(('items/$id', 'pa$$s', '$', ':a=$id&b=$id')))
+        self.assertRaises(ValidationError, expand, ('$other',))
+        c.run('-d', 'id')
+        self.assertEqual({}, pyrrhic.commands.variables)
+
+    @mock.patch('pyrrhic.Resource.get')
+    def testScript(self, mock_get):
+        import StringIO
+        out, err = self._stdout()
+        responses = [build_body_response('{"next": "b"}'),
+                     build_body_response('{"next": null}')]
+        mock_get.side_effect = lambda: responses.pop(0)
+        script = StringIO.StringIO(
+            'r foo.com a\n'
+            'get a -x next=json:$.next\n'
+            'r foo.com/$next b\n'
+            'get b -a json:$.next=b\n')
+        resources = {}
+        self.assertEqual(1, pyrrhic.ui.batch(
+            script, pyrrhic.ui.parse_statuses('2xx'), 4, resources))
+        self.assertEqual('http://foo.com:80/b', resources['b'].url)
+        written = ''.join(out.written)
+        self.failUnless('FAILED  json:$.next=b (got null)' in written)
+        self.failUnless('1 failed' in written)
+
+    def testBenchCommand(self):
+        c = pyrrhic.commands.BenchCommand(
+            {'news': pyrrhic.Resource('foo.com')})
+        self.assertRaises(pyrrhic.commands.ValidationError, c.validate, '10',
+                          'get', 'news', '-a', 'status=200')
+
+
+class StartupTestCase(StdoutRedirectorBase):
+
+    def testLookupCommand(self):
+        self.failUnless(pyrrhic.ui.lookup_command('get') is
+                        pyrrhic.commands.GetCommand)
+        self.failUnless(pyrrhic.ui.lookup_command('h') is
+                        pyrrhic.commands.HelpCommand)
+        self.assertEqual(None, pyrrhic.ui.lookup_command('nosuch'))
+        for name in pyrrhic.ui.REGISTERED_COMMANDS:
+            self.failUnless(issubclass(pyrrhic.ui.lookup_command(name),
+                                       pyrrhic.commands.BaseCommand))
+
+    def testLazyImports(self):
+        # Modules only some commands need aren't imported at startup
+        import subprocess
+        lazy = ['csv', 'difflib', 'email.utils', 'httplib', 'mmap',
+                'multiprocessing', 'pyrrhic.commands', 'pyrrhic.http',
+                'readline', 'ssl', 'urllib2']
+        code = 'import sys, pyrrhic.ui; print [name for name in %r ' \
+            'if name in sys.modules]' % lazy
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env = dict(os.environ, PYTHONPATH=root)
+        output = subprocess.Popen([sys.executable, '-c', code], env=env,
+                                  stdout=subprocess.PIPE).communicate()[0]
+        self.assertEqual('[]', output.strip())
+
+    def testImportTimer(self):
+        import shutil
+        import tempfile
+        directory = tempfile.mkdtemp()
+        open(os.path.join(directory, 'pyrrhic_timed.py'), 'w').write(
+            'import pyrrhic_timed_too\n')
+        open(os.path.join(directory, 'pyrrhic_timed_too.py'), 'w').write('')
+        sys.path.insert(0, directory)
+        timer = pyrrhic.startup.ImportTimer()
+        timer.install()
+        try:
+            import pyrrhic_timed
+            # Already imported, so not timed
+            import unittest
+        finally:
+            timer.uninstall()
+            sys.path.remove(directory)
+            shutil.rmtree(directory)
+            sys.modules.pop('pyrrhic_timed', None)
+            sys.modules.pop('pyrrhic_timed_too', None)
+        self.assertEqual(['pyrrhic_timed', 'pyrrhic_timed_too'],
+                         sorted(name for own, total, name in timer.modules))
+        times = dict((name, (own, total)) for own, total, name in timer.modules)
+        own, total = times['pyrrhic_timed']
+        self.failUnless(total >= own + times['pyrrhic_timed_too'][1] - 1e-6)
+        report = timer.report(1)
+        self.assertEqual(2, len(report))
+        self.failUnless(report[0].endswith('module'))
+
+    def testOptions(self):
+        out, err = self._stdout()
+        options = pyrrhic.ui.parse_options(['-c', 'get news', '--expect',
+                                            '2xx'])
+        self.assertEqual('get news', options.command)
+        self.assertEqual(False, options.profile_startup)
+        self.assertRaises(SystemExit, pyrrhic.ui.parse_options,
+                          ['-c', 'get', '-f', 'script.pyr'])
+        self.assertRaises(SystemExit, pyrrhic.ui.parse_options, ['-c', ' '])
+        options = pyrrhic.ui.parse_options(['--profile-startup'])
+        self.assertEqual(True, options.profile_startup)
+
+    @mock.patch('pyrrhic.Resource.get')
+    def testRunOne(self, mock_get):
+        out, err = self._stdout()
+        expected = pyrrhic.ui.parse_statuses('2xx')
+        resources = {'news': pyrrhic.Resource('foo.com')}
+        build_mock_response(mock_get, data='Body Content')
+        self.assertEqual(0, pyrrhic.ui.run_one('get news', expected,
+                                               resources))
+        self.failUnless('Body Content' in ''.join(out.written))
+        build_mock_response(mock_get, code=404, msg='Not Found')
+        self.assertEqual(1, pyrrhic.ui.run_one('get news', expected,
+                                               resources))
+        self.assertEqual(1, pyrrhic.ui.run_one('nosuch', expected,
+                                               resources))
+        self.assertEqual(2, mock_get.call_count)
+
+    @mock.patch('pyrrhic.startup.profile')
+    def testProfileStartup(self, mock_profile):
+        mock_profile.return_value = 0
+        self.assertRaises(SystemExit, pyrrhic.ui.console,
+                          ['--profile', '--no-session', '-c', 'h'])
+        mock_profile.assert_called_once_with(['--no-session', '-c', 'h'])
@@ -0,0 +1,278 @@
+"""
+Keeps requests within a rate limit, per resource and per host, and backs
+off when a server says it's getting too many (429 Too Many Requests, or
+503 Service Unavailable with a Retry-After header).
+"""
+import socket
+import threading
+import time
+import urllib2
+import urlparse
+
+import pyrrhic.caching
+import pyrrhic.streaming
+
+# Times a request is retried after a 429 or 503
+MAX_RETRIES = 3
+
+# Seconds to wait before the first retry of a 429 without a Retry-After
+# header. Doubles with each retry.
+BACKOFF = 1.0
+
+# Responses asking us to wait longer than this many seconds are passed on
+# rather than retried
+MAX_RETRY_WAIT = 60.0
+
+RATE_UNITS = {'s': 1, 'm': 60, 'h': 3600}
+
+
+def parse_rate(spec):
+    """
+    Parse a rate such as '10' or '10/s' (per second), '600/m' or '5000/h'
+    into requests per second
+    """
+    count, _, unit = spec.partition('/')
+    try:
+        count = float(count)
+        seconds = RATE_UNITS[unit or 's']
+    except (ValueError, KeyError):
+        raise ValueError, 'Invalid rate %s' % spec
+    if count <= 0:
+        raise ValueError, 'Rate must be more than 0'
+    return count / seconds
+
+
+def format_rate(rate):
+    """ The reverse of `parse_rate`, in the unit that reads best """
+    for unit, seconds in (('s', 1), ('m', 60), ('h', 3600)):
+        if rate * seconds >= 1:
+            return '%g/%s' % (round(rate * seconds, 3), unit)
+    return '%g/h' % (rate * 3600)
+
+
+def parse_retry_after(value, now):
+    """
+    Parse a Retry-After header, in seconds or an HTTP date, into how many
+    seconds to wait, or None if there isn't a valid one
+    """
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    when = pyrrhic.caching.parse_http_date(value)
+    if when is None:
+        return None
+    return max(0.0, when - now)
+
+
+def hostname(host):
+    """ 'Foo.com:443' -> 'foo.com', as host limits apply to every port """
+    return urlparse.urlsplit('//' + host).hostname or host.lower()
+
+
+class TokenBucket(object):
+    """
+    Allows `rate` requests a second, with bursts of up to `burst` after a
+    quiet spell. Each request reserves the next token, even if it has to
+    wait for it, so threads sharing a bucket are spaced out exactly rather
+    than all waking at once.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = burst
+        self.requests = 0
+        self.throttled = 0
+        self.waited = 0.0
+        self._tokens = float(burst)
+        self._updated = time.time()
+        self._lock = threading.Lock()
+
+    def reserve(self, now=None):
+        """ Take a token, returning how many seconds to wait before using it """
+        with self._lock:
+            if now is None:
+                now = time.time()
+            if now > self._updated:
+                self._tokens = min(self.burst, self._tokens +
+                                   (now - self._updated) * self.rate)
+                self._updated = now
+            self._tokens -= 1
+            self.requests += 1
+            if self._tokens >= 0:
+                return 0.0
+            wait = -self._tokens / self.rate
+            self.throttled += 1
+            self.waited += wait
+            return wait
+
+    def share(self, parts):
+        """ Cut the limit to one of `parts` shares, e.g. for one process """
+        with self._lock:
+            self.rate /= parts
+            self.burst = max(self.burst // parts, 1)
+            self._tokens = min(self._tokens, self.burst)
+
+    def __str__(self):
+        if self.burst > 1:
+            return '%s, bursts of %d' % (format_rate(self.rate), self.burst)
+        return format_rate(self.rate)
+
+
+class HostStats(object):
+    """ How often a host told us to slow down, and how long we waited """
+
+    def __init__(self):
+        self.slow_downs = 0
+        self.retries = 0
+        self.waited = 0.0
+
+
+class Throttle(object):
+    """
+    The rate limits for each host, and the times until which hosts have
+    asked us not to send anything.
+    """
+
+    def __init__(self):
+        self.limits = {}
+        self.stats = {}
+        self._blocked = {}
+        self._lock = threading.Lock()
+
+    def set_limit(self, host, rate, burst=1):
+        # Any port is dropped, as the limit is for the whole host
+        with self._lock:
+            self.limits[hostname(host)] = TokenBucket(rate, burst)
+
+    def remove_limit(self, host):
+        with self._lock:
+            self.limits.pop(hostname(host), None)
+
+    def _host_stats(self, host):
+        # Called with the lock held
+        stats = self.stats.get(host)
+        if stats is None:
+            stats = self.stats[host] = HostStats()
+        return stats
+
+    def block(self, host, seconds, now=None):
+        """ Send nothing more to a host for `seconds` """
+        if now is None:
+            now = time.time()
+        with self._lock:
+            until = now + seconds
+            self._blocked[host] = max(self._blocked.get(host, 0), until)
+            self._host_stats(host).slow_downs += 1
+
+    def delay(self, host, resource_limit=None, now=None):
+        """
+        Reserve a slot for a request to `host`, from the host's limit and
+        the resource's, if it has one. Returns how many seconds to wait.
+        """
+        if now is None:
+            now = time.time()
+        name = hostname(host)
+        with self._lock:
+            bucket = self.limits.get(name)
+            blocked = self._blocked.get(name, 0) - now
+        waits = [blocked, 0.0]
+        if bucket is not None:
+            waits.append(bucket.reserve(now))
+        if resource_limit is not None:
+            waits.append(resource_limit.reserve(now))
+        wait = max(waits)
+        if blocked > 0:
+            with self._lock:
+                self._host_stats(name).waited += blocked
+        return wait
+
+    def retried(self, host):
+        with self._lock:
+            self._host_stats(hostname(host)).retries += 1
+
+    def clear(self):
+        with self._lock:
+            self.limits.clear()
+            self.stats.clear()
+            self._blocked.clear()
+
+
+class ThrottleHandler(urllib2.BaseHandler):
+    """
+    Waits, before each request goes to the network, until it's within the
+    rate limits for its host and resource. Responses from the cache don't
+    count, as they're served before this is reached.
+    """
+
+    # Ahead of the handlers that open connections
+    handler_order = 440
+
+    def __init__(self, throttle):
+        self.throttle = throttle
+
+    def http_open(self, req):
+        wait = self.throttle.delay(req.get_host(),
+                                   getattr(req, 'rate_limit', None))
+        if wait > 0:
+            time.sleep(wait)
+        # Let the next handler make the request
+        return None
+
+    https_open = http_open
+
+
+class RetryHandler(urllib2.BaseHandler):
+    """
+    Retries a request that gets a 429, or a 503 with Retry-After, after
+    waiting as long as the server asked, or backing off exponentially. The
+    wait is a block on the host, so other requests to it wait too.
+    """
+
+    # After the handlers that wrap responses, so that they don't wrap the
+    # response to the retried request twice
+    handler_order = 460
+
+    def __init__(self, throttle):
+        self.throttle = throttle
+
+    def _wait(self, req, response):
+        # How long to wait before retrying, or None not to retry
+        retry_after = parse_retry_after(response.info().get('retry-after'),
+                                        time.time())
+        if response.code == 503 and retry_after is None:
+            # Probably just down, rather than asking us to slow down
+            return None
+        if retry_after is None:
+            retry_after = BACKOFF * 2 ** getattr(req, 'retries', 0)
+        if retry_after > MAX_RETRY_WAIT:
+            return None
+        return retry_after
+
+    def http_response(self, req, response):
+        if response.code not in (429, 503):
+            return response
+        wait = self._wait(req, response)
+        host = hostname(req.get_host())
+        if wait is None:
+            return response
+        self.throttle.block(host, wait)
+        retries = getattr(req, 'retries', 0)
+        if retries >= MAX_RETRIES:
+            return response
+        if isinstance(req.data, pyrrhic.streaming.Upload) and \
+                not req.data.rewind():
+            # The body's been sent, and can't be sent again
+            return response
+        try:
+            response.read()
+        except (socket.error, urllib2.URLError):
+            pass
+        response.close()
+        req.retries = retries + 1
+        self.throttle.retried(host)
+        # The ThrottleHandler waits until the host's block is over
+        return self.parent.open(req, timeout=req.timeout)
+
+    https_response = http_response
@@ -1,70 +1,393 @@
-import readline
-import pyrrhic.commands
-import urllib
-import urllib2
-import socket
-
-# HelpCommand is in the ui module because it's nothing to do with core
-# functionality
-class HelpCommand(pyrrhic.commands.BaseCommand):
-    """
-    Prints out some help on all commands.
-    """
-
-    def run(self, *args):
-        for opt, cls in REGISTERED_COMMANDS.items():
-            doc = ' '.join(cls.__doc__.split())
-            print "%s: %s" % (opt, doc)
+import optparse
+import os
+import pyrrhic.checks
+import pyrrhic.jobs
+import pyrrhic.session
+import pyrrhic.startup
+import sys
+import time
 
+# What each command's called, and its class as 'module:Class'. A class is
+# only imported when its command is looked up, so that starting pyr doesn't
+# import the commands, or the network modules they use, until they're run.
 REGISTERED_COMMANDS = {
-    'h': HelpCommand,
-    'r': pyrrhic.commands.ResourceCommand,
-    'q': pyrrhic.commands.QuitCommand,
-    's': pyrrhic.commands.ShowCommand,
-    'get': pyrrhic.commands.GetCommand,
-    'put': pyrrhic.commands.PutCommand,
-    'post': pyrrhic.commands.PostCommand,
-    'del': pyrrhic.commands.DeleteCommand,
-    'opts': pyrrhic.commands.OptionsCommand,
-    'auth': pyrrhic.commands.AuthCommand,
+    'h': 'pyrrhic.commands:HelpCommand',
+    'r': 'pyrrhic.commands:ResourceCommand',
+    'q': 'pyrrhic.commands:QuitCommand',
+    's': 'pyrrhic.commands:ShowCommand',
+    'get': 'pyrrhic.commands:GetCommand',
+    'put': 'pyrrhic.commands:PutCommand',
+    'post': 'pyrrhic.commands:PostCommand',
+    'del': 'pyrrhic.commands:DeleteCommand',
+    'opts': 'pyrrhic.commands:OptionsCommand',
+    'auth': 'pyrrhic.commands:AuthCommand',
+    'pool': 'pyrrhic.commands:PoolCommand',
+    'bench': 'pyrrhic.commands:BenchCommand',
+    'jobs': 'pyrrhic.commands:JobsCommand',
+    'stream': 'pyrrhic.commands:StreamCommand',
+    'timing': 'pyrrhic.commands:TimingCommand',
+    'format': 'pyrrhic.commands:FormatCommand',
+    'lines': 'pyrrhic.commands:LinesCommand',
+    'cache': 'pyrrhic.commands:CacheCommand',
+    'batch': 'pyrrhic.commands:BatchCommand',
+    'payload': 'pyrrhic.commands:PayloadCommand',
+    'var': 'pyrrhic.commands:VarCommand',
+    'template': 'pyrrhic.commands:TemplateCommand',
+    'watch': 'pyrrhic.commands:WatchCommand',
+    'http2': 'pyrrhic.commands:Http2Command',
+    'record': 'pyrrhic.commands:RecordCommand',
+    'replay': 'pyrrhic.commands:ReplayCommand',
+    'limit': 'pyrrhic.commands:LimitCommand',
+    'dns': 'pyrrhic.commands:DnsCommand',
+    'prewarm': 'pyrrhic.commands:PrewarmCommand',
+    'stats': 'pyrrhic.commands:StatsCommand',
 }
 
 
+def lookup_command(name):
+    """ The class of the command called `name`, or None if there isn't one """
+    path = REGISTERED_COMMANDS.get(name)
+    if path is None:
+        return None
+    module, _, cls = path.partition(':')
+    __import__(module)
+    return getattr(sys.modules[module], cls)
+
+
+PROMPT = 'pyr >>> '
+
+
 class CommandParser(object):
 
     def parse(self, str):
         bits = str.split()
         cmd = bits[0].lower()
-        command = REGISTERED_COMMANDS.get(cmd, pyrrhic.commands.UnknownCommand)
+        command = lookup_command(cmd)
+        if command is None:
+            import pyrrhic.commands
+            command = pyrrhic.commands.UnknownCommand
         return command, tuple(bits[1:])
         
 
 def run_command(command, args):
-    """ Validate and run the supplied command """
+    """
+    Validate and run the supplied command. Returns True if it ran, or False
+    if it didn't validate or the request failed.
+    """
+    import pyrrhic.commands
     try:
+        args = pyrrhic.commands.expand_variables(args)
         command.validate(*args)
     except pyrrhic.commands.ValidationError, e:
         print "Error: %s" % str(e)
-        return
+        return False
     try:
         command.run(*args)
-    except (urllib2.URLError, socket.gaierror), e:
+    except Exception:
+        # Only requests fail like this, and they've imported these by
+        # then, so commands that make none don't have to
+        import socket
+        import urllib2
+        if not isinstance(sys.exc_info()[1],
+                          (urllib2.URLError, socket.gaierror)):
+            raise
         import traceback
         traceback.print_exc()
+        return False
+    return True
     
     
-def console():
+def split_background(inp):
+    """
+    Return the input without any trailing '&', and whether it was there
+    (which means the command should be run in the background).
+    """
+    stripped = inp.rstrip()
+    if stripped.endswith('&'):
+        return stripped[:-1].rstrip(), True
+    return inp, False
+
+
+def show_job_result(job):
+    """ Print the output of a finished background job, tagged with its id """
+    import readline
+    out = ['\n[%d] done\t%s\n' % (job.id, job.description)]
+    out.extend(job.output)
+    if job.exc_info is not None:
+        import traceback
+        out.extend(traceback.format_exception(*job.exc_info))
+    # Put the prompt back, along with anything that was half typed
+    out.append(PROMPT + readline.get_line_buffer())
+    sys.stdout.write(''.join(out))
+    sys.stdout.flush()
+
+
+def run_background(command, args, description):
+    job = pyrrhic.jobs.manager.start(description, run_command, command, args,
+                                     on_done=show_job_result)
+    print '[%d] %s' % (job.id, description)
+    return job
+
+
+parse_statuses = pyrrhic.checks.parse_statuses
+
+
+class ScriptLine(object):
+    """ One command from a script, and how running it went """
+
+    def __init__(self, number, text, command, args):
+        self.number = number
+        self.text = text
+        self.command = command
+        self.args = args
+        self.ok = None
+        self.status = None
+        self.elapsed = None
+        self.output = []
+
+    def run(self, expected):
+        import pyrrhic.commands
+        start = time.time()
+        try:
+            self.ok = run_command(self.command, self.args)
+        except Exception:
+            # A failed line shouldn't stop the rest of the script, or the
+            # summary
+            import traceback
+            traceback.print_exc()
+            self.ok = False
+        self.elapsed = time.time() - start
+        if isinstance(self.command, pyrrhic.commands.UnknownCommand):
+            # Most likely a typo, which shouldn't pass unnoticed
+            self.ok = False
+        response = getattr(self.command, 'response', None)
+        if response is not None:
+            self.status = response.code
+            if self.ok and not expected(self.status):
+                print 'Error: unexpected status %s' % self.status
+                self.ok = False
+        checks = getattr(self.command, 'checks', None)
+        if self.ok and checks is not None and not checks.passed:
+            self.ok = False
+
+
+def read_script(f, resources):
+    """ Parse the lines of a script into `ScriptLine`s """
+    p = CommandParser()
+    lines = []
+    for number, text in enumerate(f):
+        text = text.strip()
+        if not text or text.startswith('#'):
+            continue
+        command, args = p.parse(text)
+        lines.append(ScriptLine(number + 1, text, command(resources), args))
+    return lines
+
+
+def run_script(lines, expected, parallel=1):
+    """
+    Run the lines of a script in order, printing their output. With
+    `parallel` > 1, runs of consecutive REST commands, which don't depend
+    on each other, are made up to `parallel` at a time; their output is
+    still printed in script order.
+    """
+    import pyrrhic.commands
+    running = []
+
+    def finish_oldest():
+        line, job = running.pop(0)
+        job.wait()
+        sys.stdout.write(''.join(job.output))
+        if job.exc_info is not None:
+            line.ok = False
+            import traceback
+            traceback.print_exception(*job.exc_info)
+
+    for line in lines:
+        # Commands that set variables are waited for, as later ones may
+        # use them
+        independent = isinstance(line.command,
+                                 pyrrhic.commands.RestCommand) and \
+            '-x' not in line.args
+        if parallel > 1 and independent:
+            if len(running) >= parallel:
+                finish_oldest()
+            job = pyrrhic.jobs.manager.start(line.text, line.run, expected)
+            running.append((line, job))
+            continue
+        while running:
+            finish_oldest()
+        line.run(expected)
+    while running:
+        finish_oldest()
+
+
+def print_summary(lines):
+    print
+    print 'line\tresult\ttime\tcommand'
+    for line in lines:
+        if line.ok:
+            result = line.status or 'ok'
+        elif line.status:
+            result = 'FAIL %s' % line.status
+        else:
+            result = 'FAIL'
+        print '%d\t%s\t%.3fs\t%s' % (line.number, result, line.elapsed,
+                                       line.text)
+    failed = len([line for line in lines if not line.ok])
+    print '%d commands, %d failed, %.3fs' % (len(lines), failed,
+        sum(line.elapsed for line in lines))
+
+
+def batch(f, expected, parallel=1, resources=None):
+    """
+    Run a script of pyr commands from the file object `f`. Returns the exit
+    status: 0 if every command succeeded, or 1 otherwise.
+    """
+    if resources is None:
+        resources = {}
+    lines = read_script(f, resources)
+    run_script(lines, expected, parallel)
+    print_summary(lines)
+    if all(line.ok for line in lines):
+        return 0
+    return 1
+
+
+def parse_options(argv):
+    parser = optparse.OptionParser(usage='%prog [--session FILE|--no-session] [-f SCRIPT [-j N]|-c COMMAND] [--expect CODES] [--profile-startup]')
+    parser.add_option('-f', '--file', dest='script',
+        help='run the commands in SCRIPT rather than interactively; '
+             'use - to read them from stdin')
+    parser.add_option('-c', '--command',
+        help='run COMMAND, then exit')
+    parser.add_option('-j', '--parallel', type='int', default=1,
+        help='run up to N consecutive REST commands at once')
+    parser.add_option('--expect', default='2xx,3xx',
+        help='status codes that count as success, e.g. 2xx,404 '
+             '(default %default)')
+    parser.add_option('--session', metavar='FILE',
+        help='save resources and payloads in FILE (default %s when '
+             'interactive; scripts and -c only use a session if given one)'
+             % pyrrhic.session.DEFAULT_PATH)
+    parser.add_option('--no-session', action='store_true', default=False,
+        help="don't load or save a session")
+    parser.add_option('--profile-startup', action='store_true',
+        default=False,
+        help='report how long each module takes to import, and how long '
+             'starting pyr takes in all, on stderr')
+    options, args = parser.parse_args(argv)
+    if args:
+        parser.error('unexpected arguments: %s' % ' '.join(args))
+    if options.command is not None:
+        if options.script is not None:
+            parser.error('-c and -f can\'t be used together')
+        if not options.command.strip():
+            parser.error('-c needs a command')
+    if options.parallel < 1:
+        parser.error('-j must be at least 1')
+    try:
+        options.expect = parse_statuses(options.expect)
+    except ValueError, e:
+        parser.error(str(e))
+    return options
+
+
+def open_session(options):
+    """
+    Return the `Session` to keep resources and payloads in, or None if
+    they're only to be kept in memory.
+    """
+    import pyrrhic.commands
+    path = options.session
+    if path is None and options.script is None and options.command is None:
+        path = pyrrhic.session.DEFAULT_PATH
+    if options.no_session or path is None:
+        return None
+    try:
+        session = pyrrhic.session.Session(os.path.expanduser(path))
+    except (IOError, OSError, ValueError), e:
+        sys.exit('Error: could not load session: %s' % e)
+    pyrrhic.commands.payloads = session.payloads
+    pyrrhic.commands.templates = session.templates
+    return session
+
+
+def console(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    options = parse_options(argv)
+    if options.profile_startup:
+        # Start again in a new process, timing everything from the start,
+        # without the option, however it was abbreviated
+        sys.exit(pyrrhic.startup.profile(
+            [arg for arg in argv if not (len(arg) > 3 and
+                                         '--profile-startup'.startswith(arg))]))
+    session = open_session(options)
+    if session is None:
+        resources = {}
+    else:
+        resources = session.resources
+    try:
+        if options.command is not None:
+            sys.exit(run_one(options.command, options.expect, resources))
+        elif options.script is not None:
+            run_file(options, resources)
+        else:
+            interact(resources, session)
+    finally:
+        if session is not None:
+            session.close()
+
+
+def run_one(text, expected, resources=None):
+    """
+    Run a single command, as for 'pyr -c'. Returns the exit status: 0 if
+    it succeeded, as for a line of a script, or 1 if it failed or wasn't
+    a command at all.
+    """
+    if resources is None:
+        resources = {}
+    command, args = CommandParser().parse(text)
+    line = ScriptLine(1, text, command(resources), args)
+    line.run(expected)
+    if line.ok:
+        return 0
+    return 1
+
+
+def run_file(options, resources):
+    if options.script == '-':
+        sys.exit(batch(sys.stdin, options.expect, options.parallel, resources))
+    f = open(options.script)
+    try:
+        status = batch(f, options.expect, options.parallel, resources)
+    finally:
+        f.close()
+    sys.exit(status)
+
+
+def interact(resources, session=None):
+    # Gives raw_input line editing and history. Only needed here, so pyr
+    # doesn't import it to run a script.
+    import readline
     p = CommandParser()
-    resources = {}
     exit = False
     while not exit:
         try:
-            inp = raw_input('pyr >>> ')
+            inp = raw_input(PROMPT)
+            inp, background = split_background(inp)
             if inp:
                 command, args = p.parse(inp)
                 c = command(resources)
-                run_command(c, args)
+                if background:
+                    run_background(c, args, inp)
+                else:
+                    run_command(c, args)
+                if session is not None:
+                    # Save anything the command changed in place, such as
+                    # a resource's authentication
+                    session.sync()
         except EOFError:
             print
             exit = True
-    
\ No newline at end of file
@@ -20,6 +20,10 @@ setup(name='pyrrhic',
       install_requires=[
           # -*- Extra requirements: -*-
       ],
+      extras_require={
+          # HTTP/2 support; see pyrrhic.http2
+          'http2': ['h2'],
+      },
       test_requires=[
         'nose',
         'mock',